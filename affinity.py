@@ -0,0 +1,104 @@
+import glob, os, re, subprocess
+from typing import Dict, List, Optional, Sequence
+
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def parse_cpu_list(text: str) -> List[int]:
+    ''' '0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11] '''
+    cpus = []
+    for part in text.strip().split(','):
+        if '-' in part:
+            begin, end = part.split('-')
+            cpus += list(range(int(begin), int(end) + 1))
+        elif len(part) > 0:
+            cpus.append(int(part))
+    return cpus
+
+
+def read_numa_cpus(sysfs_root: str = '/sys') -> Dict[int, List[int]]:
+    ''' {NUMA node: CPUs}, empty if the kernel exposes no nodes '''
+    numa_cpus = {}
+    for path in glob.glob(os.path.join(sysfs_root, 'devices/system/node/node*/cpulist')):
+        node = int(re.search(r'node(\d+)', path).group(1))
+        with open(path, 'r') as f:
+            numa_cpus[node] = parse_cpu_list(f.read())
+    return numa_cpus
+
+
+def read_gpu_numa_nodes(sysfs_root: str = '/sys') -> Dict[int, int]:
+    ''' {GPU index: NUMA node of its PCI device}. GPUs without a node (single socket hosts report -1) are missing. '''
+    try:
+        output = subprocess.run(['nvidia-smi', '--query-gpu=index,pci.bus_id', '--format=csv,noheader'], capture_output=True, text=True,
+                                check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    gpu_numa_nodes = {}
+    for line in output.strip().split('\n'):
+        try:
+            index, bus_id = [value.strip() for value in line.split(',')]
+            # nvidia-smi: 00000000:3B:00.0, sysfs: 0000:3b:00.0
+            domain, rest = bus_id.split(':', 1)
+            with open(os.path.join(sysfs_root, 'bus/pci/devices', (domain[-4:] + ':' + rest).lower(), 'numa_node'), 'r') as f:
+                node = int(f.read())
+        except (OSError, ValueError):
+            continue
+        if node >= 0:
+            gpu_numa_nodes[int(index)] = node
+    return gpu_numa_nodes
+
+
+class CpuAllocator():
+    '''
+    Give each job a fair share of the runner's CPUs (`len(allowed) // max_parallel`), taken from the NUMA nodes of its GPUs first.
+    Memory follows: Linux allocates pages on the node of the CPU that touches them first.
+    '''
+    def __init__(self,
+                 max_parallel: int,
+                 gpu_numa_nodes: Dict[int, int] = {},
+                 numa_cpus: Optional[Dict[int, List[int]]] = None,
+                 allowed_cpus: Optional[Sequence[int]] = None):
+        self.allowed_cpus = sorted(os.sched_getaffinity(0) if allowed_cpus is None else allowed_cpus)
+        numa_cpus = read_numa_cpus() if numa_cpus is None else numa_cpus
+        self.cpu_numa_node = {cpu: node for node, cpus in numa_cpus.items() for cpu in cpus}
+        self.gpu_numa_nodes = gpu_numa_nodes
+        self.share = max(1, len(self.allowed_cpus) // max(1, max_parallel))
+        self.assigned: Dict[str, List[int]] = {}  # owner -> CPUs
+
+    def allocate(self, owner: str, gpu_ids: Sequence[int]) -> List[int]:
+        nodes = set(self.gpu_numa_nodes[gpu_id] for gpu_id in gpu_ids if gpu_id in self.gpu_numa_nodes)
+        used = set(cpu for cpus in self.assigned.values() for cpu in cpus)
+        local = [cpu for cpu in self.allowed_cpus if self.cpu_numa_node.get(cpu) in nodes]
+        free = [cpu for cpu in local if cpu not in used] + [cpu for cpu in self.allowed_cpus if cpu not in used and cpu not in local]
+        # all shares taken (more jobs than max_parallel): share the local node rather than the whole host
+        cpus = free[:self.share] or local or self.allowed_cpus
+        self.assigned[owner] = cpus
+        return cpus
+
+    def release(self, owner: str):
+        self.assigned.pop(owner, None)
+
+
+def thread_env(cpu_ids: Sequence[int]) -> Dict[str, str]:
+    ''' thread pool sizes matching `cpu_ids`. Values already set in the runner's environment win. '''
+    if len(cpu_ids) == 0:
+        return {}
+    return {name: str(len(cpu_ids)) for name in THREAD_ENV_VARS if name not in os.environ}
+
+
+def set_affinity(cpu_ids: Sequence[int]):
+    if len(cpu_ids) > 0:
+        os.sched_setaffinity(0, cpu_ids)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser('print the CPUs each job would get')
+    parser.add_argument('--max-parallel', type=int, default=10)
+    parser.add_argument('--gpus', type=str, nargs='+', default=['0', '1'], help='GPU ids of each job, e.g. 0 1 2,3')
+    args = parser.parse_args()
+
+    allocator = CpuAllocator(args.max_parallel, read_gpu_numa_nodes())
+    for i, gpu_ids in enumerate(args.gpus):
+        cpus = allocator.allocate(str(i), list(map(int, gpu_ids.split(','))))
+        print('{}\t{}\t{}'.format(gpu_ids, ','.join(map(str, cpus)), thread_env(cpus)))
@@ -0,0 +1,321 @@
+import array, json, os, socket, socketserver, threading, time
+from typing import Dict, List, Optional, Sequence
+
+DEFAULT_SOCKET = '~/.py-job-runner/gpu-allocator.sock'
+DEFAULT_STATE_FILE = '~/.py-job-runner/gpu-allocator.json'
+# what gpu.py keeps when no allocator runs; imported on the first start
+LEGACY_HISTORY_FILE = '~/.gpu_history.json'
+LEGACY_RESERVATION_FILE = '~/.gpu_memory_reservations.json'
+
+
+class FakeDevices():
+    ''' `count` idle GPUs of `memory_mb` each, for tests and machines without GPUs '''
+    def __init__(self, count: int, memory_mb: int = 16000):
+        self.count = count
+        self.memory_mb = memory_mb
+
+    def available(self, max_memory_used: float) -> List[int]:
+        return list(range(self.count))
+
+    def memory_total(self) -> Dict[int, int]:
+        return {gpu_id: self.memory_mb for gpu_id in range(self.count)}
+
+    def snapshot(self):
+        import gpu
+        return gpu._snapshot([(gpu_id, self.memory_mb, 0, 0) for gpu_id in range(self.count)])
+
+
+class NvidiaDevices():
+    ''' GPUs as gpu.py's telemetry sampler reports them, at most `refresh_s` seconds old '''
+    def __init__(self, refresh_s: float = 2, source: str = 'auto'):
+        import gpu
+        self.sampler = gpu.TelemetrySampler(gpu.make_source(source), refresh_s, ttl_s=max(10, refresh_s * 5)).start()
+
+    def available(self, max_memory_used: float) -> List[int]:
+        return self.sampler.get().available(max_memory_used)
+
+    def memory_total(self) -> Dict[int, int]:
+        return self.sampler.get().memory_total()
+
+    def snapshot(self):
+        return self.sampler.get()
+
+
+class Allocator():
+    '''
+    Whole-GPU and shared memory reservations of one host, what gpu.py otherwise keeps in JSON files under a flock.
+    The state is written to `state_file` by an atomic rename after each change. That survives a crash of the daemon;
+    a crash of the host ends the jobs holding the reservations anyway, so nothing is fsynced.
+    '''
+    OPERATIONS = ['acquire', 'release', 'memory_total', 'snapshot', 'shared_memory', 'reserve_memory', 'reserve_best_fit', 'release_memory']
+
+    def __init__(self,
+                 devices,
+                 state_file: Optional[str] = None,
+                 legacy_history_file: str = LEGACY_HISTORY_FILE,
+                 legacy_reservation_file: str = LEGACY_RESERVATION_FILE):
+        self.devices = devices
+        self.state_file = os.path.expanduser(state_file) if state_file else None
+        # imported when there is no state yet, so reservations made through the JSON files are kept
+        self.legacy_history_file = legacy_history_file
+        self.legacy_reservation_file = legacy_reservation_file
+        self.lock = threading.Lock()
+        self.history: Dict[int, float] = {}  # gpu id -> reserved at
+        self.memory: Dict[int, Dict[str, List[float]]] = {}  # gpu id -> {owner: [memory MB, reserved at]}
+        self._load()
+
+    def _load(self):
+        if self.state_file is not None and os.path.exists(self.state_file):
+            with open(self.state_file, 'r') as f:
+                state = json.load(f)
+            history, memory = state['history'], state['memory']
+        else:
+            history, memory = _read_json(self.legacy_history_file), _read_json(self.legacy_reservation_file)
+        self.history = {int(gpu_id): reserved_at for gpu_id, reserved_at in history.items()}
+        self.memory = {int(gpu_id): owners for gpu_id, owners in memory.items()}
+
+    def _save(self):
+        if self.state_file is None:
+            return
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        temp_file = self.state_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump({'history': self.history, 'memory': self.memory}, f)
+        os.replace(temp_file, self.state_file)
+
+    def _expire(self, assign_interval_s: float):
+        current_time = time.time()
+        self.history = {gpu_id: reserved_at for gpu_id, reserved_at in self.history.items() if current_time - reserved_at <= assign_interval_s}
+        memory = {
+            gpu_id: {owner: value
+                     for owner, value in owners.items() if current_time - value[1] <= assign_interval_s}
+            for gpu_id, owners in self.memory.items()
+        }
+        self.memory = {gpu_id: owners for gpu_id, owners in memory.items() if len(owners) > 0}
+
+    def acquire(self, candidate_gpu_ids: Sequence[int], assign_interval_s: float, max_memory_used: float = 0.001,
+                ngpu: Optional[int] = None) -> List[int]:
+        ''' see `gpu.try_get_available_gpu` '''
+        with self.lock:
+            self._expire(assign_interval_s)
+            available_gpu_ids = set(self.devices.available(max_memory_used))
+            if len(candidate_gpu_ids) > 0:
+                available_gpu_ids &= set(candidate_gpu_ids)
+            available_gpu_ids -= set(self.history) | set(self.memory)
+            if ngpu is not None and len(available_gpu_ids) < ngpu:
+                return []
+            gpu_ids = sorted(available_gpu_ids)[:ngpu]
+            if len(gpu_ids) > 0:
+                self.history.update((gpu_id, time.time()) for gpu_id in gpu_ids)
+                self._save()
+            return gpu_ids
+
+    def release(self, gpu_ids: Sequence[int]):
+        with self.lock:
+            if any(gpu_id in self.history for gpu_id in gpu_ids):
+                for gpu_id in gpu_ids:
+                    self.history.pop(gpu_id, None)
+                self._save()
+
+    def memory_total(self) -> Dict[int, int]:
+        with self.lock:
+            return self.devices.memory_total()
+
+    def snapshot(self) -> dict:
+        ''' `gpu.GpuSnapshot` fields as lists, for runners profiling their jobs '''
+        snapshot = self.devices.snapshot()
+        return {field: list(value) if isinstance(value, array.array) else value for field, value in snapshot._asdict().items()}
+
+    def shared_memory(self, candidate_gpu_ids: Sequence[int], memory_total: Dict[int, int], assign_interval_s: float) -> Dict[int, int]:
+        ''' see `gpu.get_shared_gpu_memory` '''
+        memory_total = _int_keys(memory_total)
+        with self.lock:
+            self._expire(assign_interval_s)
+            return self._free_memory(candidate_gpu_ids, memory_total)
+
+    def _free_memory(self, candidate_gpu_ids: Sequence[int], memory_total: Dict[int, int]) -> Dict[int, int]:
+        return {
+            gpu_id: memory_total[gpu_id] - sum(value[0] for value in owners.values())
+            for gpu_id, owners in self.memory.items()
+            if gpu_id in memory_total and (len(candidate_gpu_ids) == 0 or gpu_id in candidate_gpu_ids)
+        }
+
+    def reserve_memory(self, gpu_ids: Sequence[int], memory_mb: int, owner: str, assign_interval_s: float):
+        with self.lock:
+            self._expire(assign_interval_s)
+            for gpu_id in gpu_ids:
+                self.memory.setdefault(gpu_id, {})[owner] = [memory_mb, time.time()]
+            self._save()
+
+    def reserve_best_fit(self, candidate_gpu_ids: Sequence[int], memory_total: Dict[int, int], memory_mb: int, ngpu: int, owner: str,
+                         assign_interval_s: float, whole_gpu_ids: Sequence[int] = ()) -> List[int]:
+        ''' see `gpu.reserve_best_fit`; picks and reserves in one step so two runners never fill the same hole '''
+        import gpu
+        memory_total = _int_keys(memory_total)
+        with self.lock:
+            self._expire(assign_interval_s)
+            free_memory = self._free_memory(candidate_gpu_ids, memory_total)
+            free_memory.update({gpu_id: memory_total[gpu_id] for gpu_id in whole_gpu_ids if gpu_id in memory_total and gpu_id not in free_memory})
+            gpu_ids = gpu.best_fit(free_memory, memory_mb, ngpu)
+            if len(gpu_ids) > 0:
+                for gpu_id in gpu_ids:
+                    self.memory.setdefault(gpu_id, {})[owner] = [memory_mb, time.time()]
+                self._save()
+            return gpu_ids
+
+    def release_memory(self, owner: str):
+        with self.lock:
+            if any(owner in owners for owners in self.memory.values()):
+                for owners in self.memory.values():
+                    owners.pop(owner, None)
+                self.memory = {gpu_id: owners for gpu_id, owners in self.memory.items() if len(owners) > 0}
+                self._save()
+
+    def handle(self, request: dict):
+        if request.get('op') not in self.OPERATIONS:
+            raise ValueError('unknown operation: {}'.format(request.get('op')))
+        return getattr(self, request['op'])(**request.get('args', {}))
+
+
+def _read_json(path: str) -> dict:
+    path = os.path.expanduser(path)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _int_keys(result):
+    # JSON object keys are strings; GPU ids are ints
+    return {int(key): value for key, value in result.items()} if isinstance(result, dict) else result
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    ''' one JSON request per line, answered by one JSON line. Clients keep the connection open. '''
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = {'result': self.server.allocator.handle(json.loads(line))}
+            except Exception as e:
+                response = {'error': repr(e)}
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class AllocatorServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, allocator: Allocator, path: str = DEFAULT_SOCKET):
+        self.allocator = allocator
+        self.path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if os.path.exists(self.path):
+            # left by a crashed daemon; refuse to replace a live one
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(self.path)
+                    raise OSError('an allocator is already listening on {}'.format(self.path))
+                except (ConnectionRefusedError, FileNotFoundError):
+                    os.remove(self.path)
+        super().__init__(self.path, _Handler)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class AllocatorClient():
+    ''' `Allocator`'s methods over the daemon's socket, on one connection shared by the caller's threads '''
+    def __init__(self, path: str = DEFAULT_SOCKET, timeout_s: float = 10):
+        self.path = os.path.expanduser(path)
+        self.timeout_s = timeout_s
+        self.lock = threading.Lock()
+        self.sock = None
+        self.file = None
+
+    def _connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout_s)
+        self.sock.connect(self.path)
+        self.file = self.sock.makefile('rwb')
+
+    def close(self):
+        if self.sock is not None:
+            self.file.close()
+            self.sock.close()
+        self.sock, self.file = None, None
+
+    def _call(self, op: str, **args):
+        request = json.dumps({'op': op, 'args': args}).encode() + b'\n'
+        with self.lock:
+            # a restarted daemon closes the old connection without reading it; send again on a new one
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self._connect()
+                    self.file.write(request)
+                    self.file.flush()
+                    line = self.file.readline()
+                    if len(line) == 0:
+                        raise ConnectionResetError('allocator closed the connection')
+                    break
+                except OSError:
+                    self.close()
+                    if attempt == 1:
+                        raise
+        response = json.loads(line)
+        if 'error' in response:
+            raise RuntimeError('allocator: ' + response['error'])
+        return response['result']
+
+    def acquire(self, candidate_gpu_ids, assign_interval_s, max_memory_used=0.001, ngpu=None) -> List[int]:
+        return self._call('acquire', candidate_gpu_ids=sorted(candidate_gpu_ids), assign_interval_s=assign_interval_s,
+                          max_memory_used=max_memory_used, ngpu=ngpu)
+
+    def release(self, gpu_ids):
+        self._call('release', gpu_ids=list(gpu_ids))
+
+    def memory_total(self) -> Dict[int, int]:
+        return _int_keys(self._call('memory_total'))
+
+    def snapshot(self):
+        import gpu
+        fields = self._call('snapshot')
+        return gpu.GpuSnapshot(array.array('i', fields['ids']), *[array.array('d', fields[field]) for field in gpu.GpuSnapshot._fields[1:4]],
+                               fields['sampled_at'])
+
+    def shared_memory(self, candidate_gpu_ids, memory_total, assign_interval_s) -> Dict[int, int]:
+        return _int_keys(self._call('shared_memory', candidate_gpu_ids=sorted(candidate_gpu_ids), memory_total=memory_total,
+                                    assign_interval_s=assign_interval_s))
+
+    def reserve_memory(self, gpu_ids, memory_mb, owner, assign_interval_s):
+        self._call('reserve_memory', gpu_ids=list(gpu_ids), memory_mb=memory_mb, owner=owner, assign_interval_s=assign_interval_s)
+
+    def reserve_best_fit(self, candidate_gpu_ids, memory_total, memory_mb, ngpu, owner, assign_interval_s, whole_gpu_ids=()) -> List[int]:
+        return self._call('reserve_best_fit', candidate_gpu_ids=sorted(candidate_gpu_ids), memory_total=memory_total, memory_mb=memory_mb,
+                          ngpu=ngpu, owner=owner, assign_interval_s=assign_interval_s, whole_gpu_ids=sorted(whole_gpu_ids))
+
+    def release_memory(self, owner):
+        self._call('release_memory', owner=owner)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser('per-host GPU allocator shared by runner.py --gpu-allocator and gpu.py --allocator')
+    parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET)
+    parser.add_argument('--state-file', type=str, default=DEFAULT_STATE_FILE, help='reservations survive restarts of the allocator here')
+    parser.add_argument('--device-refresh-s', type=float, default=2, help='GPU state is sampled this often in the background')
+    parser.add_argument('--telemetry', choices=['auto', 'nvml', 'nvidia-smi'], default='auto', help='auto: NVML if pynvml is installed')
+    parser.add_argument('--fake-gpus', type=int, default=0, help='serve this many idle fake GPUs instead of the real ones')
+    parser.add_argument('--fake-memory-mb', type=int, default=16000)
+    args = parser.parse_args()
+
+    devices = FakeDevices(args.fake_gpus, args.fake_memory_mb) if args.fake_gpus > 0 else NvidiaDevices(args.device_refresh_s, args.telemetry)
+    server = AllocatorServer(Allocator(devices, args.state_file), args.socket)
+    print('listening on {}'.format(server.path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
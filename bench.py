@@ -0,0 +1,251 @@
+import time, multiprocessing, threading, queue, random, datetime, heapq
+from db import JobRepository, add_database_arguments, open_database
+from model import Job, JobStatus
+import wakeup
+from scheduler import Policy
+
+BENCH_REPO_URL = 'bench://py-gpu-job-runner'
+
+
+def connect(args, max_size=1):
+    return open_database(args, max_size=max_size)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def cleanup(args):
+    repo = JobRepository(connect(args))
+    with repo.db.cursor() as cur:
+        cur.execute('DELETE FROM jobs WHERE repo_url = %s', BENCH_REPO_URL)
+
+
+def enqueue(args, n_jobs):
+    repo = JobRepository(connect(args))
+    repo.create_many(
+        [Job(repo_url=BENCH_REPO_URL, status=JobStatus.Queue, command='echo {}'.format(i), num_gpu=1, priority=i % 3) for i in range(n_jobs)])
+
+
+def _claim_worker(args, start_event, result_que):
+    repo = JobRepository(connect(args))
+    claimed = 0
+    start_event.wait()
+    while repo.pop_next_job(max_gpu_available=8, labels=[]) is not None:
+        claimed += 1
+    result_que.put(claimed)
+
+
+def bench_claim(args):
+    ''' claims/sec while N runner processes drain the same queue '''
+    print('runners\tjobs\tseconds\tclaims/sec')
+    for n_runners in args.runners:
+        cleanup(args)
+        enqueue(args, args.jobs)
+        start_event = multiprocessing.Event()
+        result_que = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=_claim_worker, args=(args, start_event, result_que)) for _ in range(n_runners)]
+        for worker in workers:
+            worker.start()
+        time.sleep(1)  # wait for connections and schema checks
+        begin = time.time()
+        start_event.set()
+        claimed = sum(result_que.get() for _ in workers)
+        elapsed = time.time() - begin
+        for worker in workers:
+            worker.join()
+        print('{}\t{}\t{:.3f}\t{:.1f}'.format(n_runners, claimed, elapsed, claimed / elapsed))
+    cleanup(args)
+
+
+def _job_lifecycle(repo, job_id, n_heartbeats, latencies):
+    # what one WrapExecutor and its heartbeats cost the runner's repository
+    for i in range(n_heartbeats + 2):
+        begin = time.time()
+        if i == 0:
+            repo.update(job_id, run_id='bench')
+        elif i <= n_heartbeats:
+            repo.update_timestamp(job_id)
+        else:
+            repo.update(job_id, status=JobStatus.Finish)
+        latencies.append(time.time() - begin)
+
+
+def bench_latency(args):
+    ''' per-job repository latency in one runner process as --max-parallel grows '''
+    print('pool\tparallel\tp50 ms\tp95 ms\tmax ms')
+    for pool_size in args.pool_sizes:
+        db = connect(args, pool_size)
+        repo = JobRepository(db)
+        stop = threading.Event()
+        if args.slow_query_s > 0:
+            # another thread keeps one connection busy, like a slow scheduler query
+            def slow_query(db, stop):
+                while not stop.is_set():
+                    with db.cursor() as cur:
+                        cur.execute('SELECT SLEEP(%s)', args.slow_query_s)
+
+            threading.Thread(target=slow_query, args=(db, stop), daemon=True).start()
+        for parallel in args.parallel:
+            cleanup(args)
+            jobs = [repo.create(Job(repo_url=BENCH_REPO_URL, status=JobStatus.Running, command='sleep')) for _ in range(parallel)]
+            latencies = []
+            threads = [threading.Thread(target=_job_lifecycle, args=(repo, job.id, args.heartbeats, latencies)) for job in jobs]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            print('{}\t{}\t{:.2f}\t{:.2f}\t{:.2f}'.format(pool_size, parallel,
+                                                         percentile(latencies, 0.5) * 1000,
+                                                         percentile(latencies, 0.95) * 1000,
+                                                         max(latencies) * 1000))
+        stop.set()
+    cleanup(args)
+
+
+def _idle_runner(args, listener, stop, claimed_que):
+    repo = JobRepository(connect(args))
+    while not stop.is_set():
+        if listener is None:
+            time.sleep(args.poll_s)
+        else:
+            listener.wait(args.poll_s)
+        job = repo.pop_next_job(max_gpu_available=8, labels=[])
+        if job is not None:
+            claimed_que.put(time.time())
+
+
+def bench_wakeup(args):
+    ''' enqueue-to-claim latency of an idle runner, polling vs woken up by push '''
+    print('mode\tjobs\tp50 ms\tp95 ms\tmax ms')
+    cleanup(args)
+    repo = JobRepository(connect(args))
+    for mode in ['poll', 'wakeup']:
+        listener = wakeup.WakeupListener(host='127.0.0.1', advertise_host='127.0.0.1') if mode == 'wakeup' else None
+        stop = threading.Event()
+        claimed_que = queue.Queue()
+        thread = threading.Thread(target=_idle_runner, args=(args, listener, stop, claimed_que), daemon=True)
+        thread.start()
+        latencies = []
+        for _ in range(args.jobs):
+            time.sleep(random.uniform(0, args.poll_s))  # arrive at a random point of the poll cycle
+            begin = time.time()
+            repo.create(Job(repo_url=BENCH_REPO_URL, status=JobStatus.Queue, command='echo', num_gpu=1))
+            if listener is not None:
+                wakeup.notify([listener.address])
+            latencies.append(claimed_que.get() - begin)
+        stop.set()
+        if listener is not None:
+            wakeup.notify([listener.address])
+        thread.join()
+        print('{}\t{}\t{:.2f}\t{:.2f}\t{:.2f}'.format(mode, args.jobs,
+                                                     percentile(latencies, 0.5) * 1000,
+                                                     percentile(latencies, 0.95) * 1000,
+                                                     max(latencies) * 1000))
+    cleanup(args)
+
+
+def make_trace(args):
+    ''' mostly small jobs with a declared runtime, and some full-node jobs '''
+    rand = random.Random(args.seed)
+    begin = datetime.datetime(2000, 1, 1)
+    arrival = 0.0
+    trace = []
+    for i in range(args.jobs):
+        arrival += rand.expovariate(1 / args.mean_interarrival_s)
+        if rand.random() < args.large_ratio:
+            num_gpu, runtime = args.gpus_per_runner, rand.uniform(3600, 4 * 3600)
+        else:
+            num_gpu, runtime = rand.choice([1, 1, 1, 2, 4]), rand.uniform(600, 2 * 3600)
+        # declared runtimes are upper bounds; jobs usually end earlier
+        job = Job(id=i,
+                  priority=rand.choice([5, 5, 10]),
+                  num_gpu=num_gpu,
+                  expected_runtime_s=int(runtime),
+                  created_at=begin + datetime.timedelta(seconds=arrival))
+        trace.append((job, runtime * rand.uniform(0.5, 1.0)))
+    return begin, trace
+
+
+def simulate(policy, args, total_gpus):
+    ''' (GPU utilization until the last job ends, mean wait of small jobs, mean wait of large jobs) '''
+    begin, trace = make_trace(args)
+    events = [(job.created_at, 0, job.id) for job, _ in trace]  # (time, 0: arrival / 1: finish, job id or runner)
+    heapq.heapify(events)
+    actual_runtime = {job.id: runtime for job, runtime in trace}
+    queued = {}
+    running = [[] for _ in range(args.runners)]
+    waits = {True: [], False: []}
+    busy_gpu_s = 0
+    current_time = begin
+    while events:
+        current_time, kind, key = heapq.heappop(events)
+        if kind == 0:
+            queued[key] = trace[key][0]
+        else:
+            running[key[0]] = [job for job in running[key[0]] if job.id != key[1]]
+        for runner in range(args.runners):
+            while True:
+                free_gpus = args.gpus_per_runner - sum(job.num_gpu for job in running[runner])
+                job = policy.select(list(queued.values()), free_gpus, current_time, total_gpus, running[runner])
+                if job is None:
+                    break
+                del queued[job.id]
+                job = job._replace(started_at=current_time)
+                running[runner].append(job)
+                waits[job.num_gpu == args.gpus_per_runner].append((current_time - job.created_at).total_seconds())
+                busy_gpu_s += job.num_gpu * actual_runtime[job.id]
+                heapq.heappush(events, (current_time + datetime.timedelta(seconds=actual_runtime[job.id]), 1, (runner, job.id)))
+    makespan = (current_time - begin).total_seconds()
+    mean = lambda values: sum(values) / len(values) if values else 0
+    return busy_gpu_s / (makespan * args.runners * args.gpus_per_runner), mean(waits[False]), mean(waits[True])
+
+
+def bench_schedule(args):
+    ''' GPU utilization of a simulated trace, strict head-of-line blocking vs backfill with aging '''
+    print('policy\tutilization\tsmall wait h\tlarge wait h')
+    policies = [
+        ('blocking', Policy(aging_s=0, backfill=False), None),  # the former single-query claim
+        ('backfill', Policy(aging_s=args.aging_hours * 60 * 60), args.gpus_per_runner),
+    ]
+    for name, policy, total_gpus in policies:
+        utilization, small_wait, large_wait = simulate(policy, args, total_gpus)
+        print('{}\t{:.3f}\t{:.2f}\t{:.2f}'.format(name, utilization, small_wait / 3600, large_wait / 3600))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        'Benchmarks. Jobs are created with repo_url={} and deleted afterwards; use a scratch database.'.format(BENCH_REPO_URL))
+    add_database_arguments(parser)
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+    claim_parser = subparsers.add_parser('claim', help=bench_claim.__doc__)
+    claim_parser.add_argument('--jobs', type=int, default=2000)
+    claim_parser.add_argument('--runners', type=int, nargs='+', default=[1, 2, 4, 8, 16])
+    latency_parser = subparsers.add_parser('latency', help=bench_latency.__doc__)
+    latency_parser.add_argument('--parallel', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32])
+    latency_parser.add_argument('--pool-sizes', type=int, nargs='+', default=[1, 8], help='1 behaves like the former global db_lock')
+    latency_parser.add_argument('--heartbeats', type=int, default=20)
+    latency_parser.add_argument('--slow-query-s', type=float, default=0, help='mysql only')
+    wakeup_parser = subparsers.add_parser('wakeup', help=bench_wakeup.__doc__)
+    wakeup_parser.add_argument('--jobs', type=int, default=10)
+    wakeup_parser.add_argument('--poll-s', type=float, default=2, help='idle poll interval (the runner loop waits up to 10 s)')
+    schedule_parser = subparsers.add_parser('schedule', help=bench_schedule.__doc__ + ' (no database)')
+    schedule_parser.add_argument('--runners', type=int, default=4)
+    schedule_parser.add_argument('--gpus-per-runner', type=int, default=8)
+    schedule_parser.add_argument('--jobs', type=int, default=2000)
+    schedule_parser.add_argument('--mean-interarrival-s', type=float, default=350)
+    schedule_parser.add_argument('--large-ratio', type=float, default=0.1)
+    schedule_parser.add_argument('--aging-hours', type=float, default=6)
+    schedule_parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.subcommand == 'claim':
+        bench_claim(args)
+    elif args.subcommand == 'latency':
+        bench_latency(args)
+    elif args.subcommand == 'wakeup':
+        bench_wakeup(args)
+    elif args.subcommand == 'schedule':
+        bench_schedule(args)
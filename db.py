@@ -1,187 +1,1110 @@
-from typing import Optional, Sequence
-import datetime, threading
+from typing import Dict, List, Optional, Sequence, Tuple
+import datetime, json, time, zlib
 
-from pymysql.connections import Connection
-from model import Job, JobStatus, Runner, RunnerStatus
+from model import Job, JobEvent, JobStatus, Runner, RunnerStatus
+from scheduler import Policy
+from storage.backend import Backend, Migration, load_backend
+import util
 
-db_lock = threading.Lock()
+
+def now(tz: datetime.tzinfo) -> datetime.datetime:
+    # DATETIME columns have no time zone. All writers use the repository `tz`.
+    return datetime.datetime.now(tz=tz).replace(tzinfo=None)
+
+
+def add_database_arguments(parser, prefix='--'):
+    parser.add_argument(prefix + 'backend', choices=['mysql', 'sqlite'], default='mysql')
+    parser.add_argument(prefix + 'host', default='localhost')
+    parser.add_argument(prefix + 'user', default='jobmanager')
+    parser.add_argument(prefix + 'password', default='jobmanager')
+    parser.add_argument(prefix + 'database', default='jobmanage_py')
+    parser.add_argument(prefix + 'sqlite-path', default='~/.py-job-runner/jobs.sqlite3', help='database file of the sqlite backend')
+
+
+def open_database(args, **kwargs) -> Backend:
+    if args.backend == 'sqlite':
+        return load_backend('sqlite')(args.sqlite_path)
+    return load_backend('mysql')(host=args.host, user=args.user, password=args.password, database=args.database, **kwargs)
+
+
+def split_labels(labels: str) -> List[str]:
+    return sorted(set(labels.split(','))) if len(labels) > 0 else []
+
+
+def split_job_ids(ids: str) -> List[int]:
+    return sorted(set(int(id) for id in ids.split(',') if len(id.strip()) > 0)) if ids else []
+
+
+def _normalize_iso_timestamps(table: str, batch_size: int = 5000):
+    # '2020-01-01T12:34:56.789+09:00' -> '2020-01-01 12:34:56', in id ranges to keep each statement short
+    def step(cur):
+        cur.execute('SELECT MIN(id) AS lo, MAX(id) AS hi FROM ' + table)
+        row = cur.fetchone()
+        if row['lo'] is None:
+            return
+        for lo in range(row['lo'], row['hi'] + 1, batch_size):
+            cur.execute(
+                'UPDATE {0} SET'
+                '   created_at = LEFT(REPLACE(created_at, \'T\', \' \'), 19),'
+                '   updated_at = LEFT(REPLACE(updated_at, \'T\', \' \'), 19)'
+                ' WHERE id >= %s AND id < %s'.format(table), (lo, lo + batch_size))
+
+    return step
+
+
+def _backfill_job_labels(cur, batch_size: int = 5000):
+    last_id = 0
+    while True:
+        cur.execute('SELECT id, required_labels FROM jobs WHERE id > %s AND required_labels <> \'\' ORDER BY id LIMIT %s', (last_id, batch_size))
+        rows = cur.fetchall()
+        if len(rows) == 0:
+            return
+        values = [(row['id'], label) for row in rows for label in split_labels(row['required_labels'])]
+        cur.executemany('INSERT IGNORE INTO job_labels (job_id, label) VALUES (%s, %s)', values)
+        last_id = rows[-1]['id']
+
+
+def compress_message(message: str, max_bytes: int) -> Tuple[bytes, int]:
+    ''' (zlib-compressed message, original size in bytes). Only the last `max_bytes` are kept, where errors usually are. '''
+    data = message.encode('utf-8', errors='replace')
+    size = len(data)
+    if size > max_bytes:
+        data = '[{} bytes truncated]\n'.format(size - max_bytes).encode() + data[size - max_bytes:]
+    return zlib.compress(data), size
+
+
+def decompress_message(data: Optional[bytes]) -> str:
+    return zlib.decompress(data).decode('utf-8', errors='replace') if data else ''
+
+
+DEFAULT_MAX_MESSAGE_BYTES = 256 * 1024
+
+
+def dependency_failed_message(parent_id: int, status: str) -> str:
+    return 'canceled: dependency {} ended with {}'.format(parent_id, status)
+
+
+def _move_messages_to_job_logs(cur, batch_size: int = 1000):
+    last_id = 0
+    while True:
+        cur.execute('SELECT id, message FROM jobs WHERE id > %s AND message <> \'\' ORDER BY id LIMIT %s', (last_id, batch_size))
+        rows = cur.fetchall()
+        if len(rows) == 0:
+            return
+        values = [(row['id'], *compress_message(row['message'], DEFAULT_MAX_MESSAGE_BYTES)) for row in rows]
+        cur.executemany('INSERT INTO job_logs (job_id, message, size) VALUES (%s, %s, %s)', values)
+        last_id = rows[-1]['id']
+
+
+# yapf: disable
+MIGRATIONS = [
+    Migration(1, 'create jobs and runners tables', mysql=[
+        'CREATE TABLE IF NOT EXISTS jobs ('+
+        '   id int NOT NULL AUTO_INCREMENT,'+
+        '   repo_url varchar(1024),'+
+        '   commit_hash varchar(255),'+
+        '   status varchar(16),'+
+        '   command LONGTEXT,'+
+        '   message LONGTEXT,'+
+        '   priority int,'+
+        '   num_gpu int,'+
+        '   required_labels varchar(255),'+
+        '   executor varchar(255),'+
+        '   gpu_ids varchar(255),'+
+        '   host varchar(255),'+
+        '   run_id varchar(255),'+
+        '   created_at varchar(64),'+
+        '   updated_at varchar(64),'+
+        '   PRIMARY KEY (id))',
+        'CREATE TABLE IF NOT EXISTS runners ('+
+        '   id int NOT NULL AUTO_INCREMENT,'+
+        '   name varchar(255),'+
+        '   gpu_ids varchar(255),'+
+        '   labels varchar(255),'+
+        '   status varchar(16),'+
+        '   created_at varchar(64),'+
+        '   updated_at varchar(64),'+
+        '   PRIMARY KEY (id))',
+    ], sqlite=[
+        # AUTOINCREMENT: ids of deleted rows are never reused
+        'CREATE TABLE IF NOT EXISTS jobs ('+
+        '   id INTEGER PRIMARY KEY AUTOINCREMENT,'+
+        '   repo_url varchar(1024),'+
+        '   commit_hash varchar(255),'+
+        '   status varchar(16),'+
+        '   command TEXT,'+
+        '   message TEXT,'+
+        '   priority int,'+
+        '   num_gpu int,'+
+        '   required_labels varchar(255),'+
+        '   executor varchar(255),'+
+        '   gpu_ids varchar(255),'+
+        '   host varchar(255),'+
+        '   run_id varchar(255),'+
+        '   created_at DATETIME,'+
+        '   updated_at DATETIME)',
+        'CREATE TABLE IF NOT EXISTS runners ('+
+        '   id INTEGER PRIMARY KEY AUTOINCREMENT,'+
+        '   name varchar(255),'+
+        '   gpu_ids varchar(255),'+
+        '   labels varchar(255),'+
+        '   status varchar(16),'+
+        '   created_at DATETIME,'+
+        '   updated_at DATETIME)',
+    ]),
+    Migration(2, 'store timestamps as DATETIME', mysql=[
+        _normalize_iso_timestamps('jobs'),
+        _normalize_iso_timestamps('runners'),
+        # column type change copies the table; LOCK=SHARED keeps it readable meanwhile
+        'ALTER TABLE jobs MODIFY created_at DATETIME(6), MODIFY updated_at DATETIME(6), ALGORITHM=COPY, LOCK=SHARED',
+        'ALTER TABLE runners MODIFY created_at DATETIME(6), MODIFY updated_at DATETIME(6)',
+    ]),
+    Migration(3, 'index scheduler and watcher queries', mysql=[
+        'ALTER TABLE jobs'+
+        '   ADD INDEX jobs_status_priority_created (status, priority DESC, created_at),'+
+        '   ADD INDEX jobs_status_updated (status, updated_at),'+
+        '   ALGORITHM=INPLACE, LOCK=NONE',
+    ], sqlite=[
+        'CREATE INDEX jobs_status_priority_created ON jobs (status, priority DESC, created_at)',
+        'CREATE INDEX jobs_status_updated ON jobs (status, updated_at)',
+    ]),
+    Migration(4, 'index required labels in job_labels', mysql=[
+        'CREATE TABLE IF NOT EXISTS job_labels ('+
+        '   job_id int NOT NULL,'+
+        '   label varchar(255) NOT NULL,'+
+        '   PRIMARY KEY (job_id, label),'+
+        '   INDEX job_labels_label (label, job_id))',
+        _backfill_job_labels,
+    ], sqlite=[
+        'CREATE TABLE IF NOT EXISTS job_labels ('+
+        '   job_id int NOT NULL,'+
+        '   label varchar(255) NOT NULL,'+
+        '   PRIMARY KEY (job_id, label))',
+        'CREATE INDEX job_labels_label ON job_labels (label, job_id)',
+    ]),
+    Migration(5, 'move job messages to compressed job_logs', mysql=[
+        'CREATE TABLE IF NOT EXISTS job_logs ('+
+        '   job_id int NOT NULL,'+
+        '   message LONGBLOB,'+
+        '   size int,'+
+        '   PRIMARY KEY (job_id))',
+        _move_messages_to_job_logs,
+        'ALTER TABLE jobs DROP COLUMN message, ALGORITHM=INPLACE, LOCK=NONE',
+    ], sqlite=[
+        'CREATE TABLE IF NOT EXISTS job_logs ('+
+        '   job_id INTEGER PRIMARY KEY,'+
+        '   message BLOB,'+
+        '   size int)',
+        _move_messages_to_job_logs,
+        # rebuilt instead of DROP COLUMN, which needs SQLite 3.35
+        'CREATE TABLE jobs_new ('+
+        '   id INTEGER PRIMARY KEY AUTOINCREMENT,'+
+        '   repo_url varchar(1024),'+
+        '   commit_hash varchar(255),'+
+        '   status varchar(16),'+
+        '   command TEXT,'+
+        '   priority int,'+
+        '   num_gpu int,'+
+        '   required_labels varchar(255),'+
+        '   executor varchar(255),'+
+        '   gpu_ids varchar(255),'+
+        '   host varchar(255),'+
+        '   run_id varchar(255),'+
+        '   created_at DATETIME,'+
+        '   updated_at DATETIME)',
+        'INSERT INTO jobs_new (id, repo_url, commit_hash, status, command, priority, num_gpu, required_labels, executor, gpu_ids, host, run_id,'+
+        '   created_at, updated_at)'+
+        '   SELECT id, repo_url, commit_hash, status, command, priority, num_gpu, required_labels, executor, gpu_ids, host, run_id,'+
+        '   created_at, updated_at FROM jobs',
+        # keep ids of deleted jobs from being reused
+        'UPDATE sqlite_sequence SET seq = (SELECT seq FROM sqlite_sequence WHERE name = \'jobs\') WHERE name = \'jobs_new\'',
+        'DROP TABLE jobs',
+        'ALTER TABLE jobs_new RENAME TO jobs',
+        'CREATE INDEX jobs_status_priority_created ON jobs (status, priority DESC, created_at)',
+        'CREATE INDEX jobs_status_updated ON jobs (status, updated_at)',
+    ]),
+    # columns added to jobs later must be added to jobs_archive too
+    Migration(6, 'add jobs_archive for terminal jobs', mysql=[
+        'CREATE TABLE IF NOT EXISTS jobs_archive LIKE jobs',
+    ], sqlite=[
+        'CREATE TABLE IF NOT EXISTS jobs_archive ('+
+        '   id INTEGER PRIMARY KEY,'+
+        '   repo_url varchar(1024),'+
+        '   commit_hash varchar(255),'+
+        '   status varchar(16),'+
+        '   command TEXT,'+
+        '   priority int,'+
+        '   num_gpu int,'+
+        '   required_labels varchar(255),'+
+        '   executor varchar(255),'+
+        '   gpu_ids varchar(255),'+
+        '   host varchar(255),'+
+        '   run_id varchar(255),'+
+        '   created_at DATETIME,'+
+        '   updated_at DATETIME)',
+        'CREATE INDEX jobs_archive_status_updated ON jobs_archive (status, updated_at)',
+    ]),
+    Migration(7, 'add job_events outbox and subscriber cursors', mysql=[
+        'CREATE TABLE IF NOT EXISTS job_events ('+
+        '   id bigint NOT NULL AUTO_INCREMENT,'+
+        '   job_id int NOT NULL,'+
+        '   status varchar(16),'+
+        '   created_at DATETIME(6),'+
+        '   PRIMARY KEY (id))',
+        'CREATE TABLE IF NOT EXISTS event_cursors ('+
+        '   subscriber varchar(255) NOT NULL,'+
+        '   last_event_id bigint NOT NULL,'+
+        '   updated_at DATETIME(6),'+
+        '   PRIMARY KEY (subscriber))',
+    ], sqlite=[
+        'CREATE TABLE IF NOT EXISTS job_events ('+
+        '   id INTEGER PRIMARY KEY AUTOINCREMENT,'+
+        '   job_id int NOT NULL,'+
+        '   status varchar(16),'+
+        '   created_at DATETIME)',
+        'CREATE TABLE IF NOT EXISTS event_cursors ('+
+        '   subscriber varchar(255) NOT NULL PRIMARY KEY,'+
+        '   last_event_id int NOT NULL,'+
+        '   updated_at DATETIME)',
+    ]),
+    Migration(8, 'add queue version counter and runner wakeup addresses', mysql=[
+        'CREATE TABLE IF NOT EXISTS queue_state ('+
+        '   id int NOT NULL,'+
+        '   version bigint NOT NULL,'+
+        '   PRIMARY KEY (id))',
+        'INSERT INTO queue_state (id, version) VALUES (1, 0)',
+        'ALTER TABLE runners ADD COLUMN wakeup_address varchar(255) NOT NULL DEFAULT \'\'',
+    ], sqlite=[
+        'CREATE TABLE IF NOT EXISTS queue_state ('+
+        '   id INTEGER PRIMARY KEY,'+
+        '   version int NOT NULL)',
+        'INSERT INTO queue_state (id, version) VALUES (1, 0)',
+        'ALTER TABLE runners ADD COLUMN wakeup_address varchar(255) NOT NULL DEFAULT \'\'',
+    ]),
+    Migration(9, 'add job start time and declared runtime for backfill scheduling', mysql=[
+        'ALTER TABLE jobs'+
+        '   ADD COLUMN expected_runtime_s int NOT NULL DEFAULT 0,'+
+        '   ADD COLUMN started_at DATETIME(6) NULL,'+
+        '   ADD INDEX jobs_status_created (status, created_at),'+
+        '   ALGORITHM=INPLACE, LOCK=NONE',
+        'ALTER TABLE jobs_archive'+
+        '   ADD COLUMN expected_runtime_s int NOT NULL DEFAULT 0,'+
+        '   ADD COLUMN started_at DATETIME(6) NULL',
+    ], sqlite=[
+        'ALTER TABLE jobs ADD COLUMN expected_runtime_s int NOT NULL DEFAULT 0',
+        'ALTER TABLE jobs ADD COLUMN started_at DATETIME',
+        'CREATE INDEX jobs_status_created ON jobs (status, created_at)',
+        'ALTER TABLE jobs_archive ADD COLUMN expected_runtime_s int NOT NULL DEFAULT 0',
+        'ALTER TABLE jobs_archive ADD COLUMN started_at DATETIME',
+    ]),
+    Migration(10, 'add per-GPU memory requests for shared GPUs', mysql=[
+        'ALTER TABLE jobs ADD COLUMN gpu_memory_mb int NOT NULL DEFAULT 0, ALGORITHM=INPLACE, LOCK=NONE',
+        'ALTER TABLE jobs_archive ADD COLUMN gpu_memory_mb int NOT NULL DEFAULT 0',
+    ], sqlite=[
+        'ALTER TABLE jobs ADD COLUMN gpu_memory_mb int NOT NULL DEFAULT 0',
+        'ALTER TABLE jobs_archive ADD COLUMN gpu_memory_mb int NOT NULL DEFAULT 0',
+    ]),
+    Migration(11, 'add preemptible flag', mysql=[
+        'ALTER TABLE jobs ADD COLUMN preemptible tinyint NOT NULL DEFAULT 0, ALGORITHM=INPLACE, LOCK=NONE',
+        'ALTER TABLE jobs_archive ADD COLUMN preemptible tinyint NOT NULL DEFAULT 0',
+    ], sqlite=[
+        'ALTER TABLE jobs ADD COLUMN preemptible int NOT NULL DEFAULT 0',
+        'ALTER TABLE jobs_archive ADD COLUMN preemptible int NOT NULL DEFAULT 0',
+    ]),
+    # every queue scan filters on assigned_runner (NULL: unassigned), so jobs_assigned_runner supersedes jobs_status_priority_created
+    Migration(12, 'add dispatcher assignments and runner capacity', mysql=[
+        'ALTER TABLE jobs'+
+        '   ADD COLUMN assigned_runner int NULL,'+
+        '   ADD INDEX jobs_assigned_runner (assigned_runner, status, priority DESC, created_at),'+
+        '   DROP INDEX jobs_status_priority_created,'+
+        '   ALGORITHM=INPLACE, LOCK=NONE',
+        'ALTER TABLE jobs_archive ADD COLUMN assigned_runner int NULL',
+        'ALTER TABLE runners ADD COLUMN dispatch tinyint NOT NULL DEFAULT 0, ADD COLUMN free_gpus int NOT NULL DEFAULT 0',
+    ], sqlite=[
+        'ALTER TABLE jobs ADD COLUMN assigned_runner int NULL',
+        'CREATE INDEX jobs_assigned_runner ON jobs (assigned_runner, status, priority DESC, created_at)',
+        'DROP INDEX jobs_status_priority_created',
+        'ALTER TABLE jobs_archive ADD COLUMN assigned_runner int NULL',
+        'ALTER TABLE runners ADD COLUMN dispatch int NOT NULL DEFAULT 0',
+        'ALTER TABLE runners ADD COLUMN free_gpus int NOT NULL DEFAULT 0',
+    ]),
+    Migration(13, 'add job arrays', mysql=[
+        'ALTER TABLE jobs'+
+        '   ADD COLUMN array_size int NOT NULL DEFAULT 0,'+
+        '   ADD COLUMN array_next int NOT NULL DEFAULT 0,'+
+        '   ADD COLUMN array_parent int NULL,'+
+        '   ADD COLUMN array_index int NULL,'+
+        '   ADD INDEX jobs_array_parent (array_parent),'+
+        '   ALGORITHM=INPLACE, LOCK=NONE',
+        'ALTER TABLE jobs_archive'+
+        '   ADD COLUMN array_size int NOT NULL DEFAULT 0,'+
+        '   ADD COLUMN array_next int NOT NULL DEFAULT 0,'+
+        '   ADD COLUMN array_parent int NULL,'+
+        '   ADD COLUMN array_index int NULL',
+        'CREATE TABLE IF NOT EXISTS job_array_params ('+
+        '   job_id int NOT NULL,'+
+        '   array_index int NOT NULL,'+
+        '   params LONGTEXT,'+
+        '   PRIMARY KEY (job_id, array_index))',
+    ], sqlite=[
+        'ALTER TABLE jobs ADD COLUMN array_size int NOT NULL DEFAULT 0',
+        'ALTER TABLE jobs ADD COLUMN array_next int NOT NULL DEFAULT 0',
+        'ALTER TABLE jobs ADD COLUMN array_parent int NULL',
+        'ALTER TABLE jobs ADD COLUMN array_index int NULL',
+        'CREATE INDEX jobs_array_parent ON jobs (array_parent)',
+        'ALTER TABLE jobs_archive ADD COLUMN array_size int NOT NULL DEFAULT 0',
+        'ALTER TABLE jobs_archive ADD COLUMN array_next int NOT NULL DEFAULT 0',
+        'ALTER TABLE jobs_archive ADD COLUMN array_parent int NULL',
+        'ALTER TABLE jobs_archive ADD COLUMN array_index int NULL',
+        'CREATE TABLE IF NOT EXISTS job_array_params ('+
+        '   job_id int NOT NULL,'+
+        '   array_index int NOT NULL,'+
+        '   params TEXT,'+
+        '   PRIMARY KEY (job_id, array_index))',
+    ]),
+    # edges are deleted once their parent has ended, so the table only holds what waiting jobs wait for
+    Migration(14, 'add job dependencies', mysql=[
+        'ALTER TABLE jobs'+
+        '   ADD COLUMN after_ok varchar(4096) NOT NULL DEFAULT \'\','+
+        '   ADD COLUMN after_any varchar(4096) NOT NULL DEFAULT \'\','+
+        '   ADD COLUMN unmet_dependencies int NOT NULL DEFAULT 0,'+
+        '   ALGORITHM=INPLACE, LOCK=NONE',
+        'ALTER TABLE jobs_archive'+
+        '   ADD COLUMN after_ok varchar(4096) NOT NULL DEFAULT \'\','+
+        '   ADD COLUMN after_any varchar(4096) NOT NULL DEFAULT \'\','+
+        '   ADD COLUMN unmet_dependencies int NOT NULL DEFAULT 0',
+        'CREATE TABLE IF NOT EXISTS job_dependencies ('+
+        '   job_id int NOT NULL,'+
+        '   parent_id int NOT NULL,'+
+        '   kind varchar(16) NOT NULL,'+
+        '   PRIMARY KEY (job_id, parent_id),'+
+        '   INDEX job_dependencies_parent (parent_id))',
+    ], sqlite=[
+        'ALTER TABLE jobs ADD COLUMN after_ok varchar(4096) NOT NULL DEFAULT \'\'',
+        'ALTER TABLE jobs ADD COLUMN after_any varchar(4096) NOT NULL DEFAULT \'\'',
+        'ALTER TABLE jobs ADD COLUMN unmet_dependencies int NOT NULL DEFAULT 0',
+        'ALTER TABLE jobs_archive ADD COLUMN after_ok varchar(4096) NOT NULL DEFAULT \'\'',
+        'ALTER TABLE jobs_archive ADD COLUMN after_any varchar(4096) NOT NULL DEFAULT \'\'',
+        'ALTER TABLE jobs_archive ADD COLUMN unmet_dependencies int NOT NULL DEFAULT 0',
+        'CREATE TABLE IF NOT EXISTS job_dependencies ('+
+        '   job_id int NOT NULL,'+
+        '   parent_id int NOT NULL,'+
+        '   kind varchar(16) NOT NULL,'+
+        '   PRIMARY KEY (job_id, parent_id))',
+        'CREATE INDEX job_dependencies_parent ON job_dependencies (parent_id)',
+    ]),
+    Migration(15, 'add GPU utilization summaries', mysql=[
+        'ALTER TABLE jobs'+
+        '   ADD COLUMN gpu_samples int NOT NULL DEFAULT 0,'+
+        '   ADD COLUMN gpu_util_mean float NOT NULL DEFAULT 0,'+
+        '   ADD COLUMN gpu_util_p95 float NOT NULL DEFAULT 0,'+
+        '   ADD COLUMN gpu_memory_peak_mb int NOT NULL DEFAULT 0,'+
+        '   ADD COLUMN gpu_idle tinyint NOT NULL DEFAULT 0,'+
+        '   ALGORITHM=INPLACE, LOCK=NONE',
+        'ALTER TABLE jobs_archive'+
+        '   ADD COLUMN gpu_samples int NOT NULL DEFAULT 0,'+
+        '   ADD COLUMN gpu_util_mean float NOT NULL DEFAULT 0,'+
+        '   ADD COLUMN gpu_util_p95 float NOT NULL DEFAULT 0,'+
+        '   ADD COLUMN gpu_memory_peak_mb int NOT NULL DEFAULT 0,'+
+        '   ADD COLUMN gpu_idle tinyint NOT NULL DEFAULT 0',
+    ], sqlite=[
+        'ALTER TABLE jobs ADD COLUMN gpu_samples int NOT NULL DEFAULT 0',
+        'ALTER TABLE jobs ADD COLUMN gpu_util_mean float NOT NULL DEFAULT 0',
+        'ALTER TABLE jobs ADD COLUMN gpu_util_p95 float NOT NULL DEFAULT 0',
+        'ALTER TABLE jobs ADD COLUMN gpu_memory_peak_mb int NOT NULL DEFAULT 0',
+        'ALTER TABLE jobs ADD COLUMN gpu_idle int NOT NULL DEFAULT 0',
+        'ALTER TABLE jobs_archive ADD COLUMN gpu_samples int NOT NULL DEFAULT 0',
+        'ALTER TABLE jobs_archive ADD COLUMN gpu_util_mean float NOT NULL DEFAULT 0',
+        'ALTER TABLE jobs_archive ADD COLUMN gpu_util_p95 float NOT NULL DEFAULT 0',
+        'ALTER TABLE jobs_archive ADD COLUMN gpu_memory_peak_mb int NOT NULL DEFAULT 0',
+        'ALTER TABLE jobs_archive ADD COLUMN gpu_idle int NOT NULL DEFAULT 0',
+    ]),
+    # one row per phase of each run of a job, see timing.PHASES
+    Migration(16, 'add job phase timings', mysql=[
+        'CREATE TABLE IF NOT EXISTS job_phases ('+
+        '   id bigint NOT NULL AUTO_INCREMENT,'+
+        '   job_id int NOT NULL,'+
+        '   phase varchar(32) NOT NULL,'+
+        '   started_at DATETIME(6) NOT NULL,'+
+        '   duration_s double NOT NULL,'+
+        '   PRIMARY KEY (id),'+
+        '   INDEX job_phases_job (job_id),'+
+        '   INDEX job_phases_started (started_at))',
+    ], sqlite=[
+        'CREATE TABLE IF NOT EXISTS job_phases ('+
+        '   id INTEGER PRIMARY KEY AUTOINCREMENT,'+
+        '   job_id int NOT NULL,'+
+        '   phase varchar(32) NOT NULL,'+
+        '   started_at DATETIME(6) NOT NULL,'+
+        '   duration_s double NOT NULL)',
+        'CREATE INDEX job_phases_job ON job_phases (job_id)',
+        'CREATE INDEX job_phases_started ON job_phases (started_at)',
+    ]),
+    # queue wait of requeued jobs counts from their last requeue, not from their creation
+    Migration(17, 'add the time jobs were last queued', mysql=[
+        'ALTER TABLE jobs ADD COLUMN queued_at DATETIME(6) NULL, ALGORITHM=INPLACE, LOCK=NONE',
+        'ALTER TABLE jobs_archive ADD COLUMN queued_at DATETIME(6) NULL',
+    ], sqlite=[
+        'ALTER TABLE jobs ADD COLUMN queued_at DATETIME',
+        'ALTER TABLE jobs_archive ADD COLUMN queued_at DATETIME',
+    ]),
+]
+# yapf: enable
+
+
+class Migrator():
+    ''' Apply the backend's steps of `MIGRATIONS` in order and record them in `schema_migrations` '''
+    def __init__(self, db: Backend, migrations: Sequence[Migration] = MIGRATIONS):
+        self.db = db
+        self.migrations = sorted(migrations, key=lambda m: m.version)
+
+    def current_version(self) -> int:
+        with self.db.cursor() as cur:
+            return self._current_version(cur)
+
+    def pending(self) -> List[Migration]:
+        version = self.current_version()
+        return [m for m in self.migrations if m.version > version]
+
+    def upgrade(self, target: Optional[int] = None) -> List[Migration]:
+        applied = []
+        # runners may start at the same time; only one of them migrates
+        with self.db.migration_cursor() as cur:
+            version = self._current_version(cur)
+            for migration in self.migrations:
+                if migration.version <= version or (target is not None and migration.version > target):
+                    continue
+                for step in getattr(migration, self.db.name):
+                    if callable(step):
+                        step(cur)
+                    else:
+                        cur.execute(step)
+                cur.execute('INSERT INTO schema_migrations (version, description, applied_at) VALUES (%s, %s, %s)',
+                            (migration.version, migration.description, datetime.datetime.now()))
+                applied.append(migration)
+        return applied
+
+    def _current_version(self, cur) -> int:
+        # yapf: disable
+        cur.execute(
+            'CREATE TABLE IF NOT EXISTS schema_migrations ('+
+            '   version int NOT NULL,'+
+            '   description varchar(255),'+
+            '   applied_at DATETIME(6),'+
+            '   PRIMARY KEY (version))'
+        )
+        # yapf: enable
+        cur.execute('SELECT MAX(version) AS version FROM schema_migrations')
+        return cur.fetchone()['version'] or 0
+
+
+# statuses a job never leaves; such jobs are moved to jobs_archive after a while
+TERMINAL_STATUSES = [JobStatus.Finish.value, JobStatus.Fail.value, JobStatus.Cancel.value, JobStatus.Expanded.value]
+# columns of the jobs table, `Job.message` is stored compressed in job_logs
+JOB_COLUMNS = [field for field in Job._fields if field != 'message']
+# what a runner needs to start a claimed job
+CLAIM_COLUMNS = [
+    'id', 'repo_url', 'commit_hash', 'status', 'command', 'priority', 'num_gpu', 'gpu_memory_mb', 'required_labels', 'executor', 'expected_runtime_s',
+    'preemptible', 'array_size', 'array_next', 'gpu_idle', 'queued_at', 'created_at'
+]
+# pop_next_job reads the best ranked and the oldest queued jobs, the scheduler policy ages the latter up
+CANDIDATE_ORDERS = {
+    'priority': ('priority DESC, created_at ASC', 'jobs_assigned_runner'),
+    'oldest': ('created_at ASC', 'jobs_status_created'),
+}
+MAX_GPU = 2**31 - 1
+# Job fields listing the parents of a job, kept as edges in job_dependencies
+DEPENDENCY_KINDS = ['after_ok', 'after_any']
+# statuses that release dependents; after_ok dependents only wait for Finish
+DEPENDENCY_DONE_STATUSES = [JobStatus.Finish.value, JobStatus.Fail.value, JobStatus.Cancel.value]
+FAILED_DEPENDENCY_STATUSES = [JobStatus.Fail.value, JobStatus.Cancel.value]
+
+
+# Queries on the runner/watcher hot path and the index each one must use (see `explain_hot_queries`)
+def next_job_query(max_gpu: int, labels: Sequence[str], order: str = 'priority', limit: int = 1, assigned_runner: Optional[int] = None):
+    '''
+    (sql, params) selecting up to `limit` queued jobs in `CANDIDATE_ORDERS[order]` that need at most `max_gpu` GPUs
+    and whose required labels are all in `labels`. Which of them to start is up to `scheduler.Policy`.
+    Jobs the dispatcher assigned are only selected for their `assigned_runner`.
+    '''
+    labels = sorted(set(labels))
+    label_filter = ' AND job_labels.label NOT IN (' + ', '.join(['%s'] * len(labels)) + ')' if len(labels) > 0 else ''
+    # yapf: disable
+    sql = (
+        'SELECT ' + ', '.join(CLAIM_COLUMNS) + ' FROM jobs WHERE status = %s AND num_gpu <= %s'+
+        ('   AND assigned_runner IS NULL' if assigned_runner is None else '   AND assigned_runner = %s')+
+        '   AND NOT EXISTS (SELECT 1 FROM job_labels WHERE job_labels.job_id = jobs.id' + label_filter + ')'+
+        ' ORDER BY ' + CANDIDATE_ORDERS[order][0] + ' LIMIT %s'
+    )
+    # yapf: enable
+    return sql, [JobStatus.Queue.value, max_gpu] + ([] if assigned_runner is None else [assigned_runner]) + labels + [limit]
+
+
+SQL_FAILED_JOBS_SINCE = ('SELECT id, host, command FROM jobs WHERE status = %s AND updated_at > %s'
+                         ' UNION ALL SELECT id, host, command FROM jobs_archive WHERE status = %s AND updated_at > %s')
+SQL_FINISHED_JOBS_SINCE = ('SELECT id, repo_url, command, num_gpu, started_at, updated_at FROM jobs WHERE status = %s AND updated_at > %s'
+                           ' UNION ALL SELECT id, repo_url, command, num_gpu, started_at, updated_at FROM jobs_archive'
+                           ' WHERE status = %s AND updated_at > %s')
+SQL_EVENTS_AFTER = 'SELECT id, job_id, status, created_at FROM job_events WHERE id > %s ORDER BY id LIMIT %s'
+HOT_QUERIES = {
+    **{'pop_next_job ({})'.format(order): (*next_job_query(1, ['label'], order, 20), index)
+       for order, (_, index) in CANDIDATE_ORDERS.items()},
+    'pop_next_job (assigned)': (*next_job_query(1, ['label'], 'priority', 20, assigned_runner=1), CANDIDATE_ORDERS['priority'][1]),
+    'get_failed_jobs_since': (SQL_FAILED_JOBS_SINCE, (JobStatus.Fail.value, datetime.datetime(1970, 1, 1)) * 2, 'jobs_status_updated'),
+    'RuntimeEstimator.refresh': (SQL_FINISHED_JOBS_SINCE, (JobStatus.Finish.value, datetime.datetime(1970, 1, 1)) * 2, 'jobs_status_updated'),
+    'EventSubscriber.poll': (SQL_EVENTS_AFTER, (0, 100), 'PRIMARY'),
+}
+
+
+def explain_hot_queries(db: Backend) -> List[dict]:
+    ''' EXPLAIN each of `HOT_QUERIES` and report whether the database picks the expected index '''
+    results = []
+    with db.cursor() as cur:
+        for name, (sql, params, index) in HOT_QUERIES.items():
+            key, extra = db.explain(cur, sql, params)
+            results.append(dict(name=name, expected=index, key=key, ok=key == index, extra=extra))
+    return results
 
 
 class JobRepository():
-    def __init__(self, db: Connection, tz=datetime.timezone(datetime.timedelta(hours=9), 'JST')):
+    def __init__(self,
+                 db: Backend,
+                 tz=datetime.timezone(datetime.timedelta(hours=9), 'JST'),
+                 max_message_bytes: int = DEFAULT_MAX_MESSAGE_BYTES,
+                 policy: Optional[Policy] = None,
+                 candidates: int = 20):
         self.db = db
         self.tz = tz
+        self.max_message_bytes = max_message_bytes
+        self.policy = policy or Policy()
+        self.candidates = candidates
         self.create_table()
 
     def create_table(self):
-        with db_lock, self.db.cursor() as cur:
-            # yapf: disable
-            cur.execute(
-                'CREATE TABLE IF NOT EXISTS jobs ('+
-                '   id int NOT NULL AUTO_INCREMENT,'+
-                '   repo_url varchar(1024),'+
-                '   commit_hash varchar(255),'+
-                '   status varchar(16),'+
-                '   command LONGTEXT,'+
-                '   message LONGTEXT,'+
-                '   priority int,'+
-                '   num_gpu int,'+
-                '   required_labels varchar(255),'+
-                '   executor varchar(255),'+
-                '   gpu_ids varchar(255),'+
-                '   host varchar(255),'+
-                '   run_id varchar(255),'+
-                '   created_at varchar(64),'+
-                '   updated_at varchar(64),'+
-                '   PRIMARY KEY (id))'
-            )
-            # yapf: enable
-
-    def create(self, job: Job):
-        with db_lock:
-            job_dict = job._asdict()
-            job_dict['created_at'] = datetime.datetime.now(tz=self.tz).isoformat()
-            job_dict['updated_at'] = datetime.datetime.now(tz=self.tz).isoformat()
-            del job_dict['id']
-            sql = 'INSERT INTO jobs(' + ', '.join(list(job_dict.keys())) + ') VALUES (' + ', '.join(['%s'] * len(job_dict.keys())) + ')'
-            with self.db.cursor() as cur:
-                cur.execute(sql, list(job_dict.values()))
-                cur.execute('SELECT * from jobs WHERE id = LAST_INSERT_ID() LIMIT 1')
-                result = cur.fetchone()
-            return Job(**result)
+        Migrator(self.db).upgrade()
+
+    def create(self, job: Job) -> Job:
+        return self.create_many([job])[0]
+
+    def create_many(self, jobs: Sequence[Job], chunk_size: int = 500) -> List[Job]:
+        ''' Insert `jobs` in one transaction and return them with their ids (multi-row INSERTs where the backend can map them to ids) '''
+        chunk_size = min(chunk_size, self.db.max_query_params // len(JOB_COLUMNS))
+        timestamp = now(self.tz)
+        created = []
+        # label rows must exist before any runner can see the jobs
+        with self.db.transaction() as cur:
+            for begin in range(0, len(jobs), chunk_size):
+                created += self._insert(cur, [job._replace(created_at=timestamp, updated_at=timestamp) for job in jobs[begin:begin + chunk_size]])
+            if any(JobStatus(job.status) == JobStatus.Queue for job in created):
+                self._bump_queue_version(cur)
+        return created
+
+    def create_array(self, job: Job, params: Sequence[dict] = (), size: Optional[int] = None, chunk_size: int = 1000) -> Job:
+        '''
+        Queue one array job of `size` (default: `len(params)`) tasks. Task i runs `job.command` with `{index}` and
+        the keys of `params[i]` replaced; tasks are created one by one as runners claim them.
+        '''
+        size = len(params) if size is None else size
+        with self.db.transaction() as cur:
+            timestamp = now(self.tz)
+            job = self._insert(cur, [job._replace(array_size=size, array_next=0, created_at=timestamp, updated_at=timestamp)])[0]
+            for begin in range(0, len(params), chunk_size):
+                cur.executemany('INSERT INTO job_array_params (job_id, array_index, params) VALUES (%s, %s, %s)',
+                                [(job.id, index, json.dumps(params[index])) for index in range(begin, min(begin + chunk_size, len(params)))])
+            if JobStatus(job.status) == JobStatus.Queue:
+                self._bump_queue_version(cur)
+        return job
+
+    def _insert(self, cur, jobs: Sequence[Job]) -> List[Job]:
+        ''' INSERT `jobs` with their labels, dependencies, messages and events. Returns them with their ids. '''
+        jobs, dependencies = self._resolve_dependencies(cur, jobs)
+        jobs = [job._replace(queued_at=job.created_at) if JobStatus(job.status) == JobStatus.Queue and job.queued_at is None else job for job in jobs]
+        keys = [key for key in JOB_COLUMNS if key != 'id']
+        ids = self.db.insert_rows(cur, 'jobs', keys, [[getattr(job, key) for key in keys] for job in jobs])
+        jobs = [job._replace(id=id) for id, job in zip(ids, jobs)]
+        labels = [(job.id, label) for job in jobs for label in split_labels(job.required_labels)]
+        if len(labels) > 0:
+            cur.executemany('INSERT INTO job_labels (job_id, label) VALUES (%s, %s)', labels)
+        edges = [(job.id, parent_id, kind) for job, waits_for in zip(jobs, dependencies) for parent_id, kind in waits_for]
+        if len(edges) > 0:
+            cur.executemany('INSERT INTO job_dependencies (job_id, parent_id, kind) VALUES (%s, %s, %s)', edges)
+        messages = [(job.id, *compress_message(job.message, self.max_message_bytes)) for job in jobs if job.message]
+        if len(messages) > 0:
+            cur.executemany('INSERT INTO job_logs (job_id, message, size) VALUES (%s, %s, %s)', messages)
+        self._add_events(cur, [(job.id, job.status) for job in jobs])
+        return jobs
+
+    def _resolve_dependencies(self, cur, jobs: Sequence[Job]) -> Tuple[List[Job], List[List[Tuple[int, str]]]]:
+        '''
+        Queued `jobs` whose parents have not all ended Wait for them, and those with a failed or canceled after_ok parent are canceled.
+        Returns the jobs with their status set and the (parent id, kind) each one waits for.
+        Parent rows stay locked until the edges are committed, so a parent can't end in between without seeing them.
+        '''
+        dependencies = []
+        for job in jobs:
+            kinds = {}
+            if JobStatus(job.status) == JobStatus.Queue:
+                for kind in reversed(DEPENDENCY_KINDS):  # after_ok wins for parents listed twice
+                    kinds.update((parent_id, kind) for parent_id in split_job_ids(getattr(job, kind)))
+            dependencies.append(sorted(kinds.items()))
+        parent_ids = sorted(set(parent_id for edges in dependencies for parent_id, _ in edges))
+        if len(parent_ids) == 0:
+            return list(jobs), dependencies
+        placeholders = ', '.join(['%s'] * len(parent_ids))
+        cur.execute('SELECT id, status, array_size FROM jobs_archive WHERE id IN (' + placeholders + ')', parent_ids)
+        parents = {row['id']: row for row in cur.fetchall()}
+        cur.execute('SELECT id, status, array_size FROM jobs WHERE id IN (' + placeholders + ')' + self.db.for_update, parent_ids)
+        parents.update((row['id'], row) for row in cur.fetchall())
+        resolved, waits_for = [], []
+        for job, edges in zip(jobs, dependencies):
+            for parent_id, _ in edges:
+                if parent_id not in parents:
+                    raise ValueError('job {} does not exist'.format(parent_id))
+                if parents[parent_id]['array_size']:
+                    raise ValueError('job {} is an array job, which can not be depended on'.format(parent_id))
+            failed = [parent_id for parent_id, kind in edges if kind == 'after_ok' and parents[parent_id]['status'] in FAILED_DEPENDENCY_STATUSES]
+            waiting = [(parent_id, kind) for parent_id, kind in edges if parents[parent_id]['status'] not in DEPENDENCY_DONE_STATUSES]
+            if len(failed) > 0:
+                job = job._replace(status=JobStatus.Cancel.value, message=dependency_failed_message(failed[0], parents[failed[0]]['status']))
+                waiting = []
+            elif len(waiting) > 0:
+                job = job._replace(status=JobStatus.Wait.value, unmet_dependencies=len(waiting))
+            resolved.append(job)
+            waits_for.append(waiting)
+        return resolved, waits_for
+
+    def _release_dependents(self, cur, parent_id: int, status: JobStatus):
+        ''' `parent_id` ended with `status`: queue the jobs it was the last unmet dependency of, cancel after_ok ones if it failed '''
+        cur.execute('SELECT job_id, kind FROM job_dependencies WHERE parent_id = %s' + self.db.for_update, parent_id)
+        edges = cur.fetchall()
+        if len(edges) == 0:
+            return
+        cur.execute('DELETE FROM job_dependencies WHERE parent_id = %s', parent_id)
+        for edge in edges:
+            # the child's row lock serializes its parents ending at the same time
+            params = (edge['job_id'], JobStatus.Wait.value)
+            cur.execute('UPDATE jobs SET unmet_dependencies = unmet_dependencies - 1 WHERE id = %s AND status = %s', params)
+            cur.execute('SELECT unmet_dependencies FROM jobs WHERE id = %s AND status = %s' + self.db.for_update, params)
+            row = cur.fetchone()
+            if row is None:
+                continue  # already canceled
+            if edge['kind'] == 'after_ok' and status != JobStatus.Finish:
+                # cascades to its own dependents
+                self._update(cur, edge['job_id'], status=JobStatus.Cancel, message=dependency_failed_message(parent_id, status.value))
+            elif row['unmet_dependencies'] <= 0:
+                self._update(cur, edge['job_id'], status=JobStatus.Queue)
 
     def update(self, id: int, **kwargs):
-        with db_lock:
-            self._update(id, **kwargs)
-        return self.get(id)
+        # a status change, its event and the release of its dependents are committed together
+        with self.db.transaction() as cur:
+            self._update(cur, id, **kwargs)
+            return self._get(cur, id)
 
     def update_timestamp(self, id: int):
-        with db_lock:
-            self._update(id, updated_at=datetime.datetime.now(tz=self.tz).isoformat())
-        return self.get(id)
+        with self.db.cursor() as cur:
+            self._update(cur, id, updated_at=now(self.tz))
+            return self._get(cur, id)
 
-    def _update(self, id: int, **kwargs):
+    def heartbeat(self, ids: Sequence[int]) -> Dict[int, str]:
+        ''' Touch `updated_at` of all `ids` and return their current status. Deleted jobs are missing from the result. '''
+        if len(ids) == 0:
+            return {}
+        placeholders = ', '.join(['%s'] * len(ids))
+        with self.db.cursor() as cur:
+            cur.execute('UPDATE jobs SET updated_at = %s WHERE id IN (' + placeholders + ')', [now(self.tz)] + list(ids))
+            cur.execute('SELECT id, status FROM jobs WHERE id IN (' + placeholders + ')', list(ids))
+            rows = cur.fetchall()
+        return {row['id']: row['status'] for row in rows}
+
+    def _update(self, cur, id: int, **kwargs):
         default_job = Job()
         job = dict()
         for key, value in kwargs.items():
             if hasattr(default_job, key) and type(value) == type(getattr(default_job, key)):
                 job[key] = value
-        job['updated_at'] = datetime.datetime.now(tz=self.tz).isoformat()
+        if 'message' in job:
+            self._set_message(cur, id, job.pop('message'))
+        job['updated_at'] = now(self.tz)
+        if 'status' in job and JobStatus(job['status']) == JobStatus.Queue:
+            # requeued jobs (preempted, idle, resumed) are dispatched again instead of waiting for the runner that stopped them.
+            # started_at is set again by the next claim
+            job.update(assigned_runner=None, queued_at=job['updated_at'], started_at=None)
         sql = 'UPDATE jobs set ' + ', '.join([key + '= %s' for key in job.keys()]) + ' WHERE id = %s'
+        cur.execute(sql, list(job.values()) + [id])
+        if 'required_labels' in job:
+            self._set_labels(cur, id, job['required_labels'])
+        if 'status' in job:
+            self._add_events(cur, [(id, job['status'])])
+            status = JobStatus(job['status'])
+            if status == JobStatus.Queue:
+                self._bump_queue_version(cur)
+            if status.value in DEPENDENCY_DONE_STATUSES:
+                self._release_dependents(cur, id, status)
+
+    def _bump_queue_version(self, cur):
+        # only enqueue / requeue bump it; claims don't, so pushes never contend with runners on this row
+        cur.execute('UPDATE queue_state SET version = version + 1 WHERE id = 1')
+
+    def queue_version(self) -> int:
+        ''' changes whenever jobs are queued. An idle runner compares it to skip claiming when nothing was queued. '''
         with self.db.cursor() as cur:
-            cur.execute(sql, list(job.values()) + [id])
+            cur.execute('SELECT version FROM queue_state WHERE id = 1')
+            return cur.fetchone()['version']
 
-    def get(self, id: int) -> Optional[Job]:
-        with db_lock:
-            with self.db.cursor() as cur:
-                cur.execute('SELECT * from jobs WHERE id = %s LIMIT 1', id)
+    def _add_events(self, cur, events: Sequence[Tuple[int, JobStatus]]):
+        ''' append (job id, new status) to the job_events outbox, in the caller's transaction '''
+        timestamp = now(self.tz)
+        cur.executemany('INSERT INTO job_events (job_id, status, created_at) VALUES (%s, %s, %s)',
+                        [(id, JobStatus(status).value, timestamp) for id, status in events])
+
+    def _set_labels(self, cur, id: int, required_labels: str):
+        cur.execute('DELETE FROM job_labels WHERE job_id = %s', id)
+        labels = split_labels(required_labels)
+        if len(labels) > 0:
+            cur.executemany('INSERT INTO job_labels (job_id, label) VALUES (%s, %s)', [(id, label) for label in labels])
+
+    def _set_message(self, cur, id: int, message: str):
+        cur.execute('DELETE FROM job_logs WHERE job_id = %s', id)
+        if len(message) > 0:
+            cur.execute('INSERT INTO job_logs (job_id, message, size) VALUES (%s, %s, %s)', (id, *compress_message(message, self.max_message_bytes)))
+
+    def get(self, id: int, with_message: bool = False) -> Optional[Job]:
+        with self.db.cursor() as cur:
+            job = self._get(cur, id)
+            if with_message:
+                job = job._replace(message=self._get_messages(cur, [id]).get(id, ''))
+        return job
+
+    def _get(self, cur, id: int) -> Optional[Job]:
+        cur.execute('SELECT ' + ', '.join(JOB_COLUMNS) + ' from jobs WHERE id = %s LIMIT 1', id)
+        row = cur.fetchone()
+        if row is None:
+            cur.execute('SELECT ' + ', '.join(JOB_COLUMNS) + ' from jobs_archive WHERE id = %s LIMIT 1', id)
+            row = cur.fetchone()
+        return Job.from_row(row)
+
+    def get_many(self, ids: Sequence[int], with_message: bool = False) -> List[Job]:
+        if len(ids) == 0:
+            return []
+        columns = ', '.join(JOB_COLUMNS)
+        placeholders = ', '.join(['%s'] * len(ids))
+        with self.db.cursor() as cur:
+            cur.execute(
+                'SELECT ' + columns + ' FROM jobs WHERE id IN (' + placeholders + ')' + ' UNION ALL SELECT ' + columns +
+                ' FROM jobs_archive WHERE id IN (' + placeholders + ')',
+                list(ids) * 2)
+            jobs = [Job.from_row(row) for row in cur.fetchall()]
+            if with_message:
+                messages = self._get_messages(cur, ids)
+                jobs = [job._replace(message=messages.get(job.id, '')) for job in jobs]
+        return jobs
+
+    def prune_events(self, older_than: datetime.timedelta) -> int:
+        ''' delete events older than `older_than` that every subscriber has consumed '''
+        with self.db.cursor() as cur:
+            cur.execute('SELECT MIN(last_event_id) AS last_event_id FROM event_cursors')
+            consumed = cur.fetchone()['last_event_id'] or 0
+            cur.execute('DELETE FROM job_events WHERE id <= %s AND created_at < %s', (consumed, now(self.tz) - older_than))
+            return cur.rowcount
+
+    def get_messages(self, ids: Sequence[int]) -> Dict[int, str]:
+        with self.db.cursor() as cur:
+            return self._get_messages(cur, ids)
+
+    def _get_messages(self, cur, ids: Sequence[int]) -> Dict[int, str]:
+        if len(ids) == 0:
+            return {}
+        cur.execute('SELECT job_id, message FROM job_logs WHERE job_id IN (' + ', '.join(['%s'] * len(ids)) + ')', list(ids))
+        return {row['job_id']: decompress_message(row['message']) for row in cur.fetchall()}
+
+    def pop_next_job(self,
+                     max_gpu_available: int,
+                     labels: Sequence[str] = [],
+                     total_gpus: Optional[int] = None,
+                     running: Sequence[Job] = (),
+                     free_memory_mb: Sequence[int] = (),
+                     assigned_runner: Optional[int] = None) -> Optional[Job]:
+        '''
+        Claim the job `self.policy` picks for a runner with `max_gpu_available` free of `total_gpus` GPUs, running `running`.
+        `free_memory_mb` lists the unreserved memory of GPUs that jobs with `gpu_memory_mb` may share.
+        With `assigned_runner`, only jobs the dispatcher assigned to that runner are claimed.
+        Candidates are read without locks; only the chosen one is locked, and if another runner holds it the next best is tried.
+        '''
+        candidates = {}
+        with self.db.cursor() as cur:
+            for order in CANDIDATE_ORDERS:
+                sql, params = next_job_query(MAX_GPU if total_gpus is None else total_gpus, labels, order, self.candidates, assigned_runner)
+                cur.execute(sql, params)
+                candidates.update((row['id'], Job.from_row(row)) for row in cur.fetchall())
+        with self.db.transaction() as cur:
+            while True:
+                started_at = now(self.tz)
+                job = self.policy.select(list(candidates.values()), max_gpu_available, started_at, total_gpus, running, free_memory_mb)
+                if job is None:
+                    return None
+                # the full row, read with the lock so it is current (array_next of arrays)
+                cur.execute('SELECT ' + ', '.join(JOB_COLUMNS) + ' FROM jobs WHERE id = %s AND status = %s AND ' +
+                            ('assigned_runner IS NULL' if assigned_runner is None else 'assigned_runner = %s') + self.db.skip_locked,
+                            [job.id, JobStatus.Queue.value] + ([] if assigned_runner is None else [assigned_runner]))
                 row = cur.fetchone()
-            return Job(**row)
-
-    def pop_next_job(self, max_gpu_available: int, labels: Sequence[str] = []):
-        with db_lock:
-            labels = set(labels)
-            found = False
-            self.db.begin()
-            try:
-                with self.db.cursor() as cur:
-                    sql = 'SELECT * FROM jobs WHERE status = %s ORDER BY priority DESC, num_gpu DESC limit 1'
-                    cur.execute(sql, (JobStatus.Queue.value))
-                    row = cur.fetchone()
-                    if row:
-                        job = Job(**row)
-                    if row is None or job.num_gpu > max_gpu_available:
-                        rows = []
-                    else:
-                        sql = 'SELECT * FROM jobs WHERE status = %s AND num_gpu <= %s ORDER BY priority DESC, created_at ASC FOR UPDATE'
-                        cur.execute(sql, (JobStatus.Queue.value, max_gpu_available))
-                        rows = cur.fetchall()
-                for row in rows:
-                    job = Job(**row)
-                    required_labels = set(job.required_labels.split(',') if len(job.required_labels) > 0 else [])
-                    if required_labels.intersection(labels) != required_labels:
-                        continue
-                    self._update(job.id, status=JobStatus.Running)
-                    found = True
+                if row is not None:
+                    job = Job.from_row(row)
                     break
-                self.db.commit()
-            except (Exception, KeyboardInterrupt) as e:
-                self.db.rollback()
-                raise e
-        return job if found else None
+                del candidates[job.id]  # claimed or being claimed by another runner
+            if job.array_size:
+                return self._materialize_task(cur, job, started_at)
+            self._update(cur, job.id, status=JobStatus.Running)
+            cur.execute('UPDATE jobs SET started_at = %s WHERE id = %s', (started_at, job.id))
+        return job._replace(status=JobStatus.Running.value, started_at=started_at)
+
+    def _materialize_task(self, cur, parent: Job, started_at: datetime.datetime) -> Job:
+        ''' create the next task of the locked array job `parent`, loaded in full, as a running job. The parent is Expanded after the last one. '''
+        index = parent.array_next
+        cur.execute('SELECT params FROM job_array_params WHERE job_id = %s AND array_index = %s', (parent.id, index))
+        row = cur.fetchone()
+        params = json.loads(row['params']) if row is not None else {}
+        task = parent._replace(id=None,
+                               command=util.render_command(parent.command, {'index': index, **params}),
+                               status=JobStatus.Running.value,
+                               array_size=0,
+                               array_next=0,
+                               array_parent=parent.id,
+                               array_index=index,
+                               gpu_ids='',
+                               host='',
+                               run_id='',
+                               started_at=started_at,
+                               updated_at=started_at)
+        task = self._insert(cur, [task])[0]
+        cur.execute('DELETE FROM job_array_params WHERE job_id = %s AND array_index = %s', (parent.id, index))
+        # the dispatcher assigns the rest of the array again
+        cur.execute('UPDATE jobs SET array_next = %s, assigned_runner = NULL WHERE id = %s', (index + 1, parent.id))
+        if index + 1 >= parent.array_size:
+            self._update(cur, parent.id, status=JobStatus.Expanded)
+        return task
+
+    def peek_next_job(self, total_gpus: Optional[int] = None, labels: Sequence[str] = []) -> Optional[Job]:
+        ''' the highest priority queued job that fits in `total_gpus` GPUs, without claiming it '''
+        sql, params = next_job_query(MAX_GPU if total_gpus is None else total_gpus, labels, 'priority', 1)
+        with self.db.cursor() as cur:
+            cur.execute(sql, params)
+            row = cur.fetchone()
+        return Job.from_row(row) if row is not None else None
+
+    def get_dispatchable_jobs(self, limit: int) -> List[Job]:
+        ''' unassigned queued jobs in priority order and oldest first, `limit` of each '''
+        jobs = {}
+        with self.db.cursor() as cur:
+            for order, (order_by, _) in CANDIDATE_ORDERS.items():
+                cur.execute(
+                    'SELECT ' + ', '.join(CLAIM_COLUMNS) + ' FROM jobs WHERE status = %s AND assigned_runner IS NULL'
+                    ' ORDER BY ' + order_by + ' LIMIT %s',
+                    (JobStatus.Queue.value, limit))
+                jobs.update((row['id'], Job.from_row(row)) for row in cur.fetchall())
+        return list(jobs.values())
+
+    def get_assigned_gpus(self) -> Dict[int, int]:
+        ''' {runner id: GPUs of queued jobs assigned to it} '''
+        with self.db.cursor() as cur:
+            cur.execute('SELECT assigned_runner, SUM(num_gpu) AS num_gpu FROM jobs'
+                        ' WHERE assigned_runner IS NOT NULL AND status = %s GROUP BY assigned_runner',
+                        JobStatus.Queue.value)
+            return {row['assigned_runner']: int(row['num_gpu']) for row in cur.fetchall()}
+
+    def assign(self, assignments: Sequence[Tuple[int, int]], live_runner_ids: Sequence[int]):
+        '''
+        Assign queued jobs to runners, `(job id, runner id)`, in one transaction.
+        Queued jobs assigned to runners not in `live_runner_ids` are unassigned.
+        '''
+        with self.db.transaction() as cur:
+            placeholders = ', '.join(['%s'] * len(live_runner_ids))
+            cur.execute(
+                'UPDATE jobs SET assigned_runner = NULL WHERE status = %s AND assigned_runner IS NOT NULL' +
+                (' AND assigned_runner NOT IN (' + placeholders + ')' if len(live_runner_ids) > 0 else ''),
+                [JobStatus.Queue.value] + list(live_runner_ids))
+            released = cur.rowcount
+            if len(assignments) > 0:
+                cur.executemany('UPDATE jobs SET assigned_runner = %s WHERE id = %s AND status = %s AND assigned_runner IS NULL',
+                                [(runner_id, job_id, JobStatus.Queue.value) for job_id, runner_id in assignments])
+            if len(assignments) > 0 or released > 0:
+                self._bump_queue_version(cur)
+
+    def archive(self, older_than: datetime.timedelta, batch_size: int = 500, pause_s: float = 0.1) -> int:
+        '''
+        Move terminal jobs not updated for `older_than` to jobs_archive, `batch_size` rows per transaction.
+        Rows locked by someone else are left for the next run. Returns the number of archived jobs.
+        job_phases rows are kept: they are the phase history and refer to archived jobs by id like jobs_archive.
+        '''
+        columns = ', '.join(JOB_COLUMNS)
+        statuses = ', '.join(['%s'] * len(TERMINAL_STATUSES))
+        cutoff = now(self.tz) - older_than
+        archived = 0
+        while True:
+            with self.db.transaction() as cur:
+                cur.execute(
+                    'SELECT id FROM jobs WHERE status IN (' + statuses + ') AND updated_at < %s ORDER BY updated_at LIMIT %s' + self.db.skip_locked,
+                    TERMINAL_STATUSES + [cutoff, batch_size])
+                ids = [row['id'] for row in cur.fetchall()]
+                if len(ids) == 0:
+                    return archived
+                placeholders = ', '.join(['%s'] * len(ids))
+                cur.execute('INSERT INTO jobs_archive (' + columns + ') SELECT ' + columns + ' FROM jobs WHERE id IN (' + placeholders + ')', ids)
+                cur.execute('DELETE FROM job_labels WHERE job_id IN (' + placeholders + ')', ids)
+                cur.execute('DELETE FROM job_dependencies WHERE job_id IN (' + placeholders + ')', ids)
+                cur.execute('DELETE FROM jobs WHERE id IN (' + placeholders + ')', ids)
+            archived += len(ids)
+            time.sleep(pause_s)
 
     def get_failed_jobs_since(self, since):
-        with db_lock:
-            with self.db.cursor() as cur:
-                cur.execute('SELECT * FROM jobs WHERE status = %s AND updated_at > %s', (JobStatus.Fail.value, since))
-                rows = cur.fetchall()
-        return [Job(**row) for row in rows]
+        ''' failed jobs with `id`, `host`, `command` and `message` loaded '''
+        with self.db.cursor() as cur:
+            cur.execute(SQL_FAILED_JOBS_SINCE, (JobStatus.Fail.value, since) * 2)
+            jobs = [Job.from_row(row) for row in cur.fetchall()]
+            messages = self._get_messages(cur, [job.id for job in jobs])
+        return [job._replace(message=messages.get(job.id, '')) for job in jobs]
+
+    def add_phases(self, id: int, phases: Sequence[Tuple[str, float, float]]):
+        ''' (phase, begin as epoch seconds, seconds) of one run of job `id`, see `timing.Spans.items` '''
+        if len(phases) == 0:
+            return
+        with self.db.cursor() as cur:
+            cur.executemany('INSERT INTO job_phases (job_id, phase, started_at, duration_s) VALUES (%s, %s, %s, %s)',
+                            [(id, phase, datetime.datetime.fromtimestamp(begin, self.tz).replace(tzinfo=None), seconds)
+                             for phase, begin, seconds in phases])
+
+    def get_phases_since(self, since: datetime.datetime) -> List[dict]:
+        ''' rows of job_phases started after `since`: job_id, phase, started_at and duration_s '''
+        with self.db.cursor() as cur:
+            cur.execute('SELECT job_id, phase, started_at, duration_s FROM job_phases WHERE started_at > %s', since)
+            return cur.fetchall()
+
+    def get_finished_jobs_since(self, since) -> List[Job]:
+        ''' finished jobs updated after `since` with `id`, `repo_url`, `command`, `num_gpu`, `started_at` and `updated_at` loaded '''
+        with self.db.cursor() as cur:
+            cur.execute(SQL_FINISHED_JOBS_SINCE, (JobStatus.Finish.value, since) * 2)
+            return [Job.from_row(row) for row in cur.fetchall()]
+
+
+class EventSubscriber():
+    '''
+    Tail job_events with a cursor persisted in event_cursors under `name`; each subscriber name has its own cursor.
+    `poll()` returns events after the cursor and `commit()` advances it, so an event is delivered again only if the
+    consumer stops between the two.
+
+    Ids are assigned at insert but rows become visible at commit, so a concurrent writer can leave a temporary hole
+    in the ids. `poll()` stops before a hole until it is filled or is older than `gap_timeout_s` (a rolled back insert).
+    '''
+    def __init__(self,
+                 db: Backend,
+                 name: str,
+                 batch_size: int = 100,
+                 gap_timeout_s: float = 10,
+                 start_at_end: bool = True,
+                 tz=datetime.timezone(datetime.timedelta(hours=9), 'JST')):
+        self.db = db
+        self.name = name
+        self.tz = tz
+        self.batch_size = batch_size
+        self.gap_timeout_s = gap_timeout_s
+        self.gaps: Dict[int, float] = {}  # missing event id -> first seen time
+        Migrator(self.db).upgrade()
+        with self.db.transaction() as cur:
+            cur.execute('SELECT last_event_id FROM event_cursors WHERE subscriber = %s', self.name)
+            row = cur.fetchone()
+            if row is None:
+                # a new subscriber starts from now, not from the whole history
+                cur.execute('SELECT MAX(id) AS id FROM job_events')
+                self.last_event_id = (cur.fetchone()['id'] or 0) if start_at_end else 0
+                cur.execute('INSERT INTO event_cursors (subscriber, last_event_id, updated_at) VALUES (%s, %s, %s)',
+                            (self.name, self.last_event_id, now(self.tz)))
+            else:
+                self.last_event_id = row['last_event_id']
+        self.polled_event_id = self.last_event_id
+
+    def poll(self) -> List[JobEvent]:
+        with self.db.cursor() as cur:
+            cur.execute(SQL_EVENTS_AFTER, (self.polled_event_id, self.batch_size))
+            rows = cur.fetchall()
+        events = []
+        expected_id = self.polled_event_id + 1
+        for row in rows:
+            if row['id'] != expected_id:
+                first_seen = self.gaps.setdefault(expected_id, time.time())
+                if time.time() - first_seen < self.gap_timeout_s:
+                    break
+            self.gaps = {id: seen for id, seen in self.gaps.items() if id > row['id']}
+            events.append(JobEvent(**row))
+            expected_id = row['id'] + 1
+        if len(events) > 0:
+            self.polled_event_id = events[-1].id
+        return events
+
+    def commit(self, events: Sequence[JobEvent]):
+        if len(events) == 0:
+            return
+        self.last_event_id = max(event.id for event in events)
+        with self.db.cursor() as cur:
+            cur.execute('UPDATE event_cursors SET last_event_id = %s, updated_at = %s WHERE subscriber = %s',
+                        (self.last_event_id, now(self.tz), self.name))
 
 
 class RunnerRepository():
-    def __init__(self, db: Connection, tz=datetime.timezone(datetime.timedelta(hours=9), 'JST')):
+    def __init__(self, db: Backend, tz=datetime.timezone(datetime.timedelta(hours=9), 'JST')):
         self.db = db
         self.tz = tz
         self.create_table()
 
     def create_table(self):
-        with db_lock, self.db.cursor() as cur:
-            # yapf: disable
-            cur.execute(
-                'CREATE TABLE IF NOT EXISTS runners ('+
-                '   id int NOT NULL AUTO_INCREMENT,'+
-                '   name varchar(255),'+
-                '   gpu_ids varchar(255),'+
-                '   labels varchar(255),'+
-                '   status varchar(16),'+
-                '   created_at varchar(64),'+
-                '   updated_at varchar(64),'+
-                '   PRIMARY KEY (id))'
-            )
-            # yapf: enable
+        Migrator(self.db).upgrade()
 
     def create(self, runner: Runner):
-        with db_lock:
-            runner_dict = runner._asdict()
-            runner_dict['created_at'] = datetime.datetime.now(tz=self.tz).isoformat()
-            runner_dict['updated_at'] = datetime.datetime.now(tz=self.tz).isoformat()
-            del runner_dict['id']
-            sql = 'INSERT INTO runners (' + ', '.join(list(runner_dict.keys())) + ') VALUES (' + ', '.join(['%s'] * len(runner_dict.keys())) + ')'
-            with self.db.cursor() as cur:
-                cur.execute(sql, list(runner_dict.values()))
-                cur.execute('SELECT * from runners WHERE id = LAST_INSERT_ID() LIMIT 1')
-                result = cur.fetchone()
-        return Runner(**result)
+        runner_dict = runner._asdict()
+        runner_dict['created_at'] = now(self.tz)
+        runner_dict['updated_at'] = now(self.tz)
+        del runner_dict['id']
+        with self.db.cursor() as cur:
+            id = self.db.insert_rows(cur, 'runners', list(runner_dict.keys()), [list(runner_dict.values())])[0]
+            return self._get(cur, id)
 
     def update(self, id: int, **kwargs):
-        with db_lock:
-            self._update(id, **kwargs)
-        return self.get(id)
+        with self.db.cursor() as cur:
+            self._update(cur, id, **kwargs)
+            return self._get(cur, id)
 
     def update_timestamp(self, id: int):
-        with db_lock:
-            self._update(id, updated_at=datetime.datetime.now(tz=self.tz).isoformat())
-        return self.get(id)
+        with self.db.cursor() as cur:
+            self._update(cur, id, updated_at=now(self.tz))
+            return self._get(cur, id)
 
-    def _update(self, id: int, **kwargs):
+    def _update(self, cur, id: int, **kwargs):
         default_runner = Runner()
         runner = dict()
         for key, value in kwargs.items():
             if hasattr(default_runner, key) and type(value) == type(getattr(default_runner, key)):
                 runner[key] = value
-        runner['updated_at'] = datetime.datetime.now(tz=self.tz).isoformat()
+        runner['updated_at'] = now(self.tz)
         sql = 'UPDATE runners set ' + ', '.join([key + '= %s' for key in runner.keys()]) + ' WHERE id = %s'
-        with self.db.cursor() as cur:
-            cur.execute(sql, list(runner.values()) + [id])
+        cur.execute(sql, list(runner.values()) + [id])
 
     def get(self, id: int) -> Optional[Runner]:
-        with db_lock:
-            with self.db.cursor() as cur:
-                cur.execute('SELECT * from runners WHERE id = %s LIMIT 1', id)
-                row = cur.fetchone()
+        with self.db.cursor() as cur:
+            return self._get(cur, id)
+
+    def _get(self, cur, id: int) -> Optional[Runner]:
+        cur.execute('SELECT * from runners WHERE id = %s LIMIT 1', id)
+        row = cur.fetchone()
         return Runner(**row)
 
     def remove(self, id: int):
-        with db_lock:
-            with self.db.cursor() as cur:
-                cur.execute('DELETE from runners WHERE id = %s', id)
+        with self.db.cursor() as cur:
+            cur.execute('DELETE from runners WHERE id = %s', id)
+
+    def get_dispatch_runners(self, seen_since: datetime.datetime) -> List[Runner]:
+        with self.db.cursor() as cur:
+            cur.execute('SELECT * FROM runners WHERE status = %s AND dispatch = 1 AND updated_at > %s', (RunnerStatus.Running.value, seen_since))
+            return [Runner(**row) for row in cur.fetchall()]
+
+    def get_wakeup_addresses(self) -> List[str]:
+        with self.db.cursor() as cur:
+            cur.execute('SELECT wakeup_address FROM runners WHERE status = %s AND wakeup_address <> \'\'', RunnerStatus.Running.value)
+            return [row['wakeup_address'] for row in cur.fetchall()]
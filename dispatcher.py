@@ -0,0 +1,77 @@
+import time, datetime
+from typing import List, Optional, Sequence, Tuple
+
+from db import Backend, JobRepository, RunnerRepository, add_database_arguments, now, open_database, split_labels
+from model import Job, Runner
+from scheduler import Policy
+import wakeup
+
+
+class Dispatcher():
+    '''
+    Assign queued jobs to runners started with `--dispatch`, for all of them at once.
+
+    Each cycle reads the runners' free GPUs and the head of the queue, then walks the queue in `Policy` rank:
+    a job goes to the runner that fits it most tightly (best fit keeps large holes for large jobs).
+    If the job fits no runner now, the runner closest to fitting it gets nothing else this cycle, so the job is not starved.
+    Runners then claim only their assigned jobs.
+    '''
+    def __init__(self, db: Backend, policy: Optional[Policy] = None, max_jobs: int = 1000, runner_timeout_s: float = 120):
+        self.db = db
+        self.repo = JobRepository(db)
+        self.runner_repo = RunnerRepository(db)
+        self.policy = policy or Policy()
+        self.max_jobs = max_jobs
+        self.runner_timeout_s = runner_timeout_s
+
+    def plan(self, jobs: Sequence[Job], runners: Sequence[Runner], current_time: datetime.datetime) -> List[Tuple[Job, Runner]]:
+        free = {runner.id: runner.free_gpus for runner in runners}
+        total = {runner.id: len([gpu_id for gpu_id in runner.gpu_ids.split(',') if gpu_id]) or runner.free_gpus for runner in runners}
+        labels = {runner.id: set(split_labels(runner.labels)) for runner in runners}
+        reserved = set()
+        assignments = []
+        for job in self.policy.rank(jobs, current_time):
+            required_labels = set(split_labels(job.required_labels))
+            eligible = [
+                runner for runner in runners
+                if runner.id not in reserved and required_labels <= labels[runner.id] and job.num_gpu <= total[runner.id]
+            ]
+            fitting = [runner for runner in eligible if job.num_gpu <= free[runner.id]]
+            if len(fitting) > 0:
+                runner = min(fitting, key=lambda runner: (free[runner.id] - job.num_gpu, runner.id))
+                free[runner.id] -= job.num_gpu
+                assignments.append((job, runner))
+            elif len(eligible) > 0 and not job.gpu_memory_mb:
+                reserved.add(max(eligible, key=lambda runner: (free[runner.id], -runner.id)).id)
+        return assignments
+
+    def dispatch(self) -> List[Tuple[Job, Runner]]:
+        ''' one cycle '''
+        runners = self.runner_repo.get_dispatch_runners(now(self.runner_repo.tz) - datetime.timedelta(seconds=self.runner_timeout_s))
+        # GPUs of jobs assigned earlier but not claimed yet are taken
+        pending = self.repo.get_assigned_gpus()
+        runners = [runner._replace(free_gpus=runner.free_gpus - pending.get(runner.id, 0)) for runner in runners]
+        jobs = self.repo.get_dispatchable_jobs(self.max_jobs)
+        assignments = self.plan(jobs, runners, now(self.repo.tz))
+        self.repo.assign([(job.id, runner.id) for job, runner in assignments], [runner.id for runner in runners])
+        wakeup.notify(sorted(set(runner.wakeup_address for _, runner in assignments if runner.wakeup_address)))
+        return assignments
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser('assign queued jobs to runners started with --dispatch')
+    add_database_arguments(parser)
+    parser.add_argument('--interval-s', type=float, default=2)
+    parser.add_argument('--max-jobs', type=int, default=1000, help='queued jobs considered per cycle, in priority order and oldest first each')
+    parser.add_argument('--runner-timeout-s', type=float, default=120, help='runners not seen for this long get no jobs and lose their assigned ones')
+    parser.add_argument('--aging-hours', type=float, default=6)
+    args = parser.parse_args()
+
+    dispatcher = Dispatcher(open_database(args), Policy(aging_s=args.aging_hours * 60 * 60), args.max_jobs, args.runner_timeout_s)
+    while True:
+        begin = time.time()
+        assignments = dispatcher.dispatch()
+        if len(assignments) > 0:
+            print('{} assigned {} jobs in {:.3f} s'.format(datetime.datetime.now(), len(assignments), time.time() - begin))
+        time.sleep(args.interval_s)
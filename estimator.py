@@ -0,0 +1,116 @@
+import collections, datetime, re
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+
+from db import JobRepository, now
+from model import Job
+
+# numbers (including 1e-3, 0.1) and hex hashes vary between runs of the same script
+NUMBER_PATTERN = re.compile(r'(?<![\w.])[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?(?!\w)|\b[0-9a-f]{7,40}\b')
+
+
+def command_template(command: str) -> str:
+    ''' 'python train.py --lr 0.1 --seed=3' -> 'python train.py --lr # --seed=#' '''
+    return ' '.join(NUMBER_PATTERN.sub('#', command).split())
+
+
+def quantile(sorted_values: Sequence[float], q: float) -> float:
+    ''' linear interpolation between the closest ranks '''
+    position = (len(sorted_values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+class RuntimeEstimator():
+    '''
+    Runtime quantiles of finished jobs per (repo, command template), the last `window` runs of each.
+    `refresh()` reads only jobs finished since the previous call; quantiles are cached until a key gets a new run.
+    Keys with fewer than `min_samples` runs have no estimate.
+    '''
+    def __init__(self,
+                 repo: JobRepository,
+                 quantile: float = 0.9,
+                 window: int = 100,
+                 min_samples: int = 3,
+                 history: datetime.timedelta = datetime.timedelta(days=14),
+                 refresh_interval_s: float = 60):
+        self.repo = repo
+        self.quantile = quantile
+        self.window = window
+        self.min_samples = min_samples
+        self.refresh_interval_s = refresh_interval_s
+        self.samples: Dict[Tuple[str, str], Deque[float]] = {}
+        self.cache: Dict[Tuple[str, str, float], Optional[float]] = {}
+        self.watermark = now(repo.tz) - history
+        self.seen: Dict[int, datetime.datetime] = {}  # ids already counted, finished near the watermark
+        self.last_refresh: Optional[datetime.datetime] = None
+
+    def key(self, job: Job) -> Tuple[str, str]:
+        return job.repo_url or '', command_template(job.command or '')
+
+    def add(self, job: Job, runtime_s: float):
+        key = self.key(job)
+        self.samples.setdefault(key, collections.deque(maxlen=self.window)).append(runtime_s)
+        self.cache = {cached: value for cached, value in self.cache.items() if cached[:2] != key}
+
+    def refresh(self, force: bool = False) -> int:
+        ''' add jobs finished since the last refresh, at most every `refresh_interval_s`. Returns the number added. '''
+        current_time = now(self.repo.tz)
+        if not force and self.last_refresh is not None and (current_time - self.last_refresh).total_seconds() < self.refresh_interval_s:
+            return 0
+        self.last_refresh = current_time
+        # updated_at is set before commit, so a job may show up late with an older timestamp; look back a little
+        overlap = datetime.timedelta(seconds=max(60.0, self.refresh_interval_s))
+        added = 0
+        for job in self.repo.get_finished_jobs_since(self.watermark - overlap):
+            if job.id in self.seen or job.started_at is None or job.updated_at is None:
+                continue
+            self.seen[job.id] = job.updated_at
+            self.watermark = max(self.watermark, job.updated_at)
+            self.add(job, max(0.0, (job.updated_at - job.started_at).total_seconds()))
+            added += 1
+        self.seen = {id: updated_at for id, updated_at in self.seen.items() if updated_at >= self.watermark - overlap}
+        return added
+
+    def estimate(self, job: Job, q: Optional[float] = None) -> Optional[float]:
+        ''' the `q` quantile (default: `self.quantile`) of the runtime of jobs like `job`, in seconds '''
+        q = self.quantile if q is None else q
+        key = self.key(job)
+        if (*key, q) not in self.cache:
+            samples = self.samples.get(key, ())
+            self.cache[(*key, q)] = quantile(sorted(samples), q) if len(samples) >= self.min_samples else None
+        return self.cache[(*key, q)]
+
+    def runtime_hint(self, job: Job) -> Optional[float]:
+        ''' for `scheduler.Policy`; a high quantile keeps backfilled jobs from overrunning reservations '''
+        return self.estimate(job)
+
+    def eta(self, job: Job, current_time: datetime.datetime) -> Optional[datetime.datetime]:
+        ''' median finish time of the running `job`, never in the past '''
+        runtime = self.estimate(job, 0.5)
+        if runtime is None or job.started_at is None:
+            return None
+        return max(current_time, job.started_at + datetime.timedelta(seconds=runtime))
+
+    def summary(self) -> List[Tuple[str, str, int, float, float, float]]:
+        ''' (repo, command template, runs, p10, p50, p90), most runs first '''
+        rows = []
+        for (repo_url, template), samples in self.samples.items():
+            values = sorted(samples)
+            rows.append((repo_url, template, len(values), quantile(values, 0.1), quantile(values, 0.5), quantile(values, 0.9)))
+        return sorted(rows, key=lambda row: -row[2])
+
+
+if __name__ == '__main__':
+    import argparse
+    from db import add_database_arguments, open_database
+    parser = argparse.ArgumentParser('print runtime quantiles of finished jobs per repo and command template')
+    add_database_arguments(parser)
+    parser.add_argument('--history-days', type=float, default=14)
+    parser.add_argument('--window', type=int, default=100, help='recent runs kept per command template')
+    args = parser.parse_args()
+
+    estimator = RuntimeEstimator(JobRepository(open_database(args)), window=args.window, history=datetime.timedelta(days=args.history_days))
+    estimator.refresh(force=True)
+    for repo_url, template, runs, p10, p50, p90 in estimator.summary():
+        print('{}\t{:.0f}\t{:.0f}\t{:.0f}\t{}\t{}'.format(runs, p10, p50, p90, repo_url, template))
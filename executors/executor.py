@@ -1,5 +1,7 @@
-from typing import TextIO
+import os
+from typing import Dict, Sequence, TextIO
 from model import Job
+import affinity
 
 
 class Executor():
@@ -10,12 +12,29 @@ class Executor():
             temp_dir_root: str,
             stdout: TextIO,
             stderr: TextIO,
+            cpu_ids: Sequence[int] = (),
     ):
         self.job = job
         self.temp_dir = temp_dir
         self.temp_dir_root = temp_dir_root
         self.stdout = stdout
         self.stderr = stderr
+        self.cpu_ids = list(cpu_ids)
+
+    def affinity_env(self) -> Dict[str, str]:
+        ''' thread-count variables for the job's CPUs '''
+        return affinity.thread_env(self.cpu_ids)
+
+    def array_env(self) -> Dict[str, str]:
+        ''' which task of which array job this is, for commands that pick their work themselves '''
+        if self.job.array_parent is None:
+            return {}
+        return {'JOB_ARRAY_ID': str(self.job.array_parent), 'JOB_ARRAY_INDEX': str(self.job.array_index)}
+
+    def preexec(self):
+        ''' `preexec_fn` of the job process: new session, pinned to the job's CPUs '''
+        os.setsid()
+        affinity.set_affinity(self.cpu_ids)
 
     def prepare(self):
         ...
@@ -28,3 +47,7 @@ class Executor():
 
     def kill(self):
         raise NotImplementedError()
+
+    def signal(self, signum: int):
+        ''' deliver `signum` to the running job, e.g. to make it checkpoint before preemption '''
+        raise NotImplementedError()
@@ -28,6 +28,7 @@ class Executor(Base):
             lock = locks[key] if key in locks else threading.Lock()
             locks[key] = lock
         self.kill_flg = False
+        self.proc = None
         self.venv_dir = os.path.join(self.temp_dir_root, 'python_venv', repo_url_to_dir(self.job.repo_url))
         with lock:
             os.makedirs(self.venv_dir, exist_ok=True)
@@ -59,9 +60,12 @@ class Executor(Base):
                     **os.environ,
                     'CUDA_VISIBLE_DEVICES': self.job.gpu_ids,
                     'LOGDIR_ROOT': '/home/ukai/OUTPUT_SSHFS/transferclustering',
+                    **self.affinity_env(),
+                    **self.array_env(),
                 },
-                preexec_fn=os.setsid,
+                preexec_fn=self.preexec,
         ) as proc:
+            self.proc = proc
             while proc.poll() is None:
                 time.sleep(10)
                 if self.kill_flg:
@@ -75,4 +79,9 @@ class Executor(Base):
         ...
 
     def kill(self):
-        self.kill_flg = True
\ No newline at end of file
+        self.kill_flg = True
+
+    def signal(self, signum):
+        proc = getattr(self, 'proc', None)
+        if proc is not None and proc.poll() is None:
+            os.killpg(os.getpgid(proc.pid), signum)
\ No newline at end of file
@@ -1,8 +1,7 @@
-import time, datetime, json, os
+import time, json, os
 import requests
-import pymysql
-from db import JobRepository
-from model import Job
+from db import EventSubscriber, JobRepository, add_database_arguments, open_database
+from model import Job, JobStatus
 
 
 def send_to_slack(url, job: Job):
@@ -33,28 +32,22 @@ def send_to_slack(url, job: Job):
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('--host', default='localhost')
-    parser.add_argument('--user', default='jobmanager')
-    parser.add_argument('--password', default='jobmanager')
-    parser.add_argument('--database', default='jobmanage_py')
+    add_database_arguments(parser)
     parser.add_argument('--slack-api-url', default=os.environ.get('SLACK_WEBHOOK_URL'))
+    parser.add_argument('--subscriber', type=str, default='fail-watcher', help='name of the persisted event cursor')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--interval-s', type=float, default=5)
     args = parser.parse_args()
 
-    db = connection = pymysql.connect(
-        host=args.host,
-        user=args.user,
-        password=args.password,
-        database=args.database,
-        cursorclass=pymysql.cursors.DictCursor,
-        autocommit=True,
-    )
+    db = open_database(args)
     repo = JobRepository(db)
-    last_time = datetime.datetime.now(tz=repo.tz).isoformat()
+    subscriber = EventSubscriber(db, args.subscriber, batch_size=args.batch_size)
 
     while True:
-        now = datetime.datetime.now(tz=repo.tz).isoformat()
-        failed_jobs = repo.get_failed_jobs_since(last_time)
-        for job in failed_jobs:
+        events = subscriber.poll()
+        failed_ids = [event.job_id for event in events if event.status == JobStatus.Fail.value]
+        for job in repo.get_many(failed_ids, with_message=True):
             send_to_slack(args.slack_api_url, job)
-        last_time = now
-        time.sleep(30)
+        subscriber.commit(events)
+        if len(events) < args.batch_size:
+            time.sleep(args.interval_s)
@@ -1,8 +1,12 @@
 import os
 import git
 import threading
+from typing import Dict
+import gpu
 
-git_repo_lock = threading.Lock()
+repo_locks: Dict[str, threading.Lock] = {}  # cache dir -> lock, so jobs of other repositories check out meanwhile
+repo_locks_lock = threading.Lock()
+configured_caches = set()  # cache dirs whose gc settings were checked by this process
 
 
 def url_to_dir(repo_url):
@@ -19,21 +23,50 @@ def url_to_dir(repo_url):
     return repo_path
 
 
-def clone_git_repository(repo_url: str, commit_hash: str, dest_dir: str, repo_cache_dir: str, branch_name='working'):
-    # update cache
-    repo_dir = os.path.join(repo_cache_dir, url_to_dir(repo_url))
-    with git_repo_lock:
+def repo_lock(repo_dir: str) -> threading.Lock:
+    with repo_locks_lock:
+        return repo_locks.setdefault(repo_dir, threading.Lock())
+
+
+def has_commit(repo_dir: str, commit_hash: str) -> bool:
+    try:
+        git.Git(working_dir=repo_dir).cat_file('-e', commit_hash + '^{commit}')
+        return True
+    except git.GitCommandError:
+        return False
+
+
+def update_cache(repo_url: str, commit_hash: str, repo_dir: str):
+    ''' make sure `repo_dir` has `commit_hash`, fetching only when it does not. Runners sharing the cache wait on `repo_dir`.lock '''
+    os.makedirs(os.path.dirname(repo_dir), exist_ok=True)
+    with repo_lock(repo_dir), gpu.Lock(repo_dir + '.lock'):
         if not os.path.exists(repo_dir):
-            os.makedirs(os.path.dirname(repo_dir), exist_ok=True)
-            git.Git(working_dir=repo_cache_dir).clone(repo_url, repo_dir)
-            repo = git.Repo(repo_dir)
-        else:
-            repo = git.Repo(repo_dir)
-            repo.remotes.origin.pull()
-    # clone from cache
+            # no working tree; jobs check out from the objects only
+            git.Git().clone('--mirror', repo_url, repo_dir)
+        g = git.Git(working_dir=repo_dir)
+        if repo_dir not in configured_caches:
+            # job checkouts borrow these objects; gc must not drop commits force-pushed away. Also set on caches cloned before.
+            g.config('gc.pruneExpire', 'never')
+            configured_caches.add(repo_dir)
+        if has_commit(repo_dir, commit_hash):
+            return
+        g.fetch('origin')
+        if not has_commit(repo_dir, commit_hash):
+            # not on any branch (e.g. force-pushed away); servers may still hand it out by hash
+            g.fetch('origin', commit_hash)
+
+
+def checkout(repo_dir: str, commit_hash: str, dest_dir: str, branch_name='working'):
+    '''
+    Check out `commit_hash` into `dest_dir` borrowing the objects of `repo_dir` (git clone --shared), so only the working tree is written.
+    Unlike a worktree the copy stays valid when moved; it needs `repo_dir` to keep the objects, see `update_cache`.
+    '''
     os.makedirs(os.path.dirname(dest_dir), exist_ok=True)
-    with git_repo_lock:
-        repo = repo.clone(dest_dir)
-    past_branch = repo.create_head(branch_name, commit_hash)
-    repo.head.reference = past_branch
-    repo.head.reset(index=True, working_tree=True)
+    git.Git().clone('--shared', '--no-checkout', repo_dir, dest_dir)
+    git.Git(working_dir=dest_dir).checkout('-q', '-b', branch_name, commit_hash)
+
+
+def clone_git_repository(repo_url: str, commit_hash: str, dest_dir: str, repo_cache_dir: str, branch_name='working'):
+    repo_dir = os.path.join(repo_cache_dir, url_to_dir(repo_url))
+    update_cache(repo_url, commit_hash, repo_dir)
+    checkout(repo_dir, commit_hash, dest_dir, branch_name)
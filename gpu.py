@@ -1,6 +1,241 @@
 #!/usr/bin/env python
-import sys, os, json, fcntl, time
-import GPUtil
+import sys, os, json, fcntl, time, array, collections, math, subprocess, threading
+from typing import Callable, Dict, List, NamedTuple, Optional
+import allocator
+
+NVIDIA_SMI_QUERY = ['nvidia-smi', '--query-gpu=index,memory.total,memory.used,utilization.gpu', '--format=csv,noheader,nounits']
+MAX_LOAD = 0.5  # busier GPUs are not available, as GPUtil.getAvailable
+
+# set by use_allocator; None: the lock and JSON files below
+_allocator = None
+
+
+def use_allocator(path=allocator.DEFAULT_SOCKET):
+    ''' reserve GPUs through the allocator daemon listening on `path` (see allocator.py) instead of the lock and JSON files '''
+    global _allocator
+    _allocator = allocator.AllocatorClient(path)
+
+
+class GpuSnapshot(NamedTuple):
+    ''' device state at `sampled_at`, one array element per GPU in `ids` order. Unknown readings are NaN. '''
+    ids: array.array
+    memory_total_mb: array.array
+    memory_used_mb: array.array
+    utilization: array.array  # 0-1
+    sampled_at: float = 0
+
+    def available(self, max_memory_used=0.001, max_load=MAX_LOAD) -> List[int]:
+        ''' GPUs using less than `max_memory_used` of their memory and `max_load` '''
+        return [
+            gpu_id for gpu_id, total, used, load in zip(self.ids, self.memory_total_mb, self.memory_used_mb, self.utilization)
+            if total > 0 and used / total < max_memory_used and load < max_load
+        ]
+
+    def memory_total(self) -> Dict[int, int]:
+        return {gpu_id: int(total) for gpu_id, total in zip(self.ids, self.memory_total_mb) if not math.isnan(total)}
+
+    def index(self, gpu_id: int) -> Optional[int]:
+        return self.ids.index(gpu_id) if gpu_id in self.ids else None
+
+
+def _snapshot(rows) -> GpuSnapshot:
+    ''' (id, memory total MB, memory used MB, utilization 0-1) rows '''
+    rows = sorted(rows)
+    return GpuSnapshot(array.array('i', [row[0] for row in rows]), *[array.array('d', [row[i] for row in rows]) for i in range(1, 4)], time.time())
+
+
+def _reading(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return math.nan  # [N/A], [Not Supported]
+
+
+def parse_nvidia_smi_csv(text: str) -> GpuSnapshot:
+    rows = []
+    for line in text.strip().split('\n'):
+        values = [value.strip() for value in line.split(',')]
+        if len(values) == 4 and values[0].isdigit():
+            rows.append((int(values[0]), _reading(values[1]), _reading(values[2]), _reading(values[3]) / 100))
+    return _snapshot(rows)
+
+
+def nvidia_smi_source() -> GpuSnapshot:
+    try:
+        return parse_nvidia_smi_csv(subprocess.run(NVIDIA_SMI_QUERY, capture_output=True, text=True, check=True).stdout)
+    except (OSError, subprocess.CalledProcessError):
+        return _snapshot([])  # no driver: no GPUs
+
+
+def nvml_source() -> Optional[Callable[[], GpuSnapshot]]:
+    ''' sampling through the NVML library, no process per sample. None if pynvml is not installed or has no driver '''
+    try:
+        import pynvml
+        pynvml.nvmlInit()
+    except Exception:
+        return None
+
+    def sample():
+        rows = []
+        for i in range(pynvml.nvmlDeviceGetCount()):
+            handle = pynvml.nvmlDeviceGetHandleByIndex(i)
+            memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
+            try:
+                utilization = pynvml.nvmlDeviceGetUtilizationRates(handle).gpu / 100
+            except pynvml.NVMLError:
+                utilization = math.nan
+            rows.append((i, memory.total / 2**20, memory.used / 2**20, utilization))
+        return _snapshot(rows)
+
+    return sample
+
+
+def fixture_source(path: str) -> Callable[[], GpuSnapshot]:
+    ''' nvidia-smi CSV output saved in `path` (see fixtures/telemetry), read again on every sample so tests can change it '''
+    def sample():
+        with open(path, 'r') as f:
+            return parse_nvidia_smi_csv(f.read())
+
+    return sample
+
+
+def make_source(name='auto', fixture_path=None) -> Callable[[], GpuSnapshot]:
+    ''' auto: NVML if available, else nvidia-smi '''
+    if name == 'fixture':
+        return fixture_source(fixture_path)
+    if name in ['auto', 'nvml']:
+        source = nvml_source()
+        if source is not None:
+            return source
+        if name == 'nvml':
+            raise RuntimeError('NVML is unavailable (pip install nvidia-ml-py)')
+    return nvidia_smi_source
+
+
+class TelemetrySampler():
+    '''
+    Polls `source` every `interval_s` seconds on a daemon thread. Each sample replaces `snapshot` as a whole,
+    so readers take no lock. A snapshot older than `ttl_s` (sampler stuck or not started) is sampled again by the reader.
+    '''
+    def __init__(self, source: Callable[[], GpuSnapshot] = nvidia_smi_source, interval_s: float = 2, ttl_s: float = 10):
+        self.source = source
+        self.interval_s = interval_s
+        self.ttl_s = ttl_s
+        self.snapshot: Optional[GpuSnapshot] = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def sample(self) -> GpuSnapshot:
+        self.snapshot = self.source()
+        return self.snapshot
+
+    def start(self) -> 'TelemetrySampler':
+        self.sample()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval_s):
+            try:
+                self.sample()
+            except Exception:
+                pass  # the last snapshot ages out and readers sample themselves
+
+    def stop(self):
+        self.stop_event.set()
+
+    def get(self) -> GpuSnapshot:
+        snapshot = self.snapshot
+        if snapshot is None or time.time() - snapshot.sampled_at > self.ttl_s:
+            snapshot = self.sample()
+        return snapshot
+
+
+# replaced by start_sampler; until then each read spawns nvidia-smi (ttl 0)
+_sampler = TelemetrySampler(interval_s=0, ttl_s=0)
+
+
+def start_sampler(source: Optional[Callable[[], GpuSnapshot]] = None, interval_s=2, ttl_s=None) -> TelemetrySampler:
+    '''
+    sample in the background; GPU state read by the functions below is then at most `interval_s` old.
+    Readers sample themselves only when the sampler falls behind by `ttl_s` (default: 5 intervals, at least 10 seconds).
+    '''
+    global _sampler
+    _sampler.stop()
+    _sampler = TelemetrySampler(source or make_source(), interval_s, max(10, interval_s * 5) if ttl_s is None else ttl_s).start()
+    return _sampler
+
+
+def get_snapshot() -> GpuSnapshot:
+    ''' with an allocator, its sampler's; the daemon already polls the GPUs '''
+    if _allocator is not None:
+        return _allocator.snapshot()
+    return _sampler.get()
+
+
+class GpuUsage():
+    '''
+    Utilization and memory of one job's GPUs. Recent samples are kept in a ring buffer; the whole run is summarized
+    in constant space (a histogram of utilization percents gives the p95). GPUs shared with other jobs count fully for each.
+    '''
+    def __init__(self, gpu_ids: List[int], window: int = 512):
+        self.gpu_ids = list(gpu_ids)
+        self.recent = collections.deque(maxlen=window)  # (sampled at, utilization 0-1, memory used MB)
+        self.histogram = [0] * 101
+        self.samples = 0
+        self.utilization_sum = 0.0
+        self.memory_peak_mb = 0
+        self.idle_since: Optional[float] = None
+
+    def add(self, snapshot: GpuSnapshot, idle_threshold: float = 0.05):
+        if len(self.gpu_ids) == 0 or (len(self.recent) > 0 and snapshot.sampled_at <= self.recent[-1][0]):
+            return
+        indexes = [snapshot.index(gpu_id) for gpu_id in self.gpu_ids]
+        utilizations = [snapshot.utilization[i] for i in indexes if i is not None and not math.isnan(snapshot.utilization[i])]
+        memory = [snapshot.memory_used_mb[i] for i in indexes if i is not None and not math.isnan(snapshot.memory_used_mb[i])]
+        if len(utilizations) == 0:
+            return
+        utilization = sum(utilizations) / len(utilizations)
+        memory_mb = int(sum(memory))
+        self.recent.append((snapshot.sampled_at, utilization, memory_mb))
+        self.histogram[min(100, max(0, int(round(utilization * 100))))] += 1
+        self.samples += 1
+        self.utilization_sum += utilization
+        self.memory_peak_mb = max(self.memory_peak_mb, memory_mb)
+        if utilization >= idle_threshold:
+            self.idle_since = None
+        elif self.idle_since is None:
+            self.idle_since = snapshot.sampled_at
+
+    def idle_s(self) -> float:
+        ''' how long the job's GPUs have been below the idle threshold, up to the last sample '''
+        return self.recent[-1][0] - self.idle_since if self.idle_since is not None else 0
+
+    def percentile(self, q: float) -> float:
+        rank = q * (self.samples - 1)
+        count = 0
+        for percent, n in enumerate(self.histogram):
+            count += n
+            if count > rank:
+                return percent / 100
+        return 0.0
+
+    def summary(self) -> dict:
+        ''' `Job` fields '''
+        if self.samples == 0:
+            return {}
+        return dict(gpu_samples=self.samples,
+                    gpu_util_mean=self.utilization_sum / self.samples,
+                    gpu_util_p95=self.percentile(0.95),
+                    gpu_memory_peak_mb=self.memory_peak_mb)
+
+    def format(self, recent_s: float = 60) -> str:
+        if self.samples == 0:
+            return 'GPU: -'
+        recent = [utilization for sampled_at, utilization, _ in self.recent if sampled_at >= self.recent[-1][0] - recent_s]
+        return 'GPU {:.0%} now, {:.0%} mean, {:.0%} p95, peak {:.1f} GB'.format(
+            sum(recent) / len(recent), self.utilization_sum / self.samples, self.percentile(0.95), self.memory_peak_mb / 1024)
 
 
 class Lock():
@@ -23,6 +258,7 @@ def try_get_available_gpu(
         lock_file='~/.gpu_wait.lock',
         history_file='~/.gpu_history.json',
         ngpu=None,
+        reservation_file='~/.gpu_memory_reservations.json',
 ):
     '''
     if ngpu == None: get all avaiable GPUs
@@ -30,8 +266,11 @@ def try_get_available_gpu(
         try to get specified number of gpus
         if number of available gpus < ngpu: get no gpus
     '''
+    if _allocator is not None:
+        return _allocator.acquire(candidate_gpu_ids, assign_interval_s, max_memory_used, ngpu)
     history_file = os.path.expanduser(history_file)
     lock_file = os.path.expanduser(lock_file)
+    reservation_file = os.path.expanduser(reservation_file)
     os.makedirs(os.path.dirname(history_file), exist_ok=True)
     os.makedirs(os.path.dirname(lock_file), exist_ok=True)
 
@@ -49,8 +288,10 @@ def try_get_available_gpu(
             del history[del_id]
 
         used_gpu_ids = set(map(int, history.keys()))
+        # GPUs shared by memory reservations are never handed out whole
+        used_gpu_ids |= set(map(int, _load_memory_reservations(reservation_file, assign_interval_s).keys()))
 
-        available_gpu_ids = set(GPUtil.getAvailable(limit=1000, maxMemory=max_memory_used))
+        available_gpu_ids = set(get_snapshot().available(max_memory_used))
         if len(candidate_gpu_ids) > 0:
             available_gpu_ids = available_gpu_ids.intersection(candidate_gpu_ids)
         available_gpu_ids = available_gpu_ids - used_gpu_ids
@@ -73,6 +314,8 @@ def release_gpu(
         lock_file='~/.gpu_wait.lock',
         history_file='~/.gpu_history.json',
 ):
+    if _allocator is not None:
+        return _allocator.release(gpu_ids)
     gpu_ids = list(map(str, gpu_ids))
     history_file = os.path.expanduser(history_file)
     lock_file = os.path.expanduser(lock_file)
@@ -92,6 +335,141 @@ def release_gpu(
             json.dump(history, f)
 
 
+def get_gpu_memory_total():
+    ''' {gpu id: total memory in MB} '''
+    if _allocator is not None:
+        return _allocator.memory_total()
+    return get_snapshot().memory_total()
+
+
+def _load_memory_reservations(reservation_file, assign_interval_s):
+    # {gpu id: {owner: [memory MB, reserved at]}}, expired reservations dropped
+    if not os.path.exists(reservation_file):
+        return {}
+    with open(reservation_file, 'r') as f:
+        reservations = json.load(f)
+    reservations = {
+        gpu_id: {owner: value
+                 for owner, value in owners.items() if time.time() - value[1] <= assign_interval_s}
+        for gpu_id, owners in reservations.items()
+    }
+    return {gpu_id: owners for gpu_id, owners in reservations.items() if len(owners) > 0}
+
+
+def get_shared_gpu_memory(
+        candidate_gpu_ids,
+        memory_total,
+        assign_interval_s,
+        lock_file='~/.gpu_wait.lock',
+        reservation_file='~/.gpu_memory_reservations.json',
+):
+    '''
+    {gpu id: unreserved memory in MB} of GPUs that already run memory-reserved jobs.
+    Free memory is what the reservations leave, not what the GPU currently reports: jobs allocate memory gradually.
+    '''
+    if _allocator is not None:
+        return _allocator.shared_memory(candidate_gpu_ids, memory_total, assign_interval_s)
+    lock_file = os.path.expanduser(lock_file)
+    reservation_file = os.path.expanduser(reservation_file)
+    os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+    with Lock(lock_file):
+        reservations = _load_memory_reservations(reservation_file, assign_interval_s)
+    free_memory = {}
+    for gpu_id, owners in reservations.items():
+        gpu_id = int(gpu_id)
+        if gpu_id in memory_total and (len(candidate_gpu_ids) == 0 or gpu_id in candidate_gpu_ids):
+            free_memory[gpu_id] = memory_total[gpu_id] - sum(value[0] for value in owners.values())
+    return free_memory
+
+
+def best_fit(free_memory, memory_mb, ngpu=1):
+    ''' `ngpu` GPUs with the least free memory that still fits `memory_mb`, so large holes stay for large jobs. [] if impossible '''
+    gpu_ids = sorted([gpu_id for gpu_id, free in free_memory.items() if free >= memory_mb], key=lambda gpu_id: (free_memory[gpu_id], gpu_id))
+    return gpu_ids[:ngpu] if len(gpu_ids) >= ngpu else []
+
+
+def reserve_best_fit(
+        candidate_gpu_ids,
+        memory_total,
+        memory_mb,
+        ngpu,
+        owner,
+        assign_interval_s,
+        whole_gpu_ids=(),
+        lock_file='~/.gpu_wait.lock',
+        reservation_file='~/.gpu_memory_reservations.json',
+):
+    '''
+    Pick `ngpu` GPUs with `best_fit` and reserve `memory_mb` on each under one lock, so runners of a host never fill the same hole twice.
+    `whole_gpu_ids` are free GPUs the caller holds with `try_get_available_gpu`. [] if the job does not fit (any more).
+    '''
+    if _allocator is not None:
+        return _allocator.reserve_best_fit(candidate_gpu_ids, memory_total, memory_mb, ngpu, owner, assign_interval_s, whole_gpu_ids)
+    lock_file = os.path.expanduser(lock_file)
+    reservation_file = os.path.expanduser(reservation_file)
+    os.makedirs(os.path.dirname(reservation_file), exist_ok=True)
+    os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+    with Lock(lock_file):
+        reservations = _load_memory_reservations(reservation_file, assign_interval_s)
+        free_memory = {}
+        for gpu_id, owners in reservations.items():
+            if int(gpu_id) in memory_total and (len(candidate_gpu_ids) == 0 or int(gpu_id) in candidate_gpu_ids):
+                free_memory[int(gpu_id)] = memory_total[int(gpu_id)] - sum(value[0] for value in owners.values())
+        free_memory.update({gpu_id: memory_total[gpu_id] for gpu_id in whole_gpu_ids if gpu_id in memory_total and gpu_id not in free_memory})
+        gpu_ids = best_fit(free_memory, memory_mb, ngpu)
+        if len(gpu_ids) == 0:
+            return []
+        for gpu_id in gpu_ids:
+            reservations.setdefault(str(gpu_id), {})[owner] = [memory_mb, time.time()]
+        with open(reservation_file, 'w') as f:
+            json.dump(reservations, f)
+    return gpu_ids
+
+
+def reserve_gpu_memory(
+        gpu_ids,
+        memory_mb,
+        owner,
+        assign_interval_s,
+        lock_file='~/.gpu_wait.lock',
+        reservation_file='~/.gpu_memory_reservations.json',
+):
+    if _allocator is not None:
+        return _allocator.reserve_memory(gpu_ids, memory_mb, owner, assign_interval_s)
+    lock_file = os.path.expanduser(lock_file)
+    reservation_file = os.path.expanduser(reservation_file)
+    os.makedirs(os.path.dirname(reservation_file), exist_ok=True)
+    os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+    with Lock(lock_file):
+        reservations = _load_memory_reservations(reservation_file, assign_interval_s)
+        for gpu_id in gpu_ids:
+            reservations.setdefault(str(gpu_id), {})[owner] = [memory_mb, time.time()]
+        with open(reservation_file, 'w') as f:
+            json.dump(reservations, f)
+
+
+def release_gpu_memory(
+        owner,
+        lock_file='~/.gpu_wait.lock',
+        reservation_file='~/.gpu_memory_reservations.json',
+):
+    if _allocator is not None:
+        return _allocator.release_memory(owner)
+    lock_file = os.path.expanduser(lock_file)
+    reservation_file = os.path.expanduser(reservation_file)
+    os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+    with Lock(lock_file):
+        if not os.path.exists(reservation_file):
+            return
+        with open(reservation_file, 'r') as f:
+            reservations = json.load(f)
+        for owners in reservations.values():
+            owners.pop(owner, None)
+        reservations = {gpu_id: owners for gpu_id, owners in reservations.items() if len(owners) > 0}
+        with open(reservation_file, 'w') as f:
+            json.dump(reservations, f)
+
+
 def get_available_gpu(candidate_gpu_ids=set(),
                       assign_interval_s=60,
                       max_memory_used=0.001,
@@ -100,7 +478,7 @@ def get_available_gpu(candidate_gpu_ids=set(),
                       sleep_interval_s=30,
                       wait=True,
                       ngpu=1):
-    if len(GPUtil.getGPUs()) == 0:
+    if _allocator is None and len(get_snapshot().ids) == 0:
         return []
     gpu_ids = []
     flg = False
@@ -141,12 +519,18 @@ if __name__ == '__main__':
     parser.add_argument('--no-wait', action='store_true', default=False, help='')
     parser.add_argument('--max-memory-used', type=float, default=0.001, help='指定%以上メモリを使用している GPU は使わない')
     parser.add_argument('--n-gpu', type=int, default=1)
+    parser.add_argument('--allocator',
+                        type=str,
+                        default=None,
+                        help='allocator.py のソケット（指定時は history/lock ファイルを使わない）')
 
     args = parser.parse_args()
 
     sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
 
     candidate_gpu_ids = set(map(int, args.gpus.split(','))) if len(args.gpus) > 0 else set()
+    if args.allocator:
+        use_allocator(args.allocator)
 
     gpu_ids = get_available_gpu(
         candidate_gpu_ids,
@@ -0,0 +1,72 @@
+import sys, datetime
+import timing
+from db import TERMINAL_STATUSES, JobRepository, Migrator, add_database_arguments, explain_hot_queries, now, open_database
+from estimator import quantile
+from model import JobStatus
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    add_database_arguments(parser)
+    subparsers = parser.add_subparsers(dest='subcommand', required=True)
+    subparsers.add_parser('status', help='show applied and pending schema migrations')
+    migrate_parser = subparsers.add_parser('migrate', help='apply pending schema migrations')
+    migrate_parser.add_argument('--target', type=int, default=None, help='stop at this schema version')
+    subparsers.add_parser('explain', help='check that scheduler / watcher queries use their indexes')
+    archive_parser = subparsers.add_parser('archive', help='move old finished / failed / canceled jobs to jobs_archive')
+    archive_parser.add_argument('--older-than-days', type=float, default=30)
+    archive_parser.add_argument('--batch-size', type=int, default=500)
+    archive_parser.add_argument('--prune-events-days', type=float, default=7, help='also delete job_events every subscriber has consumed')
+    cancel_parser = subparsers.add_parser('cancel', help='cancel jobs; runners stop them and their after-ok dependents are canceled too')
+    cancel_parser.add_argument('ids', type=int, nargs='+')
+    phases_parser = subparsers.add_parser('phases', help='how long jobs spend in each phase, from queue wait to cleanup')
+    phases_parser.add_argument('--since-days', type=float, default=7)
+    phases_parser.add_argument('--daily', action='store_true', help='also print p50 / p90 per day to follow a trend')
+    args = parser.parse_args()
+
+    db = open_database(args)
+    migrator = Migrator(db)
+
+    if args.subcommand == 'status':
+        print('schema version: {}'.format(migrator.current_version()))
+        for migration in migrator.pending():
+            print('pending: {} {}'.format(migration.version, migration.description))
+    elif args.subcommand == 'migrate':
+        for migration in migrator.upgrade(args.target):
+            print('applied: {} {}'.format(migration.version, migration.description))
+        print('schema version: {}'.format(migrator.current_version()))
+    elif args.subcommand == 'explain':
+        results = explain_hot_queries(db)
+        for result in results:
+            print('{} {}: key={} expected={} ({})'.format('OK' if result['ok'] else 'NG', result['name'], result['key'], result['expected'],
+                                                          result['extra']))
+        if not all(result['ok'] for result in results):
+            sys.exit(1)
+    elif args.subcommand == 'archive':
+        repo = JobRepository(db)
+        archived = repo.archive(datetime.timedelta(days=args.older_than_days), batch_size=args.batch_size)
+        print('archived: {} jobs'.format(archived))
+        pruned = repo.prune_events(datetime.timedelta(days=args.prune_events_days))
+        print('pruned: {} events'.format(pruned))
+    elif args.subcommand == 'cancel':
+        repo = JobRepository(db)
+        for job in repo.get_many(args.ids):
+            if job.status not in TERMINAL_STATUSES:
+                job = repo.update(job.id, status=JobStatus.Cancel)
+            print('{}\t{}\t{}'.format(job.id, job.status, job.command))
+    elif args.subcommand == 'phases':
+        repo = JobRepository(db)
+        durations = {}  # phase -> [seconds]
+        daily = {}  # (phase, date) -> [seconds]
+        for row in repo.get_phases_since(now(repo.tz) - datetime.timedelta(days=args.since_days)):
+            durations.setdefault(row['phase'], []).append(row['duration_s'])
+            daily.setdefault((row['phase'], row['started_at'].date()), []).append(row['duration_s'])
+        for phase in sorted(durations, key=lambda phase: timing.PHASES.index(phase) if phase in timing.PHASES else len(timing.PHASES)):
+            values = sorted(durations[phase])
+            print('{}: n={} p50={:.2f}s p90={:.2f}s p99={:.2f}s max={:.2f}s'.format(phase, len(values), quantile(values, 0.5), quantile(values, 0.9),
+                                                                                    quantile(values, 0.99), values[-1]))
+            print(timing.format_histogram(values))
+            if args.daily:
+                for (_, date), day_values in sorted(item for item in daily.items() if item[0][0] == phase):
+                    day_values = sorted(day_values)
+                    print('  {} n={} p50={:.2f}s p90={:.2f}s'.format(date, len(day_values), quantile(day_values, 0.5), quantile(day_values, 0.9)))
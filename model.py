@@ -1,14 +1,17 @@
 from typing import NamedTuple, Optional
 from enum import Enum
+import datetime
 
 
 class JobStatus(Enum):
     Queue = 'QUEUE'
+    Wait = 'Wait'  # queued once its dependencies are done
     Running = 'Running'
     Finish = 'Finish'
     Fail = 'Fail'
     Cancel = 'Cancel'
     Stop = 'Stop'
+    Expanded = 'Expanded'  # array job whose tasks are all created
 
     def translate(self, escape_table):
         return self.value
@@ -25,16 +28,39 @@ class Job(NamedTuple):
     message: str = ''
     priority: int = 10
     num_gpu: int = 1
+    gpu_memory_mb: int = 0  # per GPU. 0: whole GPUs, otherwise GPUs may be shared with other such jobs
     required_labels: str = ''
     executor: str = ''
+    expected_runtime_s: int = 0
+    preemptible: bool = False  # a higher priority job may signal, stop and requeue it
+    array_size: int = 0  # > 0: array job, see JobRepository.create_array
+    array_next: int = 0
+    after_ok: str = ''  # comma separated ids of jobs that must finish first; the job is canceled if one of them doesn't
+    after_any: str = ''  # comma separated ids of jobs that must end first, however they end
     #
     gpu_ids: str = ''
     host: str = ''
     run_id: str = ''
+    started_at: datetime.datetime = None
+    queued_at: datetime.datetime = None  # last time the job was queued; queue wait counts from here
+    assigned_runner: Optional[int] = None  # set by dispatcher.py
+    array_parent: Optional[int] = None  # tasks of array jobs
+    array_index: Optional[int] = None
+    unmet_dependencies: int = 0
+    gpu_samples: int = 0  # GPU utilization samples taken while running, summarized below
+    gpu_util_mean: float = 0.0
+    gpu_util_p95: float = 0.0
+    gpu_memory_peak_mb: int = 0
+    gpu_idle: bool = False  # its GPUs stayed idle for runner.py --idle-gpu-after-s
     #
     id: int = None
-    created_at: str = None
-    updated_at: str = None
+    created_at: datetime.datetime = None
+    updated_at: datetime.datetime = None
+
+    @classmethod
+    def from_row(cls, row: dict) -> 'Job':
+        ''' Fields whose column was not selected are None, so writing a partially loaded job back leaves them untouched '''
+        return cls(**{field: row.get(field) for field in cls._fields})
 
 
 class RunnerStatus(Enum):
@@ -53,7 +79,17 @@ class Runner(NamedTuple):
     gpu_ids: str = ''
     labels: str = ''
     status: RunnerStatus = RunnerStatus.Running
+    wakeup_address: str = ''
+    dispatch: bool = False  # claims only jobs dispatcher.py assigned to it
+    free_gpus: int = 0
     #
     id: int = None
-    created_at: str = None
-    updated_at: str = None
+    created_at: datetime.datetime = None
+    updated_at: datetime.datetime = None
+
+
+class JobEvent(NamedTuple):
+    id: int = None
+    job_id: int = None
+    status: str = ''
+    created_at: datetime.datetime = None
@@ -1,45 +1,110 @@
-import pymysql
-from db import JobRepository
+import sys, itertools
+from db import JobRepository, RunnerRepository, add_database_arguments, open_database
 from model import Job, JobStatus
+import util
+import wakeup
+
+
+def read_commands(path):
+    ''' one command per line, `-` reads stdin. Empty lines and lines starting with # are skipped. '''
+    f = sys.stdin if path == '-' else open(path, 'r')
+    try:
+        lines = [line.strip() for line in f]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+    return [line for line in lines if len(line) > 0 and not line.startswith('#')]
+
+
+def grid_params(grid):
+    ''' every combination of `key=v1,v2,...` in `grid` as a dict '''
+    keys = [param.split('=', 1)[0] for param in grid]
+    values = [param.split('=', 1)[1].split(',') for param in grid]
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+
+def expand_grid(commands, grid):
+    ''' replace `{key}` in each command with every combination of `key=v1,v2,...` in `grid` '''
+    return [util.render_command(command, params) for command in commands for params in grid_params(grid)]
+
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(prefix_chars='+')
-    parser.add_argument('++command', type=str, nargs='+', required=True)
+    command_group = parser.add_mutually_exclusive_group(required=True)
+    command_group.add_argument('++command', type=str, nargs='+')
+    command_group.add_argument('++file', type=str, help='push one job per line of this file (`-` for stdin)')
+    parser.add_argument('++grid', type=str, nargs='+', default=[], help='key=v1,v2,... push one job per combination, replacing {key} in commands')
     parser.add_argument('++repo-url', type=str, required=True)
     parser.add_argument('++commit-hash', type=str, required=True)
     parser.add_argument('++priority', type=int, default=5)
     parser.add_argument('++labels', type=str, nargs='+')
+    parser.add_argument('++preemptible',
+                        action='store_true',
+                        help='may be signaled (SIGUSR1 by default), stopped and requeued for higher priority jobs')
     parser.add_argument('++num-gpu', type=int, default=1)
-    parser.add_argument('++host', default='localhost')
-    parser.add_argument('++user', default='jobmanager')
-    parser.add_argument('++password', default='jobmanager')
-    parser.add_argument('++database', default='jobmanage_py')
+    parser.add_argument('++gpu-memory-mb',
+                        type=int,
+                        default=0,
+                        help='GPU memory needed per GPU; the job may share GPUs with other such jobs (0: whole GPUs)')
+    parser.add_argument('++expected-runtime-s',
+                        type=int,
+                        default=0,
+                        help='upper bound of the runtime; lets the job start early in GPUs reserved for a larger job')
+    parser.add_argument('++after-ok', type=int, nargs='+', default=[], help='job ids that must finish first; canceled if one of them fails')
+    parser.add_argument('++after-any', type=int, nargs='+', default=[], help='job ids that must end first, however they end')
+    add_database_arguments(parser, prefix='++')
+    parser.add_argument('++array', action='store_true', help='push the commands as one array job; its tasks are created as runners claim them')
+    parser.add_argument('++array-size', type=int, default=0, help='push ++command as an array job of this many tasks, {index} is the task index')
     parser.add_argument('+n', '++no-push', action='store_true')
+    parser.add_argument('++no-wakeup', action='store_true', help='do not ping idle runners; they find the jobs on their next poll')
     args = parser.parse_args()
 
+    for param in args.grid:
+        if '=' not in param or param.split('=', 1)[1] == '':
+            parser.error('++grid expects key=v1,v2,...: {}'.format(param))
+    if args.array_size > 0 and not args.command:
+        parser.error('++array-size needs ++command')
+    if args.array_size > 0 and args.grid:
+        parser.error('++array-size can not be combined with ++grid; use ++array ++grid for one task per combination')
+    commands = [' '.join(args.command)] if args.command else read_commands(args.file)
+    commands = expand_grid(commands, args.grid)
+    if args.array_size > 0:
+        commands = [util.render_command(commands[0], {'index': index}) for index in range(args.array_size)]
+
     if args.no_push:
-        print(' '.join(args.command))
+        print('\n'.join(commands))
         exit(0)
 
-    db = connection = pymysql.connect(
-        host=args.host,
-        user=args.user,
-        password=args.password,
-        database=args.database,
-        cursorclass=pymysql.cursors.DictCursor,
-        autocommit=True,
-    )
+    db = open_database(args)
     repo = JobRepository(db)
-    res = repo.create(
+    jobs = [
         Job(
             repo_url=args.repo_url,
             commit_hash=args.commit_hash,
             status=JobStatus.Queue,
-            command=' '.join(args.command),
+            command=command,
             required_labels=','.join(args.labels) if args.labels else '',
             priority=args.priority,
             executor='python_venv',
             num_gpu=args.num_gpu,
-        ))
-    print(res)
\ No newline at end of file
+            gpu_memory_mb=args.gpu_memory_mb,
+            expected_runtime_s=args.expected_runtime_s,
+            preemptible=args.preemptible,
+            after_ok=','.join(map(str, args.after_ok)),
+            after_any=','.join(map(str, args.after_any)),
+        ) for command in commands
+    ]
+    if args.array_size > 0:
+        print(repo.create_array(jobs[0]._replace(command=' '.join(args.command)), size=args.array_size))
+    elif args.array and args.command:
+        print(repo.create_array(jobs[0]._replace(command=' '.join(args.command)), grid_params(args.grid)))
+    elif args.array:
+        print(repo.create_array(jobs[0]._replace(command='{command}'), [{'command': command} for command in commands]))
+    elif args.command and len(jobs) == 1:
+        print(repo.create(jobs[0]))
+    else:
+        for job in repo.create_many(jobs):
+            print('{}\t{}'.format(job.id, job.command))
+    if not args.no_wakeup:
+        wakeup.notify(RunnerRepository(db).get_wakeup_addresses())
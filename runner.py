@@ -1,14 +1,21 @@
-import threading, importlib, os, uuid, shutil, signal, typing, signal, queue, socket, time
+import threading, importlib, os, uuid, shutil, signal, typing, signal, queue, socket, time, datetime
 import traceback
-import pymysql
 
-from db import JobRepository, RunnerRepository
+from db import DEFAULT_MAX_MESSAGE_BYTES, Backend, JobRepository, RunnerRepository, add_database_arguments, now, open_database
 from model import Job, JobStatus, Runner, RunnerStatus
 from executors.executor import Executor
 import gitrepo
 import util
 import gpu
 from display import Display
+from wakeup import WakeupListener, notify
+from scheduler import Policy
+from estimator import RuntimeEstimator
+import topology
+import affinity
+import timing
+
+GPU_ASSIGN_INTERVAL_S = 60 * 60 * 24 * 10  # reservations of a runner killed without releasing them expire after this
 
 
 def load_executor(executor):
@@ -19,26 +26,41 @@ def load_executor(executor):
 
 class WrapExecutor(threading.Thread):
     ''' Execute `job` with `job.executor` '''
-    def __init__(self, job_repo: JobRepository, job: Job, finish_que: queue.Queue, temp_dir_root: str, repo_cache_dir: str, trash_dir_root: str):
+    def __init__(self,
+                 job_repo: JobRepository,
+                 job: Job,
+                 finish_que: queue.Queue,
+                 temp_dir_root: str,
+                 repo_cache_dir: str,
+                 trash_dir_root: str,
+                 cpu_ids: typing.List[int] = [],
+                 spans: typing.Optional[timing.Spans] = None):
         super().__init__()
         self.job_repo = job_repo
         self.job = job
         self.temp_dir_root = temp_dir_root
         self.trash_dir_root = trash_dir_root
         self.repo_cache_dir = repo_cache_dir
+        self.cpu_ids = cpu_ids
         self.executor: Executor = None
         self.stdout_path = None
         self.stderr_path = None
         self.finish_que = finish_que
         self.result: str = None
         self.should_resume = False
+        self.preempted = False
+        self.executed = False  # the job command has exited
+        self.exited_before_preempt = False
         self.finished = False
+        self.spans = spans or timing.Spans()
+        self.gpu_usage = gpu.GpuUsage([int(gpu_id) for gpu_id in job.gpu_ids.split(',') if gpu_id])
 
     def render(self) -> str:
         if self.stderr_path is None or self.stdout_path is None or self.finished:
             return ''
         with open(self.stderr_path, 'r') as stderr, open(self.stdout_path, 'r') as stdout:
-            result = '[Standard Error]\n' + stderr.read()
+            result = '[{}]\n\n'.format(self.gpu_usage.format())
+            result += '[Standard Error]\n' + stderr.read()
             result += '\n\n[Standard Out]\n' + stdout.read()
         return result
 
@@ -53,15 +75,20 @@ class WrapExecutor(threading.Thread):
         with open(self.stdout_path, 'w') as stdout, open(self.stderr_path, 'w') as stderr:
             try:
                 self.job_repo.update(self.job.id, run_id=os.path.basename(temp_dir))
-                self.executor = load_executor(self.job.executor)(self.job, temp_dir, self.temp_dir_root, stdout, stderr)
-                gitrepo.clone_git_repository(self.job.repo_url, self.job.commit_hash, os.path.join(temp_dir, 'src'), self.repo_cache_dir)
-                self.executor.prepare()
+                self.executor = load_executor(self.job.executor)(self.job, temp_dir, self.temp_dir_root, stdout, stderr, cpu_ids=self.cpu_ids)
+                with self.spans.span('clone'):
+                    gitrepo.clone_git_repository(self.job.repo_url, self.job.commit_hash, os.path.join(temp_dir, 'src'), self.repo_cache_dir)
+                with self.spans.span('prepare'):
+                    self.executor.prepare()
                 try:
-                    self.executor.execute()
+                    with self.spans.span('execute'):
+                        self.executor.execute()
                 except Exception as e:
                     execute_error = e
                 finally:
-                    self.executor.cleanup()
+                    self.executed = True
+                    with self.spans.span('cleanup'):
+                        self.executor.cleanup()
             except Exception as e:
                 other_error = e
             finally:
@@ -74,8 +101,9 @@ class WrapExecutor(threading.Thread):
                     if other_error is not None:
                         result += '\n\n[other error message]\n' + str(other_error)
                 self.finished = True
-                os.makedirs(self.trash_dir_root, exist_ok=True)
-                shutil.move(temp_dir, self.trash_dir_root)
+                with self.spans.span('cleanup'):
+                    os.makedirs(self.trash_dir_root, exist_ok=True)
+                    shutil.move(temp_dir, self.trash_dir_root)
         self.result = result
         self.finish_que.put(self.job.id)
 
@@ -84,12 +112,23 @@ class WrapExecutor(threading.Thread):
         if self.executor:
             self.executor.kill()
 
+    def preempt(self, signum: int):
+        ''' ask the job to checkpoint. It is requeued however it exits, unless it had already exited before the signal. '''
+        self.preempted = True
+        self.exited_before_preempt = self.executed
+        self.should_resume = True
+        if self.executor:
+            try:
+                self.executor.signal(signum)
+            except NotImplementedError:
+                ...
+
 
 class ExecutorManager():
     def __init__(
             self,
             display: Display,
-            db: pymysql.Connection,
+            db: Backend,
             available_gpu_ids: typing.List[int],
             temp_dir_root: str,
             repo_cache_dir: str,
@@ -97,10 +136,24 @@ class ExecutorManager():
             max_parallel: int,
             labels: typing.List[str],
             name: str = socket.gethostname(),
+            max_message_bytes: int = DEFAULT_MAX_MESSAGE_BYTES,
+            archive_after: typing.Optional[datetime.timedelta] = None,
+            wakeup: typing.Optional[WakeupListener] = None,
+            idle_poll_s: float = 60,
+            policy: typing.Optional[Policy] = None,
+            gpu_topology: typing.Optional[topology.Topology] = None,
+            cpu_allocator: typing.Optional[affinity.CpuAllocator] = None,
+            preempt_signal: typing.Optional[int] = None,
+            preempt_grace_s: float = 300,
+            dispatch: bool = False,
+            estimator: typing.Optional[RuntimeEstimator] = None,
+            idle_gpu_threshold: float = 0.05,
+            idle_gpu_after_s: typing.Optional[float] = None,
+            idle_gpu_action: str = 'flag',
     ):
         self.display = display
         self.db = db
-        self.repo = JobRepository(self.db)
+        self.repo = JobRepository(self.db, max_message_bytes=max_message_bytes, policy=policy)
         self.runner_repo = RunnerRepository(self.db)
         self.active_executors: typing.Dict[int, WrapExecutor] = {}  # Job.id ->
         self.finished_executors_queue = queue.Queue()
@@ -116,9 +169,36 @@ class ExecutorManager():
             gpu_ids=','.join(list(map(str, self.available_gpu_ids))),
             labels=','.join(labels),
             status=RunnerStatus.Running,
+            wakeup_address=wakeup.address if wakeup else '',
+            dispatch=dispatch,
         )
+        self.free_gpus = 0  # reported to dispatcher.py
         self.finish_flg = False
         self.finished_jobs = []
+        self.archive_after = archive_after
+        self.archive_interval_s = 60 * 60
+        self.last_archive_time = 0
+        self.archive_thread: typing.Optional[threading.Thread] = None
+        self.archive_error = ''  # traceback of the last failed archive run, shown on the top page
+        # without a wakeup channel every loop claims, as before
+        self.wakeup = wakeup
+        self.idle_poll_s = idle_poll_s
+        self.idle_claim_state = None
+        self.last_claim_time = 0
+        self.gpu_topology = gpu_topology
+        self.cpu_allocator = cpu_allocator
+        # preemption is off without a signal
+        self.preempt_signal = preempt_signal
+        self.preempt_grace_s = preempt_grace_s
+        self.preempting: typing.Dict[int, float] = {}  # Job.id -> when to stop it
+        self.estimator = estimator
+        self.last_estimate_time = 0
+        self.next_job_eta = None  # (job, expected start, expected finish)
+        self.claim_spans: typing.Dict[int, timing.Spans] = {}  # Job.id -> phases timed before the job starts
+        # jobs whose GPUs stay below the threshold for idle_gpu_after_s are flagged, and requeued once with 'requeue'
+        self.idle_gpu_threshold = idle_gpu_threshold
+        self.idle_gpu_after_s = idle_gpu_after_s
+        self.idle_gpu_action = idle_gpu_action
         self.display.render_toppage = self._render
 
     def run(self):
@@ -135,7 +215,11 @@ class ExecutorManager():
             sleep_time = 10
             self._handle_finished_jobs()
             self._check_active_job_status()
+            self._check_preemption()
+            self._sample_gpu_usage()
             self._sync_runner_status()
+            self._archive_jobs()
+            self._update_estimates()
             if self.finish_flg or self.runner.status == RunnerStatus.Stop.value:
                 self._kill_executors()
                 sleep_time = 10
@@ -147,7 +231,13 @@ class ExecutorManager():
             self.display.update_toppage()
         for i in range(int(sleep_time / 0.1)):
             self.display.render()
-            time.sleep(0.01)
+            if not self.finished_executors_queue.empty():
+                break
+            if self.wakeup is None:
+                time.sleep(0.01)
+            elif self.wakeup.wait(0.01):
+                self.idle_claim_state = None
+                break
 
     def _kill_executors(self):
         for executor in self.active_executors.values():
@@ -155,23 +245,113 @@ class ExecutorManager():
 
     def _get_next_job(self) -> typing.Optional[Job]:
         if len(self.active_executors) >= self.max_parallel or self.runner.status != RunnerStatus.Running.value:
+            self.free_gpus = 0
             return None
+        spans = timing.Spans()
         # acquire all free GPUs and release no-needs after get next job
-        available_gpu_ids = gpu.try_get_available_gpu(self.available_gpu_ids, 60 * 60 * 24 * 10)
+        with spans.span('gpu_allocation'):
+            available_gpu_ids = gpu.try_get_available_gpu(self.available_gpu_ids, GPU_ASSIGN_INTERVAL_S)
+        self.free_gpus = len(available_gpu_ids)
         required_gpu_ids = []
         try:
-            job = self.repo.pop_next_job(max_gpu_available=len(available_gpu_ids), labels=self.labels)
+            # jobs with gpu_memory_mb may share GPUs already shared or take free ones
+            with spans.span('gpu_allocation'):
+                memory_total = gpu.get_gpu_memory_total()
+                free_memory = gpu.get_shared_gpu_memory(self.available_gpu_ids, memory_total, GPU_ASSIGN_INTERVAL_S)
+            free_memory.update({gpu_id: memory_total[gpu_id] for gpu_id in available_gpu_ids if gpu_id in memory_total and gpu_id not in free_memory})
+            # an idle runner claims only when something was queued or its resources changed, and every idle_poll_s anyway
+            claim_state = (self.repo.queue_version(), tuple(sorted(available_gpu_ids)), tuple(sorted(free_memory.items())),
+                           tuple(self.labels)) if self.wakeup else None
+            if claim_state is not None and claim_state == self.idle_claim_state and time.time() - self.last_claim_time < self.idle_poll_s:
+                return None
+            self.last_claim_time = time.time()
+            with spans.span('claim'):
+                job = self.repo.pop_next_job(max_gpu_available=len(available_gpu_ids),
+                                             labels=self.labels,
+                                             total_gpus=len(self.available_gpu_ids) or None,  # empty: all GPUs of the host
+                                             running=[executor.job for executor in self.active_executors.values()],
+                                             free_memory_mb=list(free_memory.values()),
+                                             assigned_runner=self.runner.id if self.runner.dispatch else None)
+            self.idle_claim_state = claim_state if job is None else None
+            if job is None and self.preempt_signal is not None:
+                self._preempt(len(available_gpu_ids))
             if job is not None:
-                required_gpu_ids = available_gpu_ids[:job.num_gpu]
-                job = job._replace(gpu_ids=','.join(list(map(str, required_gpu_ids))), host=self.name)
-                self.repo.update(**job._asdict())
+                with spans.span('gpu_allocation'):
+                    if job.gpu_memory_mb:
+                        # reserved before the free GPUs are released below, so no one takes a chosen GPU whole meanwhile
+                        gpu_ids = gpu.reserve_best_fit(self.available_gpu_ids, memory_total, job.gpu_memory_mb, job.num_gpu, self._gpu_owner(job),
+                                                       GPU_ASSIGN_INTERVAL_S, available_gpu_ids)
+                    else:
+                        gpu_ids = required_gpu_ids = self._place(available_gpu_ids, job.num_gpu)
+                if len(gpu_ids) < job.num_gpu or (job.gpu_memory_mb and len(gpu_ids) == 0):
+                    # another runner of this host filled the shared GPUs since free_memory was read, or too few GPUs are free
+                    self.repo.update(job.id, status=JobStatus.Queue)
+                    return None
+                # reported to the dispatcher before the next claim updates it
+                self.free_gpus -= len(set(gpu_ids) & set(available_gpu_ids))
+                job = job._replace(gpu_ids=','.join(list(map(str, gpu_ids))), host=self.name)
+                self.repo.update(job.id, gpu_ids=job.gpu_ids, host=job.host)
         finally:
             no_need_gpu_ids = set(available_gpu_ids) - set(required_gpu_ids)
-            gpu.release_gpu(list(no_need_gpu_ids))
+            with spans.span('gpu_allocation'):
+                gpu.release_gpu(list(no_need_gpu_ids))
+        if job is not None:
+            queued_at = job.queued_at or job.created_at
+            if queued_at is not None and job.started_at is not None:
+                spans.add('queue_wait', queued_at.replace(tzinfo=self.repo.tz).timestamp(), (job.started_at - queued_at).total_seconds())
+            self.claim_spans[job.id] = spans
         return job
 
+    def _preempt(self, free_gpus: int):
+        ''' signal the fewest lower priority preemptible jobs whose GPUs let the best queued job start '''
+        if len(self.preempting) > 0:
+            return
+        running = [executor.job for executor in self.active_executors.values() if executor.job.preemptible]
+        if len(running) == 0:
+            return
+        job = self.repo.peek_next_job(len(self.available_gpu_ids) or None, self.labels)
+        if job is None or job.gpu_memory_mb:
+            return
+        for victim in self.repo.policy.victims(job, running, free_gpus):
+            self.active_executors[victim.id].preempt(self.preempt_signal)
+            self.preempting[victim.id] = time.time() + self.preempt_grace_s
+
+    def _check_preemption(self):
+        # victims leave active_executors when they exit; the ones still running after the grace period are stopped
+        for id, deadline in list(self.preempting.items()):
+            if id not in self.active_executors:
+                del self.preempting[id]
+            elif time.time() > deadline:
+                self.active_executors[id].kill(resume=True)
+
+    def _sample_gpu_usage(self):
+        snapshot = gpu.get_snapshot()
+        for executor in self.active_executors.values():
+            executor.gpu_usage.add(snapshot, self.idle_gpu_threshold)
+            if self.idle_gpu_after_s is None or executor.job.gpu_idle or executor.gpu_usage.idle_s() < self.idle_gpu_after_s:
+                continue
+            # a requeued job is flagged already, so it is requeued only once
+            executor.job = executor.job._replace(gpu_idle=True)
+            self.repo.update(executor.job.id, gpu_idle=True)
+            if self.idle_gpu_action == 'requeue':
+                executor.kill(resume=True)
+
+    def _place(self, available_gpu_ids: typing.List[int], num_gpu: int) -> typing.List[int]:
+        if num_gpu > len(available_gpu_ids) or num_gpu <= 0:
+            return []
+        if self.gpu_topology is None:
+            return available_gpu_ids[:num_gpu]
+        return self.gpu_topology.select(available_gpu_ids, num_gpu)
+
+    def _gpu_owner(self, job: Job) -> str:
+        return '{}:{}'.format(self.name, job.id)
+
     def _start_job(self, job: Job):
-        executor = WrapExecutor(self.repo, job, self.finished_executors_queue, self.temp_dir_root, self.repo_cache_dir, self.trash_dir_root)
+        cpu_ids = []
+        if self.cpu_allocator is not None:
+            cpu_ids = self.cpu_allocator.allocate(self._gpu_owner(job), [int(gpu_id) for gpu_id in job.gpu_ids.split(',') if gpu_id])
+        executor = WrapExecutor(self.repo, job, self.finished_executors_queue, self.temp_dir_root, self.repo_cache_dir, self.trash_dir_root, cpu_ids,
+                                self.claim_spans.pop(job.id, None))
         executor.start()
         refresh_func, window_id = self.display.add_window(executor.render)
         executor._window_id = window_id
@@ -185,33 +365,47 @@ class ExecutorManager():
             except queue.Empty:
                 break
             executor = self.active_executors[finished_id]
-            if len(executor.job.gpu_ids):
+            if self.cpu_allocator is not None:
+                self.cpu_allocator.release(self._gpu_owner(executor.job))
+            if executor.job.gpu_memory_mb:
+                gpu.release_gpu_memory(self._gpu_owner(executor.job))
+            elif len(executor.job.gpu_ids):
                 gpu_ids = list(map(int, executor.job.gpu_ids.split(',')))
                 gpu.release_gpu(gpu_ids)
             self.display.delete_page(id=executor._window_id)
             del self.active_executors[finished_id]
-            job = self.repo.get(executor.job.id)
-            if executor.result is None:  # success
-                job = job._replace(status=JobStatus.Finish, message='')
+            if executor.preempted and not executor.exited_before_preempt:  # usually checkpointed and exited 0 on the signal
+                status, message = JobStatus.Queue, executor.result or ''
+            elif executor.result is None:  # success
+                status, message = JobStatus.Finish, ''
             else:  # fail
                 if executor.should_resume:
-                    job = job._replace(status=JobStatus.Queue, message=executor.result)
+                    status, message = JobStatus.Queue, executor.result
                 else:
-                    job = job._replace(status=JobStatus.Fail, message=executor.result)
-            self.repo.update(**job._asdict())
+                    status, message = JobStatus.Fail, executor.result
+            version = self.repo.queue_version() if self.wakeup else None
+            job = self.repo.update(executor.job.id, status=status, message=message, **executor.gpu_usage.summary())
+            self.repo.add_phases(job.id, executor.spans.items())
+            # requeued jobs and dependents the job released are claimed by idle runners right away
+            if version is not None and self.repo.queue_version() != version:
+                notify(self.runner_repo.get_wakeup_addresses())
             self.finished_jobs.append(job)
             if len(self.finished_jobs) > 30:
                 self.finished_jobs = self.finished_jobs[len(self.finished_jobs) - 30:]
 
     def _check_active_job_status(self):
+        statuses = self.repo.heartbeat(list(self.active_executors.keys()))
         for id, executor in self.active_executors.items():
-            executor.job = self.repo.update_timestamp(id)
+            executor.job = executor.job._replace(status=statuses.get(id))
             if executor.job.status != JobStatus.Running.value:
                 executor.kill(resume=False)
             executor._window_refresh()
 
     def _sync_runner_status(self):
-        self.runner = self.runner_repo.update_timestamp(self.runner.id)
+        if self.runner.dispatch:
+            self.runner = self.runner_repo.update(self.runner.id, free_gpus=self.free_gpus)
+        else:
+            self.runner = self.runner_repo.update_timestamp(self.runner.id)
         if len(self.runner.gpu_ids) > 0:
             try:
                 available_gpu_ids = set(list(map(int, self.runner.gpu_ids.split(','))))
@@ -222,9 +416,58 @@ class ExecutorManager():
             self.available_gpu_ids = set()
         self.labels = self.runner.labels.split(',')
 
+    def _archive_jobs(self):
+        if self.archive_after is None or time.time() - self.last_archive_time < self.archive_interval_s:
+            return
+        if self.archive_thread is not None and self.archive_thread.is_alive():
+            return  # a slow run is still archiving; checked again next loop
+        self.last_archive_time = time.time()
+        # every runner may archive; concurrent archivers skip each other's rows
+        self.archive_thread = threading.Thread(target=self._archive, daemon=True)
+        self.archive_thread.start()
+
+    def _archive(self):
+        try:
+            self.repo.archive(self.archive_after)
+            self.archive_error = ''
+        except Exception:
+            self.archive_error = traceback.format_exc()
+
+    def _update_estimates(self):
+        ''' learn from newly finished jobs and predict when the next queued job starts and ends here '''
+        if self.estimator is None or time.time() - self.last_estimate_time < self.estimator.refresh_interval_s:
+            return
+        self.last_estimate_time = time.time()
+        self.estimator.refresh(force=True)
+        job = self.repo.peek_next_job(len(self.available_gpu_ids) or None, self.labels)
+        if job is None:
+            self.next_job_eta = None
+            return
+        current_time = now(self.repo.tz)
+        running = [executor.job for executor in self.active_executors.values()]
+        # running jobs end per the policy's runtime hint, see __main__
+        if job.num_gpu <= self.free_gpus:
+            start = current_time
+        else:
+            shadow = self.repo.policy.shadow(job.num_gpu, self.free_gpus, running, current_time)
+            start = shadow[0] if shadow is not None else None
+        runtime = self.estimator.estimate(job, 0.5)
+        finish = start + datetime.timedelta(seconds=runtime) if start is not None and runtime is not None else None
+        self.next_job_eta = (job, start, finish)
+
     def _render(self):
+        def format_time(time: typing.Optional[datetime.datetime]):
+            return time.strftime('%m-%d %H:%M') if time is not None else '?'
+
         def format_job(job: Job):
-            return '* {} {}'.format(job.status, job.command)
+            line = '* {} {}'.format(job.status, job.command)
+            if self.estimator is not None and job.status == JobStatus.Running.value:
+                line += ' (ETA {})'.format(format_time(self.estimator.eta(job, now(self.repo.tz))))
+            if job.id in self.active_executors:
+                line += '\n  ' + self.active_executors[job.id].gpu_usage.format()
+            elif job.gpu_samples:
+                line += '\n  GPU {:.0%} mean, {:.0%} p95, peak {:.1f} GB'.format(job.gpu_util_mean, job.gpu_util_p95, job.gpu_memory_peak_mb / 1024)
+            return line + (' [idle GPU]' if job.gpu_idle else '')
 
         if self.finish_flg:
             status = 'KeyboardInterrupt detected. Killing all {} executors. Please wait.'.format(len(self.active_executors))
@@ -234,6 +477,11 @@ class ExecutorManager():
         gpus = 'GPUs: ' + ', '.join(list(map(str, list(self.available_gpu_ids))))
         running_jobs = '\n\n'.join(list(map(format_job, map(lambda executor: executor.job, self.active_executors.values()))))
         finished_jobs = '\n\n'.join(list(map(format_job, self.finished_jobs)))
+        next_job = ''
+        if self.next_job_eta is not None:
+            job, start, finish = self.next_job_eta
+            next_job = '\n\n[Next Job]\n\n* {} (start {}, ETA {})\n'.format(job.command, format_time(start), format_time(finish))
+        archive_error = '\n\n[Archive Error]\n\n' + self.archive_error if self.archive_error else ''
         return '''
 
 :::GPU Job Runner:::
@@ -245,43 +493,82 @@ class ExecutorManager():
 [Running Jobs]
 
 {}
-
+{}
 
 [Finished Jobs]
 
 {}
-
-'''.format(status, labels, gpus, running_jobs, finished_jobs)
+{}
+'''.format(status, labels, gpus, running_jobs, next_job, finished_jobs, archive_error)
 
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('--host', default='localhost')
-    parser.add_argument('--user', default='jobmanager')
-    parser.add_argument('--password', default='jobmanager')
-    parser.add_argument('--database', default='jobmanage_py')
+    add_database_arguments(parser)
     parser.add_argument('--gpus', type=str, default=None)
     parser.add_argument('--max-gpu-memory-used', type=float, default=0.001)
     parser.add_argument('--temp-dir-root', type=str, default='~/.py-job-runner/tmp')
     parser.add_argument('--trash-dir-root', type=str, default='~/Trash')
     parser.add_argument('--repo-cache-dir', type=str, default='~/.py-job-runner/repo')
     parser.add_argument('--max-parallel', type=int, default=10)
+    parser.add_argument('--db-pool-size', type=int, default=8, help='max number of database connections')
+    parser.add_argument('--archive-after-days',
+                        type=float,
+                        default=0,
+                        help='move finished / failed / canceled jobs to jobs_archive after this (0: never)')
+    parser.add_argument('--max-message-size', type=int, default=DEFAULT_MAX_MESSAGE_BYTES, help='bytes of stderr kept per failed job (the tail)')
     parser.add_argument('--labels', type=str, nargs='+', default=[])
+    parser.add_argument('--wakeup-port', type=int, default=0, help='UDP port push.py pings after enqueueing (0: any free port)')
+    parser.add_argument('--wakeup-host', type=str, default=socket.gethostname(), help='host name push.py uses to reach this runner')
+    parser.add_argument('--no-wakeup', action='store_true', help='poll the queue every loop instead')
+    parser.add_argument('--idle-poll-s', type=float, default=60, help='claim at least this often while idle even without a wakeup')
+    parser.add_argument('--aging-hours', type=float, default=6, help='a queued job gains one priority per this many hours (0: no aging)')
+    parser.add_argument('--no-backfill', action='store_true', help='never start smaller jobs ahead of a job waiting for GPUs')
+    parser.add_argument('--topology-file', type=str, default=None, help='saved `nvidia-smi topo -m` output (default: run it)')
+    parser.add_argument('--no-topology', action='store_true', help='place multi-GPU jobs on the lowest free GPU ids')
+    parser.add_argument('--no-cpu-affinity', action='store_true', help='let jobs run on any CPU with default thread counts')
+    parser.add_argument('--dispatch', action='store_true', help='run only jobs dispatcher.py assigns to this runner')
+    parser.add_argument('--preemption', action='store_true', help='stop preemptible jobs of lower priority when a queued job does not fit')
+    parser.add_argument('--preempt-signal', type=str, default='SIGUSR1', help='sent to the victims so they can checkpoint')
+    parser.add_argument('--preempt-grace-s', type=float, default=300, help='victims still running after this are stopped and requeued')
+    parser.add_argument('--gpu-telemetry', choices=['auto', 'nvml', 'nvidia-smi', 'fixture'], default='auto', help='auto: NVML if installed')
+    parser.add_argument('--gpu-telemetry-fixture', type=str, default=None, help='nvidia-smi CSV read with --gpu-telemetry fixture')
+    parser.add_argument('--gpu-sample-interval-s',
+                        type=float,
+                        default=2,
+                        help='GPU state is sampled this often in the background (by allocator.py with --gpu-allocator)')
+    parser.add_argument('--idle-gpu-threshold', type=float, default=0.05, help='GPU utilization (0-1) below which a job counts as idle')
+    parser.add_argument('--idle-gpu-after-s', type=float, default=0, help='flag jobs idle this long (0: never)')
+    parser.add_argument('--idle-gpu-action', choices=['flag', 'requeue'], default='flag', help='requeue: also stop and requeue them, once')
+    parser.add_argument('--gpu-allocator', type=str, default=None, help='socket of allocator.py; reserve GPUs through it instead of lock files')
+    parser.add_argument('--no-runtime-estimates', action='store_true', help='no ETAs, and backfill only jobs with ++expected-runtime-s')
+    parser.add_argument('--runtime-quantile', type=float, default=0.9, help='quantile of past runtimes the scheduler assumes for jobs without one')
     args = parser.parse_args()
 
     args.temp_dir_root = os.path.expanduser(args.temp_dir_root)
     args.repo_cache_dir = os.path.expanduser(args.repo_cache_dir)
     args.trash_dir_root = os.path.expanduser(args.trash_dir_root)
 
-    db = connection = pymysql.connect(
-        host=args.host,
-        user=args.user,
-        password=args.password,
-        database=args.database,
-        cursorclass=pymysql.cursors.DictCursor,
-        autocommit=True,
-    )
+    db = open_database(args, max_size=args.db_pool_size)
+    if args.gpu_allocator:
+        # GPU state then comes from the allocator's sampler
+        gpu.use_allocator(args.gpu_allocator)
+    else:
+        gpu.start_sampler(gpu.make_source(args.gpu_telemetry, args.gpu_telemetry_fixture), args.gpu_sample_interval_s)
+
+    wakeup = None
+    if not args.no_wakeup:
+        try:
+            wakeup = WakeupListener(port=args.wakeup_port, advertise_host=args.wakeup_host)
+        except OSError as e:
+            print('wakeup channel is unavailable, polling instead:', e)
+
+    gpu_topology = None if args.no_topology else topology.load(args.topology_file)
+    # sysfs knows the NUMA node of each GPU; the topology's NUMA Affinity column is the fallback
+    gpu_numa_nodes = affinity.read_gpu_numa_nodes() or (gpu_topology.numa_node if gpu_topology else {})
+
+    estimator = None if args.no_runtime_estimates else RuntimeEstimator(JobRepository(db), quantile=args.runtime_quantile)
 
     available_gpu_ids = ''
     if args.gpus:
@@ -296,4 +583,20 @@ if __name__ == '__main__':
             args.trash_dir_root,
             args.max_parallel,
             args.labels,
+            max_message_bytes=args.max_message_size,
+            archive_after=datetime.timedelta(days=args.archive_after_days) if args.archive_after_days > 0 else None,
+            wakeup=wakeup,
+            idle_poll_s=args.idle_poll_s,
+            policy=Policy(aging_s=args.aging_hours * 60 * 60,
+                          backfill=not args.no_backfill,
+                          runtime_hint=estimator.runtime_hint if estimator else None),
+            gpu_topology=gpu_topology,
+            cpu_allocator=None if args.no_cpu_affinity else affinity.CpuAllocator(args.max_parallel, gpu_numa_nodes),
+            preempt_signal=signal.Signals[args.preempt_signal] if args.preemption else None,
+            preempt_grace_s=args.preempt_grace_s,
+            dispatch=args.dispatch,
+            estimator=estimator,
+            idle_gpu_threshold=args.idle_gpu_threshold,
+            idle_gpu_after_s=args.idle_gpu_after_s or None,
+            idle_gpu_action=args.idle_gpu_action,
         ).run()
@@ -0,0 +1,111 @@
+import datetime
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from model import Job
+
+
+class Policy():
+    '''
+    Decide which queued job a runner starts.
+
+    Candidates are ranked by priority plus one per `aging_s` seconds spent in the queue, so low priority jobs are not starved.
+    The best ranked job that does not fit in the free GPUs gets a reservation (EASY backfill): a lower ranked job may still
+    start if it is expected to finish before the reserved GPUs are free, or if it only uses GPUs the reserved job won't need.
+    Running jobs without a known runtime are assumed never to finish, so without runtimes the reserved job just blocks.
+    '''
+    def __init__(self, aging_s: float = 6 * 60 * 60, backfill: bool = True, runtime_hint: Optional[Callable[[Job], Optional[float]]] = None):
+        self.aging_s = aging_s
+        self.backfill = backfill
+        self.runtime_hint = runtime_hint
+
+    def runtime_s(self, job: Job) -> Optional[float]:
+        ''' declared runtime, else the hint's estimate '''
+        if job.expected_runtime_s:
+            return float(job.expected_runtime_s)
+        if self.runtime_hint is not None:
+            return self.runtime_hint(job)
+        return None
+
+    def fits(self, job: Job, free_gpus: int, free_memory_mb: Sequence[int]) -> bool:
+        if job.gpu_memory_mb:
+            return sum(1 for free in free_memory_mb if free >= job.gpu_memory_mb) >= job.num_gpu
+        return job.num_gpu <= free_gpus
+
+    def effective_priority(self, job: Job, current_time: datetime.datetime) -> float:
+        if self.aging_s <= 0 or job.created_at is None:
+            return job.priority
+        return job.priority + max(0.0, (current_time - job.created_at).total_seconds()) / self.aging_s
+
+    def rank(self, candidates: Sequence[Job], current_time: datetime.datetime) -> List[Job]:
+        return sorted(candidates, key=lambda job: (-self.effective_priority(job, current_time), job.created_at or current_time, job.id or 0))
+
+    def shadow(self, num_gpu: int, free_gpus: int, running: Sequence[Job],
+               current_time: datetime.datetime) -> Optional[Tuple[datetime.datetime, int]]:
+        ''' (when `num_gpu` GPUs are expected to be free, GPUs left over at that time), None if never '''
+        ends = []
+        for job in running:
+            runtime = self.runtime_s(job)
+            # a shared GPU is freed by its last job, which is not known here
+            if runtime is not None and job.started_at is not None and not job.gpu_memory_mb:
+                ends.append((max(current_time, job.started_at + datetime.timedelta(seconds=runtime)), job.num_gpu))
+        free = free_gpus
+        for end, gpus in sorted(ends, key=lambda end: end[0]):
+            free += gpus
+            if free >= num_gpu:
+                return end, free - num_gpu
+        return None
+
+    def select(self,
+               candidates: Sequence[Job],
+               free_gpus: int,
+               current_time: datetime.datetime,
+               total_gpus: Optional[int] = None,
+               running: Sequence[Job] = (),
+               free_memory_mb: Sequence[int] = ()) -> Optional[Job]:
+        '''
+        `free_gpus` of the runner's `total_gpus` are free and `running` are the runner's own jobs.
+        With `total_gpus` unknown, any job that doesn't fit may be reserved here.
+        Jobs with `gpu_memory_mb` fit in GPUs whose `free_memory_mb` is large enough; they wait without a reservation.
+        '''
+        reservation = None
+        for job in self.rank(candidates, current_time):
+            if total_gpus is not None and job.num_gpu > total_gpus:
+                continue  # never runs on this runner
+            if reservation is None:
+                if self.fits(job, free_gpus, free_memory_mb):
+                    return job
+                if job.gpu_memory_mb:
+                    continue
+                if not self.backfill:
+                    return None
+                reservation = self.shadow(job.num_gpu, free_gpus, running, current_time) or (current_time, 0)
+                continue
+            if not self.fits(job, free_gpus, free_memory_mb):
+                continue
+            shadow_time, extra_gpus = reservation
+            runtime = self.runtime_s(job)
+            if runtime is not None and current_time + datetime.timedelta(seconds=runtime) <= shadow_time:
+                return job
+            if job.num_gpu <= extra_gpus:
+                return job
+        return None
+
+    def victims(self, job: Job, running: Sequence[Job], free_gpus: int) -> List[Job]:
+        '''
+        The fewest preemptible running jobs of lower priority than `job` whose GPUs, with `free_gpus`, let it start.
+        The lowest priority and most recently started (least work lost) go first. [] if no such set exists.
+        '''
+        candidates = [victim for victim in running if victim.preemptible and victim.priority < job.priority and not victim.gpu_memory_mb]
+        candidates.sort(key=lambda victim: (victim.priority, -(victim.started_at.timestamp() if victim.started_at else 0)))
+        victims = []
+        for victim in candidates:
+            if free_gpus + sum(chosen.num_gpu for chosen in victims) >= job.num_gpu:
+                break
+            victims.append(victim)
+        if free_gpus + sum(victim.num_gpu for victim in victims) < job.num_gpu:
+            return []
+        # spare the ones the others already cover
+        for victim in list(victims):
+            if free_gpus + sum(other.num_gpu for other in victims if other is not victim) >= job.num_gpu:
+                victims.remove(victim)
+        return victims
@@ -0,0 +1,57 @@
+from typing import Callable, List, NamedTuple, Optional, Sequence, Tuple, Union
+import importlib
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    # SQL or function(cursor), per backend name
+    mysql: Sequence[Union[str, Callable]] = []
+    sqlite: Sequence[Union[str, Callable]] = []
+
+
+class Backend():
+    '''
+    Storage the repositories run their SQL on.
+    SQL is written with pymysql-style `%s` placeholders and cursors return rows as dicts.
+    '''
+    name = ''
+    # appended to SELECTs that lock the rows they are about to claim
+    skip_locked = ''
+    # appended to SELECTs that lock the rows they read until the transaction ends
+    for_update = ''
+    # bind parameters one statement may carry
+    max_query_params = 999
+
+    def cursor(self):
+        ''' context manager yielding an autocommit cursor '''
+        raise NotImplementedError()
+
+    def transaction(self):
+        ''' context manager yielding a cursor in a write transaction, committed on exit and rolled back on error '''
+        raise NotImplementedError()
+
+    def migration_cursor(self):
+        ''' context manager yielding a cursor no other process migrates with at the same time '''
+        raise NotImplementedError()
+
+    def insert_rows(self, cur, table: str, keys: Sequence[str], rows: Sequence[Sequence]) -> List[int]:
+        ''' INSERT `rows` (values in `keys` order) into `table` and return their auto-increment ids in order '''
+        sql = 'INSERT INTO ' + table + ' (' + ', '.join(keys) + ') VALUES (' + ', '.join(['%s'] * len(keys)) + ')'
+        ids = []
+        # one row per statement: ids of a multi-row INSERT may interleave with other sessions' (innodb_autoinc_lock_mode=2)
+        for row in rows:
+            cur.execute(sql, list(row))
+            ids.append(cur.lastrowid)
+        return ids
+
+    def explain(self, cur, sql: str, params) -> Tuple[Optional[str], str]:
+        ''' (index name used for the first table of `sql`, plan detail) '''
+        raise NotImplementedError()
+
+    def close(self):
+        ...
+
+
+def load_backend(name):
+    return importlib.import_module('storage.' + name).Backend
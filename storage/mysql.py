@@ -0,0 +1,118 @@
+from typing import Optional
+import collections, contextlib, threading, time
+
+import pymysql
+from storage.backend import Backend as Base
+
+
+class ConnectionPool():
+    '''
+    Thread-safe bounded pool of autocommit pymysql connections.
+    Idle connections are pinged (and reconnected) before reuse, and connections that raised a connection error are dropped.
+    '''
+    def __init__(self, max_size: int = 8, ping_interval_s: float = 30, acquire_timeout_s: Optional[float] = None, **connect_kwargs):
+        self.max_size = max_size
+        self.ping_interval_s = ping_interval_s
+        self.acquire_timeout_s = acquire_timeout_s
+        self.connect_kwargs = {'cursorclass': pymysql.cursors.DictCursor, **connect_kwargs, 'autocommit': True}
+        self._idle = collections.deque()  # (connection, last used time)
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def _acquire(self) -> pymysql.connections.Connection:
+        with self._cond:
+            if not self._cond.wait_for(lambda: len(self._idle) > 0 or self._size < self.max_size, self.acquire_timeout_s):
+                raise TimeoutError('no database connection available in {}s'.format(self.acquire_timeout_s))
+            if len(self._idle) > 0:
+                conn, last_used = self._idle.pop()
+            else:
+                conn, last_used = None, None
+                self._size += 1
+        try:
+            if conn is None:
+                conn = pymysql.connect(**self.connect_kwargs)
+            elif not conn.open or time.time() - last_used > self.ping_interval_s:
+                conn.ping(reconnect=True)
+        except Exception:
+            self._discard(conn)
+            raise
+        return conn
+
+    def _release(self, conn: pymysql.connections.Connection):
+        with self._cond:
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def _discard(self, conn: Optional[pymysql.connections.Connection]):
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                ...
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+            self._discard(conn)
+            raise
+        except BaseException:
+            self._release(conn)
+            raise
+        self._release(conn)
+
+    @contextlib.contextmanager
+    def cursor(self):
+        with self.connection() as conn, conn.cursor() as cur:
+            yield cur
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.connection() as conn:
+            conn.begin()
+            try:
+                with conn.cursor() as cur:
+                    yield cur
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def close(self):
+        with self._cond:
+            while len(self._idle) > 0:
+                conn, _ = self._idle.pop()
+                conn.close()
+                self._size -= 1
+
+
+class Backend(ConnectionPool, Base):
+    name = 'mysql'
+    skip_locked = ' FOR UPDATE SKIP LOCKED'
+    for_update = ' FOR UPDATE'
+    max_query_params = 65535
+    migration_lock_name = 'jobmanage_py.schema_migrations'
+    migration_lock_timeout_s = 600
+
+    @contextlib.contextmanager
+    def migration_cursor(self):
+        # DDL commits implicitly, so runners starting together are serialized by a named lock instead of a transaction.
+        # GET_LOCK belongs to the session, so everything runs on one connection.
+        with self.cursor() as cur:
+            cur.execute('SELECT GET_LOCK(%s, %s) AS locked', (self.migration_lock_name, self.migration_lock_timeout_s))
+            if not cur.fetchone()['locked']:
+                raise TimeoutError('could not acquire schema migration lock')
+            try:
+                yield cur
+            finally:
+                cur.execute('SELECT RELEASE_LOCK(%s)', self.migration_lock_name)
+
+    def explain(self, cur, sql: str, params):
+        cur.execute('EXPLAIN ' + sql, params)
+        plan = cur.fetchall()
+        return plan[0]['key'], plan[0]['Extra']
@@ -0,0 +1,135 @@
+import contextlib, datetime, enum, os, re, sqlite3, threading
+from typing import List, Sequence
+from storage.backend import Backend as Base
+
+sqlite3.register_converter('DATETIME', lambda value: datetime.datetime.fromisoformat(value.decode()))
+
+
+def _adapt(value):
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(' ', timespec='microseconds')
+    return value
+
+
+class Cursor():
+    ''' sqlite3 cursor accepting the pymysql-style SQL and params the repositories use '''
+    def __init__(self, cur: sqlite3.Cursor):
+        self.cur = cur
+
+    @staticmethod
+    def _sql(sql: str) -> str:
+        return sql.replace('%s', '?').replace('%%', '%')
+
+    @staticmethod
+    def _params(params):
+        if params is None:
+            return ()
+        if not isinstance(params, (list, tuple)):
+            params = (params, )
+        return [_adapt(value) for value in params]
+
+    def execute(self, sql: str, params=None):
+        self.cur.execute(self._sql(sql), self._params(params))
+
+    def executemany(self, sql: str, seq_of_params):
+        self.cur.executemany(self._sql(sql), [self._params(params) for params in seq_of_params])
+
+    def fetchone(self):
+        row = self.cur.fetchone()
+        return None if row is None else dict(row)
+
+    def fetchall(self):
+        return [dict(row) for row in self.cur.fetchall()]
+
+    @property
+    def lastrowid(self):
+        return self.cur.lastrowid
+
+    @property
+    def rowcount(self):
+        return self.cur.rowcount
+
+
+class Backend(Base):
+    '''
+    Embedded database file in WAL mode. Readers never block, and write transactions start with BEGIN IMMEDIATE,
+    so a claim (SELECT + UPDATE) is atomic across all runner processes sharing the file.
+    '''
+    name = 'sqlite'
+
+    def __init__(self, path: str, busy_timeout_s: float = 60):
+        self.path = os.path.expanduser(path)
+        self.busy_timeout_s = busy_timeout_s
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        with self.cursor() as cur:
+            cur.execute('PRAGMA journal_mode=WAL')
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections are cheap; one per thread avoids sharing a connection across threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=self.busy_timeout_s,
+                isolation_level=None,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+                check_same_thread=False,
+            )
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextlib.contextmanager
+    def cursor(self):
+        cur = self._connection().cursor()
+        try:
+            yield Cursor(cur)
+        finally:
+            cur.close()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            with self.cursor() as cur:
+                yield cur
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def migration_cursor(self):
+        # DDL is transactional in SQLite
+        return self.transaction()
+
+    def insert_rows(self, cur, table: str, keys: Sequence[str], rows: Sequence[Sequence]) -> List[int]:
+        # one multi-row INSERT: writers are serialized, so its rows get consecutive ids ending at lastrowid
+        row_placeholder = '(' + ', '.join(['%s'] * len(keys)) + ')'
+        cur.execute('INSERT INTO ' + table + ' (' + ', '.join(keys) + ') VALUES ' + ', '.join([row_placeholder] * len(rows)),
+                    [value for row in rows for value in row])
+        return list(range(cur.lastrowid - len(rows) + 1, cur.lastrowid + 1))
+
+    def explain(self, cur, sql: str, params):
+        cur.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        # the first table access; compound queries start with a COMPOUND QUERY row
+        detail = [row['detail'] for row in cur.fetchall() if row['detail'].startswith(('SCAN', 'SEARCH'))][0]
+        if re.search(r'USING (?:INTEGER )?PRIMARY KEY', detail):
+            return 'PRIMARY', detail
+        match = re.search(r'USING (?:COVERING )?INDEX (\w+)', detail)
+        return (match.group(1) if match else None), detail
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
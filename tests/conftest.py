@@ -0,0 +1,5 @@
+import os, sys
+
+# the modules live at the top of the repository
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+FIXTURES = os.path.join(os.path.dirname(__file__), '..', 'fixtures')
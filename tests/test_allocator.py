@@ -0,0 +1,56 @@
+import allocator
+
+
+def make_allocator(tmp_path, count=4, memory_mb=16000, state_file=None):
+    # never import the reservations of this host
+    return allocator.Allocator(allocator.FakeDevices(count, memory_mb), state_file, str(tmp_path / 'gpu_history.json'),
+                               str(tmp_path / 'gpu_memory_reservations.json'))
+
+
+def test_acquire_and_release(tmp_path):
+    a = make_allocator(tmp_path)
+    assert a.acquire([], 60, ngpu=2) == [0, 1]
+    assert a.acquire([0, 1, 2], 60) == [2]
+    assert a.acquire([], 60, ngpu=2) == []  # only 3 is left
+    a.release([0])
+    assert a.acquire([], 60) == [0, 3]
+
+
+def test_acquired_gpus_expire(tmp_path):
+    a = make_allocator(tmp_path)
+    assert a.acquire([], 60, ngpu=1) == [0]
+    a.history[0] -= 120  # acquired two minutes ago by a runner that never released it
+    assert a.acquire([], 60, ngpu=1) == [0]
+
+
+def test_reserve_memory(tmp_path):
+    a = make_allocator(tmp_path)
+    a.reserve_memory([3], 10000, 'runner:1', 60)
+    assert a.shared_memory([], a.memory_total(), 60) == {3: 6000}
+    assert 3 not in a.acquire([], 60)  # shared GPUs are never handed out whole
+    a.release_memory('runner:1')
+    assert a.shared_memory([], a.memory_total(), 60) == {}
+
+
+def test_reserve_best_fit_never_overcommits(tmp_path):
+    a = make_allocator(tmp_path, 2)
+    total = a.memory_total()
+    assert a.reserve_best_fit([], total, 10000, 1, 'a', 60, whole_gpu_ids=[0]) == [0]
+    assert a.reserve_best_fit([], total, 5000, 1, 'b', 60) == [0]
+    assert a.reserve_best_fit([], total, 5000, 1, 'c', 60) == []
+    assert a.shared_memory([], total, 60) == {0: 1000}
+
+
+def test_state_survives_restart(tmp_path):
+    state_file = str(tmp_path / 'allocator.json')
+    a = make_allocator(tmp_path, 2, state_file=state_file)
+    a.acquire([], 60, ngpu=1)
+    a.reserve_memory([1], 4000, 'runner:1', 60)
+    restarted = make_allocator(tmp_path, 2, state_file=state_file)
+    assert restarted.acquire([], 60) == []
+    assert restarted.shared_memory([], restarted.memory_total(), 60) == {1: 12000}
+
+
+def test_imports_legacy_files(tmp_path):
+    (tmp_path / 'gpu_history.json').write_text('{"1": 1e12}')  # reserved far in the future, so never expired
+    assert make_allocator(tmp_path, 2).acquire([], 60, ngpu=2) == []
@@ -0,0 +1,29 @@
+import math, os
+import gpu
+from conftest import FIXTURES
+
+
+def load_fixture():
+    with open(os.path.join(FIXTURES, 'telemetry', '8gpu_busy.csv'), 'r') as f:
+        return gpu.parse_nvidia_smi_csv(f.read())
+
+
+def test_parse_nvidia_smi_csv():
+    snapshot = load_fixture()
+    assert list(snapshot.ids) == list(range(8))
+    assert snapshot.memory_total() == {gpu_id: 32510 for gpu_id in range(8)}
+    assert snapshot.utilization[0] == 0.97
+    assert math.isnan(snapshot.memory_used_mb[6]) and math.isnan(snapshot.utilization[6])
+
+
+def test_available_skips_busy_and_unknown_gpus():
+    # 0, 1 and 4 are busy, 6 reads [N/A]
+    assert load_fixture().available() == [2, 3, 5, 7]
+
+
+def test_sampler_serves_fixture():
+    sampler = gpu.TelemetrySampler(gpu.fixture_source(os.path.join(FIXTURES, 'telemetry', '8gpu_busy.csv')), interval_s=60).start()
+    try:
+        assert sampler.get().available() == [2, 3, 5, 7]
+    finally:
+        sampler.stop()
@@ -0,0 +1,35 @@
+import os
+import topology
+from conftest import FIXTURES
+
+
+def load(name):
+    return topology.load(os.path.join(FIXTURES, 'topology', name))
+
+
+def test_parse_dgx1():
+    t = load('dgx1.txt')
+    assert t.gpu_ids == list(range(8))
+    assert t.links[0, 3] == 'NV2' and t.links[0, 1] == 'NV1' and t.links[0, 5] == 'SYS'
+    assert t.links[0, 3] == t.links[3, 0]
+    assert t.cpu_affinity[0] == '0-19,40-59' and t.cpu_affinity[7] == '20-39,60-79'
+
+
+def test_select_prefers_nvlink():
+    t = load('dgx1.txt')
+    assert t.select(t.gpu_ids, 2) == [0, 3]  # NV2
+    assert t.select(t.gpu_ids, 4) == [0, 1, 2, 3]  # one NVLink clique
+    assert t.select([0, 1, 2, 4], 2) == [0, 4]
+    assert t.select([0, 5], 1) == [0]
+    assert t.select([0, 5], 3) == []  # never fewer GPUs than asked
+
+
+def test_parse_pcie_skips_nics():
+    t = load('pcie_2socket.txt')
+    assert t.gpu_ids == [0, 1, 2, 3]
+    assert t.numa_node == {0: 0, 1: 0, 2: 1, 3: 1}
+    assert t.select(t.gpu_ids, 2) == [0, 1]  # same PCIe switch
+
+
+def test_missing_file():
+    assert topology.load(os.path.join(FIXTURES, 'topology', 'missing.txt')) is None
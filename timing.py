@@ -0,0 +1,49 @@
+import contextlib, time
+from typing import Dict, List, Sequence, Tuple
+
+# lifecycle of a job on a runner, in order
+PHASES = ['queue_wait', 'claim', 'gpu_allocation', 'clone', 'prepare', 'execute', 'cleanup']
+# upper bounds of the histogram buckets in seconds; the last one is open
+BUCKETS_S = [0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000, 10000]
+
+
+class Spans():
+    ''' time spent in each phase of one job. A phase timed more than once (e.g. in two steps) adds up. '''
+    def __init__(self):
+        self.phases: Dict[str, List[float]] = {}  # phase -> [first begin (epoch seconds), seconds]
+
+    def add(self, phase: str, begin: float, seconds: float):
+        if phase in self.phases:
+            self.phases[phase][1] += seconds
+        else:
+            self.phases[phase] = [begin, seconds]
+
+    @contextlib.contextmanager
+    def span(self, phase: str):
+        begin = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, begin, time.time() - begin)
+
+    def items(self) -> List[Tuple[str, float, float]]:
+        ''' (phase, begin, seconds) in `PHASES` order '''
+        order = sorted(self.phases, key=lambda phase: PHASES.index(phase) if phase in PHASES else len(PHASES))
+        return [(phase, *self.phases[phase]) for phase in order]
+
+
+def histogram(durations: Sequence[float]) -> List[int]:
+    counts = [0] * (len(BUCKETS_S) + 1)
+    for duration in durations:
+        counts[next((i for i, bound in enumerate(BUCKETS_S) if duration < bound), len(BUCKETS_S))] += 1
+    return counts
+
+
+def format_histogram(durations: Sequence[float], width: int = 40) -> str:
+    counts = histogram(durations)
+    labels = ['< {}s'.format(bound) for bound in BUCKETS_S] + ['>= {}s'.format(BUCKETS_S[-1])]
+    lines = []
+    for label, count in zip(labels, counts):
+        if count > 0:
+            lines.append('  {:>9} {:>7} {}'.format(label, count, '#' * max(1, int(width * count / max(counts)))))
+    return '\n'.join(lines)
@@ -0,0 +1,110 @@
+import itertools, re, subprocess
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# higher is faster. NV# counts bonded NVLinks
+LINK_SCORES = {'SYS': 1, 'NODE': 2, 'PHB': 3, 'PXB': 4, 'PIX': 5}
+NVLINK_BASE_SCORE = 10
+MAX_COMBINATIONS = 20000
+
+
+def link_score(link: str) -> int:
+    if link.startswith('NV'):
+        return NVLINK_BASE_SCORE + int(link[2:] or 1)
+    return LINK_SCORES.get(link, 0)
+
+
+class Topology():
+    ''' GPU interconnect matrix of one host, as `nvidia-smi topo -m` prints it '''
+    def __init__(self, links: Dict[Tuple[int, int], str], cpu_affinity: Dict[int, str] = {}, numa_node: Dict[int, int] = {}):
+        self.links = links
+        self.cpu_affinity = cpu_affinity
+        self.numa_node = numa_node
+
+    @classmethod
+    def parse(cls, text: str) -> 'Topology':
+        text = re.sub(r'\x1b\[[0-9;]*m', '', text)
+        lines = [line for line in text.split('\n') if len(line.strip()) > 0]
+        header = [column.strip() for column in lines[0].split('\t')]
+        links, cpu_affinity, numa_node = {}, {}, {}
+        for line in lines[1:]:
+            values = [value.strip() for value in line.split('\t')]
+            if not re.fullmatch(r'GPU\d+', values[0]):
+                if values[0].startswith('Legend'):
+                    break
+                continue  # NICs
+            gpu = int(values[0][3:])
+            for column, value in zip(header[1:], values[1:]):
+                if re.fullmatch(r'GPU\d+', column) and value != 'X':
+                    links[gpu, int(column[3:])] = value
+                elif column == 'CPU Affinity':
+                    cpu_affinity[gpu] = value
+                elif column == 'NUMA Affinity' and value.isdigit():
+                    numa_node[gpu] = int(value)
+        return cls(links, cpu_affinity, numa_node)
+
+    @property
+    def gpu_ids(self) -> List[int]:
+        return sorted(set(gpu for gpu, _ in self.links))
+
+    def score(self, a: int, b: int) -> int:
+        return link_score(self.links.get((a, b), ''))
+
+    def _rank(self, chosen: Sequence[int], rest: Sequence[int]):
+        pairs = [self.score(a, b) for a, b in itertools.combinations(chosen, 2)]
+        # the slowest link bounds collective ops. Among equals, cut the fewest good links to the GPUs left free
+        cut = sum(self.score(a, b) for a in chosen for b in rest)
+        return (min(pairs) if pairs else 0, sum(pairs), -cut)
+
+    def select(self, available_gpu_ids: Sequence[int], num_gpu: int) -> List[int]:
+        ''' the best connected `num_gpu` of `available_gpu_ids`, leaving well connected groups for later jobs. [] if too few are available '''
+        available_gpu_ids = sorted(available_gpu_ids)
+        if num_gpu > len(available_gpu_ids) or num_gpu <= 0:
+            return []
+        if num_gpu == len(available_gpu_ids):
+            return available_gpu_ids
+        n_combinations = 1
+        for i in range(num_gpu):
+            n_combinations = n_combinations * (len(available_gpu_ids) - i) // (i + 1)
+        if n_combinations <= MAX_COMBINATIONS:
+            candidates = itertools.combinations(available_gpu_ids, num_gpu)
+        else:
+            candidates = [self._grow(available_gpu_ids, num_gpu, gpu) for gpu in available_gpu_ids]
+        best = max(candidates, key=lambda chosen: self._rank(chosen, [gpu for gpu in available_gpu_ids if gpu not in chosen]))
+        return sorted(best)
+
+    def _grow(self, available_gpu_ids: Sequence[int], num_gpu: int, first: int) -> List[int]:
+        # greedy for large hosts: add the GPU with the best slowest link to the chosen ones
+        chosen = [first]
+        while len(chosen) < num_gpu:
+            rest = [gpu for gpu in available_gpu_ids if gpu not in chosen]
+            chosen.append(max(rest, key=lambda gpu: (min(self.score(gpu, other) for other in chosen), -gpu)))
+        return chosen
+
+
+def load(path: Optional[str] = None) -> Optional[Topology]:
+    ''' parse `path`, or the output of `nvidia-smi topo -m`. None if unavailable. '''
+    try:
+        if path is not None:
+            with open(path, 'r') as f:
+                return Topology.parse(f.read())
+        return Topology.parse(subprocess.run(['nvidia-smi', 'topo', '-m'], capture_output=True, text=True, check=True).stdout)
+    except (OSError, subprocess.CalledProcessError, IndexError, ValueError):
+        return None
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser('print the GPUs a job would be placed on')
+    parser.add_argument('--file', type=str, default=None, help='saved `nvidia-smi topo -m` output, e.g. fixtures/topology/dgx1.txt')
+    parser.add_argument('--gpus', type=str, default='', help='available GPUs, e.g. 0,1,2,3. empty: all')
+    parser.add_argument('--num-gpu', type=int, nargs='+', default=[1, 2, 4])
+    args = parser.parse_args()
+
+    topology = load(args.file)
+    if topology is None:
+        parser.error('no topology')
+    available_gpu_ids = list(map(int, args.gpus.split(','))) if args.gpus else topology.gpu_ids
+    for num_gpu in args.num_gpu:
+        chosen = topology.select(available_gpu_ids, num_gpu)
+        links = ' '.join(topology.links[a, b] for a, b in itertools.combinations(chosen, 2))
+        print('{}\t{}\t{}'.format(num_gpu, ','.join(map(str, chosen)), links))
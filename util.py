@@ -12,4 +12,11 @@ class DelayedKeyboardInterrupt():
     def __exit__(self, type, value, traceback):
         signal.signal(signal.SIGINT, self.old_handler)
         if self.signal_received:
-            self.old_handler(*self.signal_received)
\ No newline at end of file
+            self.old_handler(*self.signal_received)
+
+
+def render_command(template: str, params: dict) -> str:
+    # plain replacement instead of str.format, shell commands often contain other braces
+    for key, value in params.items():
+        template = template.replace('{' + key + '}', str(value))
+    return template
@@ -0,0 +1,44 @@
+import select, socket
+from typing import Optional, Sequence
+
+
+def parse_address(address: str):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+class WakeupListener():
+    '''
+    UDP socket an idle runner blocks on. Anyone who enqueues jobs sends a datagram to `address` (see `notify`).
+    A lost datagram only delays the job until the runner's next poll.
+    '''
+    def __init__(self, host: str = '', port: int = 0, advertise_host: Optional[str] = None):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.sock.setblocking(False)
+        self.address = '{}:{}'.format(advertise_host or socket.gethostname(), self.sock.getsockname()[1])
+
+    def wait(self, timeout: float) -> bool:
+        ''' True if woken up within `timeout` seconds. Pending wakeups are drained. '''
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if len(readable) == 0:
+            return False
+        try:
+            while True:
+                self.sock.recv(64)
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        self.sock.close()
+
+
+def notify(addresses: Sequence[str]):
+    ''' wake up runners listening on `addresses` (`host:port`). Unreachable ones are ignored. '''
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for address in addresses:
+            try:
+                sock.sendto(b'wakeup', parse_address(address))
+            except (OSError, ValueError):
+                pass